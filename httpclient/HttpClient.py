@@ -1,23 +1,39 @@
 import logging
-import re
 from datetime import timedelta
 from threading import Lock
 
 import requests
 from requests.adapters import HTTPAdapter
-from requests.cookies import extract_cookies_to_jar
-from requests.hooks import dispatch_hook, default_hooks
+from requests.cookies import extract_cookies_to_jar, get_cookie_header
+from requests.hooks import default_hooks
 from requests.sessions import preferred_clock
 from requests.structures import CaseInsensitiveDict
-from requests.utils import get_encoding_from_headers
+from requests.utils import get_encoding_from_headers, rewind_body
 
+from httpclient.compression import Compression
+from httpclient.connection import POOL_CLASSES_BY_SCHEME, measure
 from httpclient.convey import Convey
+from httpclient.cookies import IndexedCookieJar
+from httpclient.extract import Extractor
+from httpclient.hooks import BackgroundHook, HookPipeline, HookWorker, BEFORE_REQUEST, TIMING
+from httpclient.http2 import H2Adapter
+from httpclient.multipart import FileBody, MultipartEncoder
+from httpclient.retry import CircuitOpenError
 from httpclient.strcutures import ResponseMixin, RandomUserAgentMixin, RequestMixin, WithContext, \
     NoEnableCacheRequest, text2dict
 from httpclient.strcutures import dict2text
 
 
 class UpgradeResponse(requests.Response, ResponseMixin):
+    from_cache = False
+    # 各个阶段的耗时，启用enable_timing后才会记录，具体查看RequestTiming类
+    timing = None
+    # 包括重试在内的请求次数
+    attempts = 1
+    # 启用enable_compression后才会统计，具体查看CompressionStats类
+    compression = None
+    # 使用H2Adapter时为协商后的协议版本
+    http_version = "HTTP/1.1"
 
     @property
     def text(self):
@@ -28,6 +44,10 @@ class UpgradeResponse(requests.Response, ResponseMixin):
 
 class Adapter(HTTPAdapter):
 
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = POOL_CLASSES_BY_SCHEME
+
     def build_response(self, req, resp) -> UpgradeResponse:
         response = UpgradeResponse()
 
@@ -80,7 +100,7 @@ class ClientMixin:
         def handle(func):
             def inner():
                 nonlocal result  # 声明result不是本地变量，寻找result变量
-                func.regex = lambda reg: re.findall(reg, result)
+                func.regex = lambda reg: Extractor(reg).findall(result.text)
 
                 return func(result)
 
@@ -88,6 +108,98 @@ class ClientMixin:
 
         return handle
 
+    def use_recorder(self, recorder):
+        """
+        使用录制/回放层，具体查看Recorder类
+        :param recorder: Recorder实例，为None时关闭
+        :return:
+        """
+        self.recorder = recorder
+        return self
+
+    def use_http_cache(self, cache):
+        """
+        使用RFC 7234 HTTP缓存，具体查看HttpCache类
+        :param cache: HttpCache实例，为None时关闭
+        :return:
+        """
+        self.http_cache = cache
+        return self
+
+    def use_retry(self, policy):
+        """
+        请求失败时按照重试策略重试，具体查看RetryPolicy类
+        :param policy: RetryPolicy实例，为None时关闭
+        :return:
+        """
+        self.retry_policy = policy
+        return self
+
+    def use_circuit_breaker(self, breaker):
+        """
+        按主机熔断，具体查看CircuitBreaker类
+        :param breaker: CircuitBreaker实例，为None时关闭
+        :return:
+        """
+        self.circuit_breaker = breaker
+        return self
+
+    def use_http2(self, adapter=None, prefixes=("https://",)):
+        """
+        使用HTTP/2传输层，具体查看H2Adapter类，with_*方法和Convey的用法不变
+        多个HttpClient可以共用同一个H2Adapter，共用时关闭任意一个HttpClient都会关闭该H2Adapter
+        :param adapter: H2Adapter实例，为None时创建新的实例
+        :param prefixes: 使用HTTP/2的URL前缀，h2c(http://)需要创建H2Adapter时指定http1=False
+        :return:
+        """
+        if adapter is None:
+            adapter = H2Adapter(response_cls=UpgradeResponse)
+        for prefix in prefixes:
+            self.mount(prefix, adapter)
+        return self
+
+    def enable_compression(self, encoding="gzip", min_size=1024, level=6):
+        """
+        发送Accept-Encoding: br, zstd, gzip并解码响应，大于min_size的请求体使用encoding压缩
+        请求和响应的压缩比保存在request.compression和response.compression中
+        :param encoding: 请求体的压缩格式 gzip，deflate或zstd(需要安装zstandard)
+        :param min_size: 小于该值的请求体不压缩
+        :param level: 压缩等级
+        :return:
+        """
+        self.compression = Compression(encoding, min_size, level)
+        return self
+
+    def disable_compression(self):
+        self.compression = None
+        return self
+
+    def enable_timing(self):
+        """
+        记录每个请求DNS解析，TCP连接，TLS握手，首字节时间和下载时间，结果保存在response.timing中
+        :return:
+        """
+        self.timing = True
+        return self
+
+    def disable_timing(self):
+        self.timing = False
+        return self
+
+    def timing_hooks(self, hook):
+        """
+        请求完成后将各个阶段的耗时传递给回调函数，会自动启用enable_timing
+
+        def callback(response, **kwargs):
+            print(response.timing)
+
+        :param hook:
+        :return:
+        """
+        self.req.add_hooks(TIMING, hook)
+        self._pipeline = None
+        return self.enable_timing()
+
     def check_cache(self):
         if not hasattr(self, "req"):
             raise NoEnableCacheRequest("请在实例化Client类时指定cache=True")
@@ -101,12 +213,30 @@ class ClientMixin:
             self.req.disable_random_ua()
         return self
 
-    def enable_random_ua(self):
+    def enable_random_ua(self, pool=None):
         """
         启用随机UA
+        :param pool: UserAgentPool实例，可以指定轮换方式或者从文件加载，不指定时使用默认的User-Agent池
         :return:
         """
-        self.req.enable_random_ua()
+        self.req.enable_random_ua(pool)
+        return self
+
+    def enable_stream(self):
+        """
+        启用流式响应，响应体不会在请求结束时读入内存
+        regex/extract/dump_text_context/dump_binary_context会逐块处理响应体
+        :return:
+        """
+        self.stream = True
+        return self
+
+    def disable_stream(self):
+        """
+        关闭流式响应
+        :return:
+        """
+        self.stream = False
         return self
 
     def reset(self):
@@ -225,7 +355,7 @@ class ClientMixin:
 
         self.check_cache()
         self._increment()
-        self.req.prepare_body(data, None)
+        self.req.prepare_body(None, None, data)
         return self
 
     def with_method(self, method):
@@ -239,22 +369,39 @@ class ClientMixin:
 
     def with_file(self, filename):
         """
-        上传文件
+        上传文件，文件在发送时才打开，发送完毕后关闭
         :param filename: 文件路径
         :return:
         """
-        self.with_stream(open(filename, "rb"))
-        return self
+        return self.with_stream(FileBody(filename))
 
     def with_stream(self, file_stream):
         """
-        使用字节流形式
+        使用字节流形式，文件对象会按块发送，内存占用与文件大小无关
         :param file_stream: 二进制字节流
         :return:
         """
         self.check_cache()
         self._increment()
-        self.req.prepare_body(None, file_stream)
+        self.req.prepare_body(FileBody.wrap(file_stream), None)
+        return self
+
+    def with_multipart(self, fields):
+        """
+        使用流式multipart/form-data上传，文件内容在发送时按块读取
+        例如：
+            c = HttpClient()
+            c.do("http://127.0.0.1/upload").with_method("POST")\
+                .with_multipart({"name": "demo", "file": ("a.bin", "/tmp/a.bin")}).result
+        :param fields: MultipartEncoder或者MultipartEncoder支持的字段
+        :return:
+        """
+        if not isinstance(fields, MultipartEncoder):
+            fields = MultipartEncoder(fields)
+        self.check_cache()
+        self._increment()
+        self.req.prepare_body(fields, None)
+        self.req.set_body_content_type(fields.content_type)
         return self
 
     def with_body(self, data, file, js):
@@ -306,17 +453,20 @@ class ClientMixin:
         self.req.prepare_method("POST")
         return self.with_json(js)
 
-    def add_hooks(self, hook_name: str, hook):
+    def add_hooks(self, hook_name: str, hook, background=False):
         """
         添加回调函数，添加完回调函数后需要手动指定需要哪些函数需要调用
+        回调函数可以是async函数，async函数在后台事件循环中执行
         :param hook_name:
         :param hook:
+        :param background: 为True时在后台线程中执行，不会阻塞请求，适合记录日志等较慢的操作
         :return:
         """
         if hook_name == 'response':
             logging.warning("do not use hooks named `response` this will ignore")
             return self
-        self.req.add_hooks(hook_name, hook)
+        self.req.add_hooks(hook_name, BackgroundHook(hook) if background else hook)
+        self._pipeline = None
         return self
 
     def dispatch_hooks(self, hooks: str):
@@ -340,6 +490,7 @@ class ClientMixin:
             has_instance = True
         if not has_instance:
             logging.warning(f"`{hooks}` not found, make sure you add hooks by `add_hooks` method")
+        self._pipeline = None
         return self
 
     def response_hooks(self, hooks):
@@ -349,6 +500,22 @@ class ClientMixin:
         :return:
         """
         self.req.hooks["response"] = hooks
+        self._pipeline = None
+        return self
+
+    def before_hooks(self, hooks):
+        """
+        请求发送前执行的回调函数，返回值不为None时会替换请求
+
+        def callback(request, **kwargs):
+            request.headers["X-Trace-Id"] = uuid.uuid4().hex
+            return request
+
+        :param hooks: 回调函数或者回调函数列表
+        :return:
+        """
+        self.req.hooks[BEFORE_REQUEST] = hooks
+        self._pipeline = None
         return self
 
     @property
@@ -360,7 +527,7 @@ class ClientMixin:
         self.check_cache()
         self.reset()
         if hasattr(self.req, "ua") and self.req.ua:
-            ua = {"User-Agent": next(self.req.random())}
+            ua = {"User-Agent": self.req.user_agent()}
             if self.req.headers:
                 self.req.headers.update(ua)
             else:
@@ -386,7 +553,22 @@ class HttpClient(requests.Session, ClientMixin):
         self.mount('https://', Adapter())
         self.mount('http://', Adapter())
         self.req = HttpRequest().reset_all()
+        self.cookies = IndexedCookieJar()
         self._dispatch_hooks = []
+        self._pipeline = None
+        self._hook_worker = HookWorker()
+        self.recorder = None
+        self.http_cache = None
+        self.timing = False
+        self.retry_policy = None
+        self.circuit_breaker = None
+        self.compression = None
+
+    def close(self):
+        self._hook_worker.close()
+        if self.recorder is not None:
+            self.recorder.save()
+        super().close()
 
     def send(self, request, **kwargs) -> UpgradeResponse:
         kwargs.setdefault('stream', self.stream)
@@ -399,23 +581,29 @@ class HttpClient(requests.Session, ClientMixin):
         if isinstance(request, HttpRequest):
             request.check()
         allow_redirects = kwargs.pop('allow_redirects', True)
-        hooks = request.hooks
+        pipeline = self._hook_pipeline(request)
 
-        adapter = self.get_adapter(url=request.url)
+        request = pipeline.run_before(request, **kwargs)
 
-        start = preferred_clock()
+        # 会话中保存的Cookie，请求中已经指定Cookie时不覆盖
+        if "Cookie" not in request.headers:
+            cookie = get_cookie_header(self.cookies, request)
+            if cookie:
+                request = request.copy()
+                request.headers["Cookie"] = cookie
 
-        r = adapter.send(request, **kwargs)
+        if self.compression is not None:
+            request = self.compression.prepare(request)
 
-        elapsed = preferred_clock() - start
-        r.elapsed = timedelta(seconds=elapsed)
+        adapter = self.get_adapter(url=request.url)
+
+        r = self._cached_send(adapter, request, **kwargs)
 
         # this function not change response and result params
-        if len(self._dispatch_hooks) > 0:
-            dispatch(self._dispatch_hooks, hooks, r, **kwargs)
+        pipeline.run_observers(r, **kwargs)
 
         # dispatch hook will change response and request params
-        r = dispatch_hook('response', hooks, r, **kwargs)
+        r = pipeline.run_response(r, **kwargs)
 
         if r.history:
             for resp in r.history:
@@ -438,10 +626,136 @@ class HttpClient(requests.Session, ClientMixin):
             except StopIteration:
                 pass
 
+        if not kwargs["stream"]:
+            r.content
+            if r.timing is not None:
+                r.timing.mark("end")
+            if self.compression is not None:
+                r.compression = Compression.response_stats(r)
+
+        # background, async and timing hooks run after the body has been read
+        pipeline.run_deferred(r, **kwargs)
+
+        return r
+
+    def _hook_pipeline(self, request) -> HookPipeline:
+        if request.hooks is not self.req.hooks:
+            return HookPipeline(request.hooks, self._dispatch_hooks, self._hook_worker)
+        if self._pipeline is None:
+            self._pipeline = HookPipeline(self.req.hooks, self._dispatch_hooks, self._hook_worker)
+        return self._pipeline
+
+    def _cached_send(self, adapter, request, **kwargs):
+        cache = self.http_cache
+        if cache is None:
+            return self._transmit(adapter, request, **kwargs)
+        if not cache.cacheable_request(request):
+            r = self._transmit(adapter, request, **kwargs)
+            if r.ok:
+                cache.invalidate(request)
+            return r
+        entry = cache.lookup(request)
+        if cache.fresh(request, entry):
+            return cache.cached(request, entry, UpgradeResponse)
+        r = self._transmit(adapter, cache.conditional(request, entry), **kwargs)
+        return cache.update(request, entry, r, UpgradeResponse)
+
+    def _transmit(self, adapter, request, **kwargs):
+        recorder = self.recorder
+        if recorder is not None and recorder.should_replay(request):
+            r = recorder.replay(request, UpgradeResponse)
+            r.connection = adapter
+            return r
+
+        r = self._send_with_retry(adapter, request, **kwargs)
+
+        if recorder is not None and recorder.recording:
+            recorder.record(request, r)
+        return r
+
+    def _send_with_retry(self, adapter, request, **kwargs):
+        policy, breaker = self.retry_policy, self.circuit_breaker
+        if policy is None and breaker is None:
+            return self._send_once(adapter, request, **kwargs)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if breaker is not None:
+                breaker.before(request)
+            try:
+                r = self._send_once(adapter, request, **kwargs)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                if breaker is not None:
+                    breaker.record(request, False)
+                if (policy is None or not isinstance(e, policy.errors) or not policy.can_retry(request, attempt)
+                        or not self._replayable(request)):
+                    raise
+                logging.warning(f"{request.method} {request.url} failed: {e!r}, retry {attempt}/{policy.total}")
+                self._prepare_retry(policy, request, attempt, None)
+                continue
+
+            if breaker is not None:
+                breaker.record(request, not breaker.failed(r))
+            if (policy is not None and policy.retry_status(r) and policy.can_retry(request, attempt)
+                    and self._replayable(request)):
+                logging.warning(f"{request.method} {request.url} got {r.status_code}, retry {attempt}/{policy.total}")
+                self._prepare_retry(policy, request, attempt, r)
+                continue
+            r.attempts = attempt
+            return r
+
+    @staticmethod
+    def _replayable(request) -> bool:
+        """
+        请求体能否重新发送，迭代器和生成器发送后已经耗尽，重试会发送空的或者不完整的请求体
+        :param request:
+        :return:
+        """
+        body = request.body
+        if body is None or isinstance(body, (bytes, bytearray, str)):
+            return True
+        if getattr(request, "_body_factory", None) is not None:
+            return True
+        position = getattr(request, "_body_position", None)
+        if isinstance(position, int):
+            return True
+        logging.warning(f"{request.method} {request.url} body can not be rewound, will not retry")
+        return False
+
+    @staticmethod
+    def _prepare_retry(policy, request, attempt, response):
+        delay = policy.backoff(attempt, response)
+        if response is not None:
+            response.close()
+        factory = getattr(request, "_body_factory", None)
+        if factory is not None:
+            # 请求体由生成器产生时(例如压缩后的流)，重新创建生成器
+            request.body = factory()
+        elif request._body_position is not None:
+            rewind_body(request)
+        policy.sleep(delay)
+
+    def _send_once(self, adapter, request, **kwargs):
+        start = preferred_clock()
+
+        if self.timing:
+            with measure() as timing:
+                r = adapter.send(request, **kwargs)
+            r.timing = timing
+        else:
+            r = adapter.send(request, **kwargs)
+
+        elapsed = preferred_clock() - start
+        r.elapsed = timedelta(seconds=elapsed)
         return r
 
 
 class HttpRequest(requests.PreparedRequest, RandomUserAgentMixin, RequestMixin):
+    # 请求体设置的Content-Type(json，表单，multipart)，更换请求体时删除
+    _body_content_type = None
 
     def __init__(self):
         super().__init__()
@@ -456,14 +770,41 @@ class HttpRequest(requests.PreparedRequest, RandomUserAgentMixin, RequestMixin):
         self._body_position = None
         return self
 
+    def prepare_body(self, data, files, json=None):
+        # 请求对象会被重复使用，先清除上一个请求体留下的长度和分块头
+        if self.headers:
+            self.headers.pop("Content-Length", None)
+            self.headers.pop("Transfer-Encoding", None)
+            # 通过with_headers指定的Content-Type保留
+            if self._body_content_type is not None and self.headers.get("Content-Type") == self._body_content_type:
+                del self.headers["Content-Type"]
+        self._body_position = None
+        content_type = self.headers.get("Content-Type") if self.headers else None
+        super().prepare_body(data, files, json)
+        body_content_type = self.headers.get("Content-Type")
+        self._body_content_type = body_content_type if body_content_type != content_type else None
+
+    def set_body_content_type(self, content_type):
+        """
+        设置由请求体决定的Content-Type，下一次prepare_body时会被删除
+        :param content_type:
+        :return:
+        """
+        self.headers["Content-Type"] = content_type
+        self._body_content_type = content_type
+
     def check(self):
         for attr in ("url", "method"):
             if not self.__getattribute__(attr):
                 raise ValueError("The request must have `{}`".format(attr))
 
     def reset(self):
+        """
+        清除上一个请求留下的地址，请求方法，请求头和请求体，回调函数保留
+        :return:
+        """
         self.url = None
-        self.headers = None
+        self.headers = CaseInsensitiveDict()
         self.method = "GET"
         self.body = None
         self._body_position = None
@@ -476,20 +817,3 @@ class HttpRequest(requests.PreparedRequest, RandomUserAgentMixin, RequestMixin):
         self.hooks[hook_name] = func
         return self
 
-
-def dispatch(key, hooks, hook_data, **kwargs):
-    hooks = hooks or {}
-
-    def inner(_key, _hooks, _hook_data, **_kwargs):
-        _hooks = _hooks.get(_key)
-        if _hooks:
-            if hasattr(_hooks, '__call__'):
-                _hooks = [_hooks]
-            for hook in _hooks:
-                hook(_hook_data, **_kwargs)
-
-    if isinstance(key, str):
-        inner(key, hooks, hook_data, **kwargs)
-    if isinstance(key, list):
-        for k in key:
-            inner(k, hooks, hook_data, **kwargs)
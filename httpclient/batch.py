@@ -0,0 +1,250 @@
+"""
+
+spec = ResponseSpec()\
+    .status(should_equal, 200)\
+    .header("Content-Type", should_contains, "json")\
+    .json_path("data.id", should_not_none)\
+    .regex(r'"token": "(\\w+)"', should_not_none)
+
+convey = Convey(self)
+report = convey.so_batch(responses, spec)
+"""
+import operator
+
+from httpclient.extract import Extractor
+from httpclient.funcions import should_none, should_not_none, should_equal, should_not_equal, should_true, \
+    should_false, should_contains, should_not_contains
+from httpclient.strcutures import compile_path
+
+_ABSENT = object()
+
+# 断言函数对应的判断函数，参数为(实际值, 预期值)，语义与Convey.so相同
+PREDICATES = {
+    should_none: (lambda real, _: real is None, "is None"),
+    should_not_none: (lambda real, _: real is not None, "is not None"),
+    should_equal: (operator.eq, "=="),
+    should_not_equal: (operator.ne, "!="),
+    should_true: (lambda real, _: bool(real), "is true"),
+    should_false: (lambda real, _: not real, "is false"),
+    should_contains: (lambda real, value: value in real, "contains"),
+    should_not_contains: (lambda real, value: value not in real, "not contains"),
+}
+
+
+class _Check:
+    __slots__ = ("name", "getter", "predicate", "op", "except_value", "fn")
+
+    def __init__(self, name, getter, fn, except_value):
+        self.name = name
+        self.getter = getter
+        self.fn = fn
+        self.except_value = except_value
+        self.predicate, self.op = PREDICATES.get(fn, (None, getattr(fn, "__name__", repr(fn))))
+
+    def describe(self) -> str:
+        if self.fn in (should_none, should_not_none, should_true, should_false):
+            return "{} {}".format(self.name, self.op)
+        return "{} {} {!r}".format(self.name, self.op, self.except_value)
+
+
+class ResponseSpec:
+    """
+    批量断言的规则，创建后可以重复用于多批响应
+    JSON路径和正则表达式在添加规则时编译，断言函数转换为普通的判断函数，
+    批量断言时不会为每个响应调用unittest的assert*方法，自定义的断言函数除外
+    """
+
+    def __init__(self):
+        self.checks = []
+
+    def _add(self, name, getter, fn, except_value):
+        self.checks.append(_Check(name, getter, fn, except_value))
+        return self
+
+    def status(self, fn, except_value=None):
+        """
+        断言HTTP状态码
+        :param fn: 断言函数
+        :param except_value: 预期结果
+        :return:
+        """
+        return self._add("status_code", lambda r: r.status_code, fn, except_value)
+
+    def header(self, header_name, fn, except_value=None):
+        """
+        断言HTTP响应头，响应头不存在时实际值为None
+        :param header_name: 响应头字段
+        :param fn: 断言函数
+        :param except_value: 预期结果
+        :return:
+        """
+        return self._add("headers[{!r}]".format(header_name), lambda r: r.headers.get(header_name), fn, except_value)
+
+    def json_path(self, path, fn, except_value=None):
+        """
+        使用路径表达式断言json中的值，路径语法查看JSONPath类，路径不存在或者响应不是json时断言失败
+        :param path: 路径表达式
+        :param fn: 断言函数
+        :param except_value: 预期结果
+        :return:
+        """
+        compiled = compile_path(path)
+        return self._add("json[{!r}]".format(path),
+                         lambda r: compiled.find(r.jsonify.document, _ABSENT), fn, except_value)
+
+    def regex(self, pattern, fn, except_value=None, index=None, trim=False):
+        """
+        使用正则表达式提取响应内容后断言
+        :param pattern: 表达式或者Extractor
+        :param fn: 断言函数
+        :param except_value: 预期结果
+        :param index: 获取第index个结果，为None时使用Extractor的index，表达式默认为0
+        :param trim: 为True时删除响应体中的换行后再匹配，使用Extractor时在创建Extractor时指定
+        :return:
+        """
+        if isinstance(pattern, Extractor):
+            if trim:
+                raise ValueError("`trim` can not be used with an Extractor, pass it to Extractor instead")
+            extractor = pattern
+        else:
+            extractor = Extractor(pattern, 0 if index is None else index, trim)
+        getter = extractor if index is None else lambda r: extractor(r, index)
+        return self._add("regex[{!r}]".format(extractor.pattern.pattern), getter, fn, except_value)
+
+    def response(self, where, fn, except_value=None):
+        """
+        断言响应对象的属性，使用ResponseTable指定
+        :param where: 属性名
+        :param fn: 断言函数
+        :param except_value: 预期结果
+        :return:
+        """
+        return self._add(where, lambda r: getattr(r, where), fn, except_value)
+
+    def evaluate(self, responses, case=None):
+        """
+        按规则逐列检查所有响应
+        :param responses: 响应列表
+        :param case: unittest.TestCase，只有自定义的断言函数会用到
+        :return: BatchReport
+        """
+        responses = list(responses)
+        failures = []
+        for check in self.checks:
+            predicate, getter, except_value = check.predicate, check.getter, check.except_value
+            for i, response in enumerate(responses):
+                try:
+                    real = getter(response)
+                except Exception as e:
+                    failures.append((i, check, "<{}: {}>".format(type(e).__name__, e)))
+                    continue
+                if real is _ABSENT:
+                    failures.append((i, check, "<missing>"))
+                    continue
+                try:
+                    if predicate is not None:
+                        ok = predicate(real, except_value)
+                    else:
+                        check.fn(case, real, except_value)
+                        ok = True
+                except Exception:
+                    ok = False
+                if not ok:
+                    failures.append((i, check, real))
+        return BatchReport(len(responses), self.checks, failures)
+
+
+class BatchReport:
+    """
+    批量断言的结果
+        total: 响应数量
+        failures: (响应索引, 规则, 实际值) 列表
+    """
+
+    def __init__(self, total, checks, failures):
+        self.total = total
+        self.checks = checks
+        self.failures = failures
+
+    @property
+    def ok(self) -> bool:
+        return not self.failures
+
+    @property
+    def failed_responses(self) -> list:
+        """
+        断言失败的响应索引
+        :return:
+        """
+        return sorted({i for i, _, _ in self.failures})
+
+    def format(self, max_samples=5) -> str:
+        """
+        按规则汇总失败信息，每个规则最多展示max_samples个失败的响应
+        :param max_samples:
+        :return:
+        """
+        if self.ok:
+            return "{} responses, {} checks passed".format(self.total, len(self.checks))
+        grouped = {}
+        for i, check, real in self.failures:
+            grouped.setdefault(check, []).append((i, real))
+        lines = ["{} of {} responses failed {} of {} checks".format(
+            len(self.failed_responses), self.total, len(grouped), len(self.checks))]
+        for check in self.checks:
+            failed = grouped.get(check)
+            if not failed:
+                continue
+            lines.append("  {}: {} failed".format(check.describe(), len(failed)))
+            for i, real in failed[:max_samples]:
+                lines.append("    response[{}]: {!r}".format(i, real))
+            if len(failed) > max_samples:
+                lines.append("    ... {} more".format(len(failed) - max_samples))
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.format()
+
+
+if __name__ == '__main__':
+    import json
+    import time
+    import unittest
+
+    from httpclient.HttpClient import UpgradeResponse
+
+    def fake(i):
+        r = UpgradeResponse()
+        r.status_code = 200 if i % 10 else 500
+        r.headers["Content-Type"] = "application/json"
+        r._content = json.dumps({"data": {"id": i, "token": "t{}".format(i)}}).encode()
+        r.encoding = "utf-8"
+        return r
+
+    spec = ResponseSpec()\
+        .status(should_equal, 200)\
+        .header("Content-Type", should_contains, "json")\
+        .json_path("data.id", should_not_none)\
+        .json_path("data.token", should_not_equal, "")\
+        .regex(r'"token": "(\w+)"', should_not_none)
+
+    responses = [fake(i) for i in range(10000)]
+    start = time.perf_counter()
+    report = spec.evaluate(responses)
+    print("batch: {:.1f}ms".format((time.perf_counter() - start) * 1000))
+    print(report)
+
+    case = unittest.TestCase()
+    responses = [fake(i) for i in range(10000)]
+    start = time.perf_counter()
+    for r in responses:
+        for fn, real, value in ((should_equal, r.status_code, 200),
+                                (should_contains, r.headers["Content-Type"], "json"),
+                                (should_not_none, r.jsonify.path("data.id"), None),
+                                (should_not_equal, r.jsonify.path("data.token"), ""),
+                                (should_not_none, r.regex(r'"token": "(\w+)"'), None)):
+            try:
+                fn(case, real, value)
+            except AssertionError:
+                pass
+    print("assert*: {:.1f}ms".format((time.perf_counter() - start) * 1000))
@@ -0,0 +1,243 @@
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from httpclient.recorder import ResponseSnapshot
+from tools.cache import LRUCache
+
+_CACHE_CONTROL = re.compile(r'([\w\-]+)\s*(?:=\s*("[^"]*"|[^,\s]*))?')
+# RFC 7231 6.1 默认可以缓存的状态码
+_CACHEABLE_STATUS = frozenset((200, 203, 204, 300, 301, 404, 405, 410, 414, 501))
+# RFC 7234 4.3.4 304响应中不能覆盖缓存的头部
+_SKIP_UPDATE_HEADERS = frozenset(("content-length", "content-encoding", "transfer-encoding"))
+_UNSAFE_METHODS = frozenset(("POST", "PUT", "PATCH", "DELETE"))
+
+
+def parse_cache_control(value) -> dict:
+    """
+    解析Cache-Control头部
+        max-age=60, no-cache -> {"max-age": "60", "no-cache": None}
+    :param value:
+    :return:
+    """
+    if not value:
+        return {}
+    return {k.lower(): v.strip('"') if v else None for k, v in _CACHE_CONTROL.findall(value)}
+
+
+def parse_http_date(value):
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def _seconds(directives: dict, name):
+    try:
+        return max(0, int(directives[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class CacheEntry:
+    """
+    缓存的响应和计算新鲜度需要的时间信息
+    """
+    __slots__ = ("snapshot", "response_time", "initial_age", "lifetime", "vary", "no_cache")
+
+    def __init__(self, snapshot: ResponseSnapshot, request_headers, response_time):
+        self.snapshot = snapshot
+        self.response_time = response_time
+        headers = self.headers
+        self.vary = {name: request_headers.get(name) for name in self.vary_names(headers)}
+        self.refresh(headers, response_time)
+
+    @property
+    def headers(self) -> dict:
+        return {k.lower(): v for k, v in self.snapshot.headers}
+
+    @staticmethod
+    def vary_names(headers: dict):
+        return [name.strip() for name in headers.get("vary", "").split(",") if name.strip()]
+
+    def refresh(self, headers: dict, response_time):
+        """
+        根据响应头重新计算新鲜度
+        RFC 7234 4.2.1 freshness_lifetime 和 4.2.3 current_age
+        :param headers: 小写的响应头
+        :param response_time:
+        :return:
+        """
+        directives = parse_cache_control(headers.get("cache-control"))
+        date = parse_http_date(headers.get("date")) or response_time
+        age = _seconds({"age": headers.get("age")}, "age") or 0
+        self.response_time = response_time
+        self.initial_age = max(0, response_time - date, age)
+        self.no_cache = "no-cache" in directives
+
+        lifetime = _seconds(directives, "max-age")
+        if lifetime is None:
+            expires = parse_http_date(headers.get("expires"))
+            if expires is not None:
+                lifetime = max(0, expires - date)
+            else:
+                # RFC 7234 4.2.2 启发式新鲜度，Last-Modified到Date时间的10%
+                modified = parse_http_date(headers.get("last-modified"))
+                lifetime = max(0, (date - modified) / 10) if modified is not None else 0
+        self.lifetime = lifetime
+
+    def current_age(self, now=None) -> float:
+        now = time.time() if now is None else now
+        return self.initial_age + (now - self.response_time)
+
+    def fresh(self, request_directives: dict) -> bool:
+        if self.no_cache or "no-cache" in request_directives:
+            return False
+        lifetime = self.lifetime
+        max_age = _seconds(request_directives, "max-age")
+        if max_age is not None:
+            lifetime = min(lifetime, max_age)
+        return self.current_age() < lifetime
+
+    def matches(self, request) -> bool:
+        return all(request.headers.get(name) == value for name, value in self.vary.items())
+
+    def validators(self) -> dict:
+        headers = self.headers
+        conditional = {}
+        if headers.get("etag"):
+            conditional["If-None-Match"] = headers["etag"]
+        if headers.get("last-modified"):
+            conditional["If-Modified-Since"] = headers["last-modified"]
+        return conditional
+
+    def update_headers(self, headers):
+        """
+        使用304响应的头部更新缓存的头部
+        :param headers:
+        :return:
+        """
+        updated = {k.lower(): (k, v) for k, v in headers.items() if k.lower() not in _SKIP_UPDATE_HEADERS}
+        stored = [(k, v) for k, v in self.snapshot.headers if k.lower() not in updated]
+        self.snapshot.headers = stored + list(updated.values())
+
+
+class HttpCache:
+    """
+    RFC 7234 私有HTTP缓存，缓存GET请求的响应
+
+    client = HttpClient()
+    client.use_http_cache(HttpCache(cap=256))
+
+    新鲜的响应直接从缓存返回，过期的响应使用If-None-Match/If-Modified-Since重新验证，
+    服务器返回304时使用缓存的响应体，使用LRU策略淘汰缓存
+    """
+
+    def __init__(self, cap=1024, storage=None):
+        """
+        :param cap: 默认LRUCache的容量
+        :param storage: tools.cache中的任意缓存，不指定时使用LRUCache
+        """
+        self._storage = storage if storage is not None else LRUCache(cap)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(request) -> str:
+        return "{} {}".format(request.method, request.url)
+
+    @staticmethod
+    def cacheable_request(request) -> bool:
+        if request.method != "GET":
+            return False
+        return "no-store" not in parse_cache_control(request.headers.get("Cache-Control"))
+
+    def lookup(self, request):
+        with self._lock:
+            entry = self._storage.get(self.key(request))
+        if entry is not None and entry.matches(request):
+            return entry
+        return None
+
+    def fresh(self, request, entry) -> bool:
+        return entry is not None and entry.fresh(parse_cache_control(request.headers.get("Cache-Control")))
+
+    def conditional(self, request, entry):
+        """
+        为过期的缓存创建条件请求
+        :param request:
+        :param entry:
+        :return:
+        """
+        validators = entry.validators() if entry is not None else None
+        if not validators:
+            return request
+        conditional = request.copy()
+        conditional.headers.update(validators)
+        return conditional
+
+    def cached(self, request, entry, response_cls):
+        with self._lock:
+            self.hits += 1
+        response = entry.snapshot.to_response(request, response_cls)
+        response.from_cache = True
+        return response
+
+    def update(self, request, entry, response, response_cls):
+        """
+        处理源服务器的响应：304时更新并返回缓存的响应，否则尝试缓存新的响应
+        :param request: 原始请求
+        :param entry: 过期的缓存，没有时为None
+        :param response: 源服务器的响应
+        :param response_cls: 响应对象的类型
+        :return:
+        """
+        now = time.time()
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            with self._lock:
+                self.revalidated += 1
+                entry.update_headers(response.headers)
+                entry.refresh(entry.headers, now)
+            cached = entry.snapshot.to_response(request, response_cls)
+            cached.elapsed = response.elapsed
+            cached.from_cache = True
+            return cached
+        with self._lock:
+            self.misses += 1
+        if self.storable(request, response):
+            new_entry = CacheEntry(ResponseSnapshot.from_response(response), request.headers, now)
+            with self._lock:
+                self._storage.put(self.key(request), new_entry)
+        return response
+
+    @staticmethod
+    def storable(request, response) -> bool:
+        if response.status_code not in _CACHEABLE_STATUS:
+            return False
+        directives = parse_cache_control(response.headers.get("Cache-Control"))
+        if "no-store" in directives or response.headers.get("Vary", "").strip() == "*":
+            return False
+        return any((
+            "max-age" in directives, "Expires" in response.headers,
+            "ETag" in response.headers, "Last-Modified" in response.headers
+        ))
+
+    def invalidate(self, request):
+        """
+        不安全的请求方法成功后删除同一个URL的缓存 RFC 7234 4.4
+        :param request:
+        :return:
+        """
+        if request.method in _UNSAFE_METHODS:
+            key = "GET {}".format(request.url)
+            with self._lock:
+                self._storage.delete(key)
+
+    def __len__(self):
+        return len(self._storage)
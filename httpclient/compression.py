@@ -0,0 +1,169 @@
+import logging
+import zlib
+
+from urllib3.util.request import ACCEPT_ENCODING
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_CHUNK_SIZE = 64 * 1024
+# 优先级从高到低，只声明urllib3能够解码的格式
+_PREFERRED_ENCODINGS = ("br", "zstd", "gzip", "deflate")
+
+
+def accept_encoding() -> str:
+    """
+    返回Accept-Encoding，例如 br, zstd, gzip, deflate
+    br和zstd需要安装brotli和zstandard才能解码
+    :return:
+    """
+    supported = {e.strip() for e in ACCEPT_ENCODING.split(",")}
+    return ", ".join(e for e in _PREFERRED_ENCODINGS if e in supported)
+
+
+class CompressionStats:
+    """
+    压缩统计，wire_bytes为实际传输的字节数，raw_bytes为压缩前的字节数
+    """
+    __slots__ = ("encoding", "wire_bytes", "raw_bytes")
+
+    def __init__(self, encoding, wire_bytes=0, raw_bytes=0):
+        self.encoding = encoding
+        self.wire_bytes = wire_bytes
+        self.raw_bytes = raw_bytes
+
+    @property
+    def ratio(self) -> float:
+        """
+        压缩比，raw_bytes / wire_bytes
+        :return:
+        """
+        return self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+
+    def __repr__(self):
+        return "CompressionStats(encoding={}, wire_bytes={}, raw_bytes={}, ratio={:.2f})".format(
+            self.encoding, self.wire_bytes, self.raw_bytes, self.ratio)
+
+
+def _compressor(encoding, level):
+    if encoding == "gzip":
+        # wbits=31输出gzip格式，头部中的时间为0，相同的请求体压缩结果相同
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if encoding == "deflate":
+        return zlib.compressobj(level)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd request compression requires `zstandard`")
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError(f"unsupported content encoding `{encoding}`")
+
+
+class Compression:
+    """
+    请求体压缩和响应解压
+
+    client = HttpClient()
+    client.enable_compression("gzip", min_size=1024)
+
+    发送Accept-Encoding: br, zstd, gzip，响应体由urllib3解码
+    大于min_size的请求体使用encoding压缩，流式请求体逐块压缩并使用chunked传输
+    """
+
+    def __init__(self, encoding="gzip", min_size=1024, level=6):
+        _compressor(encoding, level)
+        self.encoding = encoding
+        self.min_size = min_size
+        self.level = level
+        self.accept = accept_encoding()
+
+    def prepare(self, request):
+        """
+        返回压缩后的请求副本，不会修改原请求
+        :param request:
+        :return:
+        """
+        request = request.copy()
+        if "Accept-Encoding" not in request.headers:
+            request.headers["Accept-Encoding"] = self.accept
+        body = request.body
+        if body is None or "Content-Encoding" in request.headers:
+            return request
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if isinstance(body, (bytes, bytearray)):
+            if len(body) < self.min_size:
+                return request
+            compressor = _compressor(self.encoding, self.level)
+            data = compressor.compress(body) + compressor.flush()
+            request.compression = CompressionStats(self.encoding, len(data), len(body))
+            request.body = data
+            request.headers["Content-Length"] = str(len(data))
+        elif hasattr(body, "read") or hasattr(body, "__iter__"):
+            request.body = self._rebuild(request, body, request._body_position)()
+            # 请求体已经替换为生成器，不能再通过_body_position回退，重试时由_body_factory重新创建
+            request._body_position = None
+            request.headers.pop("Content-Length", None)
+            request.headers["Transfer-Encoding"] = "chunked"
+        else:
+            return request
+        request.headers["Content-Encoding"] = self.encoding
+        return request
+
+    def _rebuild(self, request, body, position):
+        """
+        返回创建压缩流的函数，源请求体可以回退时保存到request._body_factory，重试时重新压缩
+        :param request:
+        :param body: 源请求体
+        :param position: 源请求体的起始位置，为None时无法回退
+        :return:
+        """
+        seekable = hasattr(body, "read") and hasattr(body, "seek") and isinstance(position, int)
+        # 列表等可以重复迭代的对象每次iter都返回新的迭代器
+        reiterable = not hasattr(body, "read") and iter(body) is not body
+
+        def factory():
+            if seekable:
+                body.seek(position)
+            stats = request.compression = CompressionStats(self.encoding)
+            return self._stream(body, stats)
+
+        request._body_factory = factory if seekable or reiterable else None
+        return factory
+
+    def _stream(self, body, stats: CompressionStats):
+        compressor = _compressor(self.encoding, self.level)
+        if hasattr(body, "read"):
+            chunks = iter(lambda: body.read(_CHUNK_SIZE), b"")
+        else:
+            chunks = body
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            stats.raw_bytes += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                stats.wire_bytes += len(data)
+                yield data
+        data = compressor.flush()
+        stats.wire_bytes += len(data)
+        yield data
+
+    @staticmethod
+    def response_stats(response):
+        """
+        统计已经读取完毕的响应体的压缩比
+        :param response:
+        :return:
+        """
+        raw = response.raw
+        content = response._content
+        if raw is None or not isinstance(content, bytes) or not hasattr(raw, "tell"):
+            return None
+        try:
+            wire = raw.tell()
+        except Exception as e:
+            logging.debug(f"can not get wire bytes: {e}")
+            return None
+        return CompressionStats(response.headers.get("Content-Encoding", "identity"), wire, len(content))
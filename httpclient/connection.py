@@ -0,0 +1,178 @@
+import inspect
+import socket
+import threading
+from contextlib import contextmanager
+
+from requests.sessions import preferred_clock
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+_STATE = threading.local()
+# urllib3 1.x的HTTPConnection.request沿用http.client的签名，不接受chunked参数(chunked请求走request_chunked)
+_REQUEST_CHUNKED = "chunked" in inspect.signature(HTTPConnection.request).parameters
+
+
+class RequestTiming:
+    """
+    单个请求各个阶段的耗时，单位秒
+        dns: DNS解析
+        connect: TCP连接
+        tls: TLS握手
+        send: 准备并发送请求
+        ttfb: 请求发送完毕到收到响应头(服务器处理时间)
+        download: 接收响应体
+    复用连接时dns，connect，tls为None，reused为True
+    """
+    __slots__ = ("start", "dns_start", "dns_end", "connect_end", "tls_end", "sent", "first_byte", "end")
+
+    def __init__(self):
+        self.start = preferred_clock()
+        self.dns_start = None
+        self.dns_end = None
+        self.connect_end = None
+        self.tls_end = None
+        self.sent = None
+        self.first_byte = None
+        self.end = None
+
+    def mark(self, name):
+        setattr(self, name, preferred_clock())
+
+    @staticmethod
+    def _span(begin, end):
+        if begin is None or end is None:
+            return None
+        return end - begin
+
+    @property
+    def reused(self) -> bool:
+        return self.connect_end is None
+
+    @property
+    def dns(self):
+        return self._span(self.dns_start, self.dns_end)
+
+    @property
+    def connect(self):
+        return self._span(self.dns_end, self.connect_end)
+
+    @property
+    def tls(self):
+        return self._span(self.connect_end, self.tls_end)
+
+    @property
+    def send(self):
+        return self._span(self.tls_end or self.connect_end or self.start, self.sent)
+
+    @property
+    def ttfb(self):
+        return self._span(self.sent, self.first_byte)
+
+    @property
+    def download(self):
+        return self._span(self.first_byte, self.end)
+
+    @property
+    def total(self):
+        return self._span(self.start, self.end or self.first_byte)
+
+    def as_dict(self) -> dict:
+        return {
+            "dns": self.dns, "connect": self.connect, "tls": self.tls, "send": self.send,
+            "ttfb": self.ttfb, "download": self.download, "total": self.total, "reused": self.reused,
+        }
+
+    def __repr__(self):
+        return "RequestTiming({})".format(", ".join(
+            "{}={}".format(k, v if v is None or isinstance(v, bool) else "{:.3f}ms".format(v * 1000))
+            for k, v in self.as_dict().items()))
+
+
+def current_timing():
+    return getattr(_STATE, "timing", None)
+
+
+@contextmanager
+def measure():
+    """
+    在当前线程中测量一次请求，请求在同一个线程中同步执行，连接对象通过线程局部变量写入各个阶段的时间
+    :return:
+    """
+    timing = RequestTiming()
+    _STATE.timing = timing
+    try:
+        yield timing
+    finally:
+        _STATE.timing = None
+
+
+class TimedHTTPConnection(HTTPConnection):
+    """
+    没有正在测量的请求时与HTTPConnection行为一致
+    测量时先单独解析域名，再使用解析出的第一个地址建立连接
+    """
+
+    def _new_conn(self):
+        timing = current_timing()
+        if timing is None:
+            return super()._new_conn()
+        host = self._dns_host
+        timing.mark("dns_start")
+        try:
+            address = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)[0][4][0]
+        except (socket.gaierror, IndexError):
+            # 交给urllib3抛出NameResolutionError
+            address = host
+        timing.mark("dns_end")
+        self._dns_host = address
+        try:
+            sock = super()._new_conn()
+        finally:
+            self._dns_host = host
+        timing.mark("connect_end")
+        return sock
+
+    def request(self, method, url, body=None, headers=None, *, chunked=False, **kwargs):
+        """
+        请求体提供sendfile方法并且已经确定Content-Length时(FileBody，MultipartEncoder)
+        先发送请求头，再由请求体直接写入socket，普通连接上文件内容不经过用户态
+        """
+        if _REQUEST_CHUNKED:
+            kwargs["chunked"] = chunked
+        if (body is None or chunked or not hasattr(body, "sendfile")
+                or not any(k.lower() == "content-length" for k in (headers or ()))):
+            return super().request(method, url, body, headers, **kwargs)
+        super().request(method, url, None, headers, **kwargs)
+        body.sendfile(self.sock)
+
+    def getresponse(self):
+        timing = current_timing()
+        if timing is None:
+            return super().getresponse()
+        timing.mark("sent")
+        response = super().getresponse()
+        timing.mark("first_byte")
+        return response
+
+
+class TimedHTTPSConnection(HTTPSConnection, TimedHTTPConnection):
+
+    def connect(self):
+        super().connect()
+        timing = current_timing()
+        if timing is not None:
+            timing.mark("tls_end")
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+POOL_CLASSES_BY_SCHEME = {
+    "http": TimedHTTPConnectionPool,
+    "https": TimedHTTPSConnectionPool,
+}
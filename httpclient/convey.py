@@ -9,8 +9,6 @@ So(res,should_not_none)
 So(res.text,should_not_none)
 So(res,status_code,should_be_equal,200)
 """
-import logging
-import re
 import unittest
 
 from httpclient.funcions import should_not_none
@@ -169,7 +167,7 @@ class JsonConveyMixin:
         """
 
         if hasattr(self, "js"):
-            self.so(self.js.array(except_item).index(except_index).value, fn, except_value)
+            return self.so(self.js.array(except_item).index(except_index).value, fn, except_value)
         raise ValueError("返回结果不是json或者没有调用except_json方法")
 
     def so_json_items(self, except_item, fn, except_value=None):
@@ -196,27 +194,45 @@ class JsonConveyMixin:
         :return:
         """
         if hasattr(self, "js"):
-            self.so(self.js.items(except_item).value, fn, except_value)
+            return self.so(self.js.items(except_item).value, fn, except_value)
+        raise ValueError("返回结果不是json或者没有调用except_json方法")
+
+    def so_json_path(self, path, fn, except_value=None):
+        """
+        使用路径表达式断言json中的值，路径语法查看JSONPath类
+        例如：
+            {
+                "name": "admin",
+                "list": ["1","2","3"],
+                "dict": {
+                    "age":18,
+                    "phone":"123456789",
+                    "li":[1,2,3,4]
+                    },
+            }
+        so_json_path("dict.li[0]", should_equal, 1)
+        so_json_path("list[*]", should_equal, ["1","2","3"])
+        :param path: 路径表达式
+        :param fn: 断言函数
+        :param except_value: 期待的值
+        :return:
+        """
+        if hasattr(self, "js"):
+            return self.so(self.js.path(path), fn, except_value)
         raise ValueError("返回结果不是json或者没有调用except_json方法")
 
 
 class HttpConveyMixin:
 
-    def regex(self, reg, index=0, trim=False):
+    def regex(self, reg, index=None, trim=False):
         """
         使用正则表达式提取响应结果
-        :param trim:
-        :param reg: 表达式
-        :param index: 获取第index个结果
+        :param trim: 为True时删除响应体中的换行后再匹配，使用Extractor时在创建Extractor时指定
+        :param reg: 表达式或者Extractor
+        :param index: 获取第index个结果，为None时使用Extractor的index，表达式默认为0
         :return:
         """
-        data = self.response.text
-        if trim:
-            data = data.replace("\n", "")
-        try:
-            return re.findall(reg, data)[index]
-        except IndexError:
-            logging.error("{}，内容没有提取到".format(reg))
+        return self.response.regex(reg, index, trim)
 
     def so_body_text(self, fn, except_value):
         """
@@ -318,13 +334,30 @@ class HttpConveyMixin:
         """
         return self.so(getattr(self.response, where), fn, except_value)
 
+    def so_batch(self, responses, spec, max_samples=5):
+        """
+        使用同一个规则批量断言多个响应，所有响应检查完毕后只报告一次失败
+        例如：
+            spec = ResponseSpec().status(should_equal, 200).json_path("data.id", should_not_none)
+            convey.so_batch(responses, spec)
+
+        :param responses: 响应列表
+        :param spec: ResponseSpec
+        :param max_samples: 失败信息中每个规则最多展示的响应数量
+        :return: BatchReport
+        """
+        report = spec.evaluate(responses, self.case)
+        if not report.ok:
+            self.case.fail(report.format(max_samples))
+        return report
+
     @property
     def except_json(self):
         """
         提取响应结果，并转为json形式
         :return:
         """
-        setattr(self, "js", self.response.json)
+        setattr(self, "js", self.response.jsonify)
         return self
 
     def set_response(self, resp):
@@ -338,6 +371,10 @@ class Convey(JsonConveyMixin, HttpConveyMixin):
     def __init__(self, case):
         self.__test = case
 
+    @property
+    def case(self) -> unittest.TestCase:
+        return self.__test
+
     def so(self, except_value, fn, real_value=None):
         """
         def add(a,b):
@@ -0,0 +1,131 @@
+import heapq
+import time
+from http.cookiejar import eff_request_host
+
+from requests.cookies import RequestsCookieJar
+
+_MIN_COMPACT = 64
+
+
+def _domain_keys(host: str):
+    """
+    返回可能匹配host的cookie域名，例如 a.b.com -> a.b.com, .a.b.com, b.com, .b.com, com, .com
+    :param host:
+    :return:
+    """
+    labels = host.split(".")
+    for i in range(len(labels)):
+        suffix = ".".join(labels[i:])
+        yield suffix
+        yield "." + suffix
+
+
+class IndexedCookieJar(RequestsCookieJar):
+    """
+    适合长时间运行的会话的CookieJar，可以直接替换HttpClient.cookies
+
+    RequestsCookieJar生成Cookie请求头时会检查所有域名下的Cookie，并且每次都会遍历整个jar清理过期的Cookie，
+    IndexedCookieJar只查找请求主机的各级父域名，过期时间保存在最小堆中，清理时只处理已经过期的Cookie，
+    匹配规则仍然由CookiePolicy决定，匹配的Cookie与RequestsCookieJar相同，路径长度相同时更具体的域名排在前面
+    """
+
+    def __init__(self, policy=None):
+        super().__init__(policy)
+        self._expiry = []
+        # 堆的长度超过该值时清理旧记录，清理后设置为存活记录数的2倍，均摊后每次set_cookie为O(log n)
+        self._compact_at = _MIN_COMPACT
+
+    def set_cookie(self, cookie, *args, **kwargs):
+        super().set_cookie(cookie, *args, **kwargs)
+        if cookie.expires is not None:
+            with self._cookies_lock:
+                heapq.heappush(self._expiry, (cookie.expires, cookie.domain, cookie.path, cookie.name))
+                if len(self._expiry) > self._compact_at:
+                    self._compact()
+
+    def _compact(self):
+        """
+        删除堆中重新设置或删除的Cookie留下的旧记录，调用者需要持有_cookies_lock
+        :return:
+        """
+        self._expiry = [(c.expires, c.domain, c.path, c.name) for c in self if c.expires is not None]
+        heapq.heapify(self._expiry)
+        self._compact_at = max(_MIN_COMPACT, 2 * len(self._expiry))
+
+    def _cookies_for_request(self, request):
+        host, erhn = eff_request_host(request)
+        cookies = []
+        seen = set()
+        for name in (host, erhn):
+            for domain in _domain_keys(name.lower()):
+                if domain in seen or domain not in self._cookies:
+                    continue
+                seen.add(domain)
+                cookies.extend(self._cookies_for_domain(domain, request))
+        return cookies
+
+    def clear_expired_cookies(self):
+        """
+        清理已经过期的Cookie，只处理过期时间已到的Cookie
+        :return:
+        """
+        with self._cookies_lock:
+            now = time.time()
+            expiry = self._expiry
+            while expiry and expiry[0][0] <= now:
+                expires, domain, path, name = heapq.heappop(expiry)
+                try:
+                    cookie = self._cookies[domain][path][name]
+                except KeyError:
+                    continue
+                # 同名Cookie被重新设置后使用新的过期时间
+                if cookie.expires == expires:
+                    self.clear(domain, path, name)
+            if len(self._expiry) > self._compact_at:
+                self._compact()
+
+    def prune(self):
+        """
+        清理过期的Cookie和空的域名，返回剩余的Cookie数量
+        :return:
+        """
+        self.clear_expired_cookies()
+        with self._cookies_lock:
+            for domain in [d for d, paths in self._cookies.items() if not any(paths.values())]:
+                del self._cookies[domain]
+            if len(self._expiry) > 2 * len(self):
+                self._compact()
+            return len(self)
+
+    def copy(self):
+        new_cj = type(self)()
+        new_cj.set_policy(self.get_policy())
+        new_cj.update(self)
+        return new_cj
+
+
+if __name__ == '__main__':
+    from requests import Request
+    from requests.cookies import create_cookie, get_cookie_header
+
+    def bench(jar, n):
+        for i in range(n):
+            jar.set_cookie(create_cookie("sid", str(i), domain="s{}.example.com".format(i), path="/"))
+        jar.set_cookie(create_cookie("token", "t", domain=".example.com", path="/"))
+        request = Request("GET", "http://s7.example.com/api").prepare()
+        start = time.perf_counter()
+        for _ in range(1000):
+            header = get_cookie_header(jar, request)
+        return header, (time.perf_counter() - start) * 1000
+
+    for n in (100, 1000, 5000):
+        h1, t1 = bench(RequestsCookieJar(), n)
+        h2, t2 = bench(IndexedCookieJar(), n)
+        assert h1 == h2, (h1, h2)
+        print("{:>6} cookies  RequestsCookieJar {:>8.1f}ms  IndexedCookieJar {:>6.1f}ms  ({})".format(n, t1, t2, h2))
+
+    # 反复刷新同一个Cookie，堆中的旧记录会被清理
+    jar = IndexedCookieJar()
+    for i in range(100000):
+        jar.set_cookie(create_cookie("sid", str(i), domain="example.com", path="/", expires=int(time.time()) + 3600 + i))
+    assert len(jar) == 1 and len(jar._expiry) <= _MIN_COMPACT, len(jar._expiry)
@@ -0,0 +1,160 @@
+import functools
+import itertools
+import logging
+import re
+from collections import deque
+
+_MAXCACHE = 512
+
+
+@functools.lru_cache(maxsize=_MAXCACHE)
+def compile_pattern(pattern: str, flags=0):
+    """
+    编译正则表达式，相同的表达式和flags只会编译一次
+    :param pattern:
+    :param flags:
+    :return:
+    """
+    return re.compile(pattern, flags)
+
+
+class Extractor:
+    """
+    正则提取器，表达式只会编译一次，可以在测试类中声明后重复使用
+    例如：
+        class MyTestCase(unittest.TestCase):
+            user = Extractor(".*user=(.+?)&pass=?")
+
+            def test_user(self):
+                res = self.client.do("http://192.168.1.24/login").result
+                self.assertEqual(self.user(res), "admin")
+
+    index为0时只查找第一个匹配结果，不会扫描整个响应体
+    trim为True时先删除文本中的换行再匹配(会复制文本)，只需要`.`匹配换行时使用flags=re.DOTALL，不会复制文本
+    """
+    __slots__ = ("pattern", "index", "trim", "name")
+
+    def __init__(self, pattern, index=0, trim=False, flags=0):
+        self.pattern = compile_pattern(pattern, flags) if isinstance(pattern, str) else pattern
+        self.index = index
+        self.trim = trim
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def findall(self, data: str) -> list:
+        return self.pattern.findall(data)
+
+    def extract(self, data: str, index=None):
+        """
+        从文本中提取第index个结果，结果的形式与re.findall相同
+        :param data:
+        :param index:
+        :return:
+        """
+        index = self.index if index is None else index
+        if self.trim:
+            data = data.replace("\n", "")
+        if index == 0:
+            m = self.pattern.search(data)
+            return self.__found(m)
+        if index > 0:
+            return self.__found(next(itertools.islice(self.pattern.finditer(data), index, None), None))
+        try:
+            return self.pattern.findall(data)[index]
+        except IndexError:
+            return self.__found(None)
+
+    def extract_stream(self, chunks, overlap, index=None):
+        """
+        从文本块中逐块提取第index个结果
+        :param chunks: 文本块
+        :param overlap: 窗口重叠的字符数
+        :param index:
+        :return:
+        """
+        index = self.index if index is None else index
+        if self.trim:
+            chunks = (chunk.replace("\n", "") for chunk in chunks)
+        matches = stream_finditer(self.pattern, chunks, overlap)
+        if index < 0:
+            found = deque(matches, maxlen=-index)
+            return self.__found(found[0] if len(found) == -index else None)
+        return self.__found(next(itertools.islice(matches, index, None), None))
+
+    def __found(self, m):
+        if m is None:
+            logging.error("{}，内容没有提取到".format(self.name or self.pattern.pattern))
+            return None
+        return match_value(self.pattern, m)
+
+    def __call__(self, data, index=None):
+        """
+        data可以是文本或者响应对象，流式模式的响应会逐块提取
+        :param data:
+        :param index:
+        :return:
+        """
+        if isinstance(data, str):
+            return self.extract(data, index)
+        if getattr(data, "streaming", False):
+            return self.extract_stream(data.iter_text(), data.stream_overlap, index)
+        return self.extract(data.text, index)
+
+    def __repr__(self):
+        return "Extractor({!r}, index={}, trim={})".format(self.pattern.pattern, self.index, self.trim)
+
+
+def stream_windows(chunks, overlap):
+    """
+    将文本块转换为相互重叠的窗口，每个窗口保留上一个窗口末尾overlap个字符
+    :param chunks:
+    :param overlap:
+    :return:
+    """
+    tail = ""
+    for chunk in chunks:
+        window = tail + chunk
+        yield window
+        tail = window[-overlap:]
+
+
+def stream_finditer(pattern, chunks, overlap):
+    """
+    在文本块上逐块匹配，结果与在完整文本上执行finditer一致(匹配长度不超过overlap时)
+    起始位置距离窗口末尾不足overlap的匹配会留到下一个窗口中再次匹配，
+    匹配延伸到窗口末尾时(长度超过overlap，可能被截断)抛出ValueError
+    :param pattern: 编译后的正则表达式
+    :param chunks: 文本块
+    :param overlap: 窗口重叠的字符数
+    :return:
+    """
+    buf = ""
+    for chunk in chunks:
+        buf = buf + chunk
+        boundary = len(buf) - overlap
+        pos = 0
+        for m in pattern.finditer(buf):
+            if m.start() >= boundary:
+                break
+            if m.end() >= len(buf):
+                raise ValueError("匹配结果从位置{}延伸到窗口末尾，长度超过了overlap({})".format(m.start(), overlap))
+            yield m
+            pos = m.end()
+        buf = buf[max(pos, boundary, 0):]
+    yield from pattern.finditer(buf)
+
+
+def match_value(pattern, m):
+    """
+    将匹配结果转为与re.findall相同的形式
+    :param pattern:
+    :param m:
+    :return:
+    """
+    if pattern.groups == 0:
+        return m.group(0)
+    if pattern.groups == 1:
+        return m.group(1) or ""
+    return m.groups("")
@@ -1,12 +1,19 @@
+"""
+断言函数，Convey.so(except_value, fn, real_value)调用fn(test, except_value, real_value)
+except_value是被检查的值(例如响应内容)，real_value是用来比较的值，例如：
+    so(res.text, should_contains, "admin")      "admin"在res.text中
+    so(res.text, should_not_contains, "error")  "error"不在res.text中
+    so(res.headers.get("Token"), should_not_none)
+"""
 import unittest
 
 
 def should_none(test: unittest.TestCase, except_value, real_value):
-    return test.assertIsNone(real_value)
+    return test.assertIsNone(except_value)
 
 
 def should_not_none(test: unittest.TestCase, except_value, real_value):
-    return test.assertIsNotNone(real_value)
+    return test.assertIsNotNone(except_value)
 
 
 def should_equal(test: unittest.TestCase, except_value, real_value):
@@ -26,8 +33,25 @@ def should_not_equal(test: unittest.TestCase, except_value, real_value):
 
 
 def should_not_contains(test: unittest.TestCase, except_value, real_value):
-    return test.assertNotIn(except_value, real_value)
+    return test.assertNotIn(real_value, except_value)
 
 
 def should_contains(test: unittest.TestCase, except_value, real_value):
-    return test.assertIn(except_value, real_value)
+    return test.assertIn(real_value, except_value)
+
+
+if __name__ == '__main__':
+    case = unittest.TestCase()
+
+    def fails(fn, except_value, real_value=None):
+        try:
+            fn(case, except_value, real_value)
+        except AssertionError:
+            return True
+        return False
+
+    assert not fails(should_none, None) and fails(should_none, "token")
+    assert not fails(should_not_none, "token") and fails(should_not_none, None)
+    assert not fails(should_contains, "user=admin", "admin") and fails(should_contains, "user=admin", "root")
+    assert not fails(should_not_contains, "user=admin", "root") and fails(should_not_contains, "user=admin", "admin")
+    print("ok")
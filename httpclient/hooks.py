@@ -0,0 +1,170 @@
+import asyncio
+import inspect
+import logging
+import queue
+import threading
+
+# 请求发送前执行的回调函数名称，由before_hooks注册
+BEFORE_REQUEST = "request"
+# 请求完成后可以修改响应的回调函数名称，由response_hooks注册
+RESPONSE = "response"
+# 各个阶段耗时的回调函数名称，由timing_hooks注册
+TIMING = "timing"
+
+
+class BackgroundHook:
+    """
+    在后台线程中执行的回调函数，不会阻塞请求
+    """
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+
+class HookWorker:
+    """
+    执行后台回调函数和异步回调函数，线程在第一次使用时启动
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._loop = None
+        self._loop_thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, hook, data, kwargs):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="hook-worker", daemon=True)
+                    self._thread.start()
+        self._queue.put((hook, data, kwargs))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            hook, data, kwargs = item
+            try:
+                result = hook(data, **kwargs)
+                if inspect.isawaitable(result):
+                    self.run_coroutine(result).result()
+            except Exception as e:
+                logging.error(f"background hook `{getattr(hook, '__name__', hook)}` failed", exc_info=e)
+
+    def run_coroutine(self, coro):
+        """
+        在后台事件循环中执行协程，返回concurrent.futures.Future
+        :param coro:
+        :return:
+        """
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    self._loop_thread = threading.Thread(target=loop.run_forever, name="hook-loop", daemon=True)
+                    self._loop_thread.start()
+                    self._loop = loop
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def close(self, timeout=None):
+        """
+        等待已经提交的后台回调函数执行完毕
+        :param timeout:
+        :return:
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            loop, self._loop = self._loop, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            self._loop_thread.join(timeout)
+            loop.close()
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("async hook failed", exc_info=future.exception())
+
+
+def _as_list(hooks) -> list:
+    if not hooks:
+        return []
+    if hasattr(hooks, "__call__"):
+        return [hooks]
+    return list(hooks)
+
+
+class HookPipeline:
+    """
+    将回调函数编译为有序的执行流程，回调函数改变时才会重新编译
+        before:     请求发送前执行，可以返回新的请求
+        observers:  dispatch_hooks指定的回调函数，不能修改响应
+        response:   response_hooks指定的回调函数，返回值会替换响应
+        deferred:   后台回调函数和timing回调函数，在读取完响应体后执行
+    普通函数直接调用，async函数在后台事件循环中执行，BackgroundHook在后台线程中执行
+    """
+    __slots__ = ("before", "observers", "response", "deferred", "timing", "_worker")
+
+    def __init__(self, hooks: dict, dispatch_names, worker: HookWorker):
+        self._worker = worker
+        observers, deferred = [], []
+        for name in dispatch_names:
+            for hook in _as_list(hooks.get(name)):
+                (deferred if self._offload(hook) else observers).append(hook)
+        self.before = tuple(_as_list(hooks.get(BEFORE_REQUEST)))
+        self.observers = tuple(observers)
+        self.response = tuple(_as_list(hooks.get(RESPONSE)))
+        self.deferred = tuple(deferred)
+        self.timing = tuple(_as_list(hooks.get(TIMING)))
+
+    @staticmethod
+    def _offload(hook) -> bool:
+        return isinstance(hook, BackgroundHook) or inspect.iscoroutinefunction(hook)
+
+    def _await(self, result):
+        if inspect.isawaitable(result):
+            return self._worker.run_coroutine(result).result()
+        return result
+
+    def _fire(self, hook, response, kwargs):
+        if isinstance(hook, BackgroundHook):
+            self._worker.submit(hook, response, kwargs)
+        elif inspect.iscoroutinefunction(hook):
+            self._worker.run_coroutine(hook(response, **kwargs)).add_done_callback(_log_failure)
+        else:
+            hook(response, **kwargs)
+
+    def run_before(self, request, **kwargs):
+        for hook in self.before:
+            result = self._await(hook(request, **kwargs))
+            if result is not None:
+                request = result
+        return request
+
+    def run_observers(self, response, **kwargs):
+        for hook in self.observers:
+            hook(response, **kwargs)
+
+    def run_response(self, response, **kwargs):
+        for hook in self.response:
+            result = self._await(hook(response, **kwargs))
+            if result is not None:
+                response = result
+        return response
+
+    def run_deferred(self, response, **kwargs):
+        for hook in self.deferred:
+            self._fire(hook, response, kwargs)
+        if getattr(response, "timing", None) is not None:
+            for hook in self.timing:
+                self._fire(hook, response, kwargs)
@@ -0,0 +1,366 @@
+import asyncio
+import email.message
+import threading
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.cookies import extract_cookies_to_jar
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from httpclient.connection import current_timing
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+
+_CHUNK_SIZE = 64 * 1024
+
+
+async def _async_body(body):
+    """
+    同步的请求体(FileBody，MultipartEncoder，生成器)在线程池中读取，避免阻塞事件循环
+    """
+    loop = asyncio.get_running_loop()
+    if hasattr(body, "read"):
+        chunks = iter(lambda: body.read(_CHUNK_SIZE), b"")
+    else:
+        chunks = iter(body)
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            break
+        yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+
+class _OriginalResponse:
+    """
+    extract_cookies_to_jar从raw._original_response.msg中读取Set-Cookie，msg需要支持get_all
+    """
+    __slots__ = ("msg",)
+
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class _RawStream:
+    """
+    把事件循环中的httpx.Response包装成requests.Response.raw需要的同步接口
+    """
+    __slots__ = ("response", "loop", "_chunks", "_buffer", "_original_response")
+
+    def __init__(self, response, loop):
+        self.response = response
+        self.loop = loop
+        self._chunks = None
+        self._buffer = b""
+        message = email.message.Message()
+        for cookie in response.headers.get_list("set-cookie"):
+            message["Set-Cookie"] = cookie
+        # HttpClient.send和重定向通过extract_cookies_to_jar(jar, request, response.raw)保存会话Cookie
+        self._original_response = _OriginalResponse(message)
+
+    @property
+    def reason(self):
+        return self.response.reason_phrase
+
+    @property
+    def headers(self):
+        return self.response.headers
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def _next_chunk(self):
+        if self._chunks is False:
+            return b""
+        if self._chunks is None:
+            if self.response.is_stream_consumed:
+                # 非流式请求已经在事件循环中读取了响应体
+                self._chunks = False
+                return self.response.content
+            self._chunks = self.response.aiter_bytes(_CHUNK_SIZE)
+        try:
+            return self._call(self._chunks.__anext__())
+        except StopAsyncIteration:
+            self.close()
+            return b""
+
+    def stream(self, chunk_size=None, decode_content=True):
+        try:
+            while True:
+                chunk = self.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def read(self, amt=None, decode_content=None):
+        """
+        :param amt: 最多读取的字节数，None表示读取全部
+        :param decode_content: 与urllib3的接口保持一致，httpx已经解码了响应体，忽略该参数
+        :return:
+        """
+        if amt is None:
+            chunks = [self._buffer]
+            chunk = self._next_chunk()
+            while chunk:
+                chunks.append(chunk)
+                chunk = self._next_chunk()
+            self._buffer = b""
+            return b"".join(chunks)
+        if not self._buffer:
+            self._buffer = self._next_chunk()
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def tell(self):
+        return self.response.num_bytes_downloaded
+
+    def close(self):
+        if not self.response.is_closed and not self.loop.is_closed():
+            self._call(self.response.aclose())
+
+    def release_conn(self):
+        self.close()
+
+
+def _timeout(timeout):
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+    return httpx.Timeout(timeout)
+
+
+class H2Adapter(BaseAdapter):
+    """
+    基于httpx的HTTP/2传输层，需要安装 httpx[http2]
+    https连接通过ALPN协商h2，服务器不支持时回退到HTTP/1.1
+    请求在H2Adapter自己的事件循环线程中执行，同一个主机的并发请求在一个连接上多路复用，
+    多个线程的HttpClient可以共用同一个H2Adapter
+
+    adapter = H2Adapter()
+    client = HttpClient().use_http2(adapter)
+    res = client.do("https://192.168.1.24/api").result
+    print(res.http_version)
+
+    verify，cert和代理在创建时指定，请求时传入的对应参数会被忽略
+    """
+
+    def __init__(self, http1=True, max_connections=10, verify=True, cert=None,
+                 response_cls=requests.Response, **client_kwargs):
+        """
+        :param http1: 是否允许回退到HTTP/1.1，为False时http://连接使用h2c(prior knowledge)
+        :param max_connections: 每个连接池的最大连接数
+        :param verify: 是否校验证书或者CA证书路径
+        :param cert: 客户端证书
+        :param response_cls: 响应对象的类型
+        :param client_kwargs: 传递给httpx.AsyncClient的其他参数
+        """
+        if httpx is None:
+            raise ImportError("HTTP/2 transport requires httpx, install it with `pip install httpx[http2]`")
+        super().__init__()
+        self.response_cls = response_cls
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="h2-transport", daemon=True)
+        self._thread.start()
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+
+        async def create():
+            return httpx.AsyncClient(http1=http1, http2=True, verify=verify, cert=cert, follow_redirects=False,
+                                     limits=limits, **client_kwargs)
+
+        self.client = self._call(create())
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _send(self, request, timeout, stream):
+        body = request.body
+        if body is not None and not isinstance(body, (bytes, str)):
+            body = _async_body(body)
+        outgoing = self.client.build_request(
+            request.method, request.url, headers=list(request.headers.items()), content=body,
+            timeout=_timeout(timeout))
+        response = await self.client.send(outgoing, stream=True)
+        if not stream:
+            await response.aread()
+        return response
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        timing = current_timing()
+        if timing is not None:
+            timing.mark("sent")
+        try:
+            resp = self._call(self._send(request, timeout, stream))
+        except httpx.ConnectTimeout as e:
+            raise requests.ConnectTimeout(e, request=request)
+        except httpx.TimeoutException as e:
+            raise requests.ReadTimeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.ConnectionError(e, request=request)
+        if timing is not None:
+            timing.mark("first_byte")
+        return self.build_response(request, resp)
+
+    def build_response(self, req, resp):
+        response = self.response_cls()
+        response.status_code = resp.status_code
+        response.headers = CaseInsensitiveDict(resp.headers.multi_items())
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = _RawStream(resp, self.loop)
+        response.reason = resp.reason_phrase
+        response.url = req.url.decode("utf-8") if isinstance(req.url, bytes) else req.url
+        response.http_version = resp.http_version
+
+        extract_cookies_to_jar(response.cookies, req, response.raw)
+
+        response.request = req
+        response.connection = self
+        return response
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self._call(self.client.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class _H2Protocol(asyncio.Protocol):
+    """
+    h2c测试服务器，每个请求延迟delay秒后返回固定的JSON
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.transport.write(self.conn.data_to_send())
+            self.transport.close()
+            return
+        for event in events:
+            if isinstance(event, h2.events.DataReceived):
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                asyncio.get_running_loop().call_later(self.delay, self.respond, event.stream_id)
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.transport.close()
+        self.transport.write(self.conn.data_to_send())
+
+    def respond(self, stream_id):
+        body = b'{"code": 0}'
+        try:
+            self.conn.send_headers(stream_id, [
+                (":status", "200"), ("content-type", "application/json"), ("content-length", str(len(body))),
+                ("set-cookie", "sid={}; Path=/".format(stream_id)),
+            ])
+            self.conn.send_data(stream_id, body, end_stream=True)
+        except h2.exceptions.StreamClosedError:
+            return
+        self.transport.write(self.conn.data_to_send())
+
+
+def serve_h2c(host="127.0.0.1", port=0, delay=0.01):
+    """
+    在后台线程中启动h2c测试服务器，需要安装h2
+    :param host:
+    :param port: 0表示随机端口
+    :param delay: 每个请求的处理时间
+    :return: (port, 关闭服务器的函数)
+    """
+    if h2 is None:
+        raise ImportError("h2c test server requires h2, install it with `pip install h2`")
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(loop.create_server(lambda: _H2Protocol(delay), host, port))
+    threading.Thread(target=loop.run_forever, name="h2c-server", daemon=True).start()
+
+    def shutdown():
+        loop.call_soon_threadsafe(server.close)
+        loop.call_soon_threadsafe(loop.stop)
+
+    return server.sockets[0].getsockname()[1], shutdown
+
+
+if __name__ == '__main__':
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    from httpclient.HttpClient import HttpClient, UpgradeResponse
+
+    DELAY = 0.05
+    CONCURRENCY = 50
+    TOTAL = 2000
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            time.sleep(DELAY)
+            body = b'{"code": 0}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    h1_server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=h1_server.serve_forever, daemon=True).start()
+    h2_port, h2_shutdown = serve_h2c(delay=DELAY)
+
+    def bench(name, url, factory):
+        local = threading.local()
+
+        def one(_):
+            client = getattr(local, "client", None)
+            if client is None:
+                client = local.client = factory()
+            return client.do(url).result
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(CONCURRENCY) as pool:
+            responses = list(pool.map(one, range(TOTAL)))
+        cost = time.perf_counter() - start
+        assert all(r.status_code == 200 for r in responses)
+        print("{:<16} {:>8.0f} req/s  {}".format(name, TOTAL / cost, getattr(responses[-1], "http_version", "")))
+
+    # HTTP/1.1: 每个线程一个HttpClient，每个连接同一时间只能处理一个请求
+    bench("h1 pooled", "http://127.0.0.1:{}/".format(h1_server.server_address[1]), HttpClient)
+    # HTTP/2: 所有线程共用一个H2Adapter，请求在一个连接上多路复用
+    shared = H2Adapter(http1=False, max_connections=1, response_cls=UpgradeResponse)
+    # HTTP/2响应中的Set-Cookie保存到会话中，后续请求会带上Cookie
+    client = HttpClient().use_http2(shared, prefixes=("http://",))
+    res = client.do("http://127.0.0.1:{}/".format(h2_port)).result
+    assert res.cookies.get("sid") and client.cookies.get("sid") == res.cookies.get("sid"), client.cookies
+    bench("h2 multiplexed", "http://127.0.0.1:{}/".format(h2_port),
+          lambda: HttpClient().use_http2(shared, prefixes=("http://",)))
+    shared.close()
+    h2_shutdown()
+    h1_server.shutdown()
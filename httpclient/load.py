@@ -0,0 +1,359 @@
+import itertools
+import logging
+import random
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.sessions import preferred_clock
+
+from httpclient.HttpClient import HttpClient
+from httpclient.convey import Convey
+
+
+class LatencyHistogram:
+    """
+    HDR风格的延迟直方图
+    以微秒记录，值按照2的幂分段，每段分为2^(precision-1)个桶，相对误差不超过1/2^(precision-1)
+    内存只与值的数量级有关，与记录的次数无关
+    """
+
+    def __init__(self, precision=7):
+        self._precision = precision
+        self._counts = {}
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value: int) -> int:
+        shift = value.bit_length() - self._precision
+        if shift <= 0:
+            return value
+        return (value >> shift) << shift
+
+    def _width(self, bucket: int) -> int:
+        shift = bucket.bit_length() - self._precision
+        return 1 << shift if shift > 0 else 1
+
+    def record(self, seconds: float):
+        value = max(0, int(seconds * 1000000))
+        bucket = self._bucket(value)
+        with self._lock:
+            self._counts[bucket] = self._counts.get(bucket, 0) + 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, p: float) -> float:
+        """
+        返回第p百分位的延迟，单位秒
+        :param p: 0-100
+        :return:
+        """
+        with self._lock:
+            if not self.count:
+                return 0.0
+            buckets = sorted(self._counts.items())
+            rank = max(1, int(round(p / 100 * self.count)))
+            upper = self.max
+        seen = 0
+        for bucket, count in buckets:
+            seen += count
+            if seen >= rank:
+                return min(bucket + self._width(bucket) - 1, upper) / 1000000
+        return upper / 1000000
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count / 1000000 if self.count else 0.0
+
+
+class EndpointStats:
+    """
+    单个接口的压测结果，固定并发数时延迟使用HttpClient.send中测量的elapsed，
+    固定速率时延迟从计划发送的时间开始计算，包括在队列中等待的时间，避免协调遗漏(coordinated omission)
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.histogram = LatencyHistogram()
+        self.status = {}
+        self.requests = 0
+        self.errors = 0
+        self.error_samples = []
+        self._lock = threading.Lock()
+
+    def record(self, response=None, error=None, latency=None):
+        """
+        :param response:
+        :param error:
+        :param latency: 延迟(秒)，为None时使用response.elapsed
+        :return:
+        """
+        if latency is not None:
+            self.histogram.record(latency)
+        elif response is not None:
+            self.histogram.record(response.elapsed.total_seconds())
+        with self._lock:
+            self.requests += 1
+            if response is not None:
+                self.status[response.status_code] = self.status.get(response.status_code, 0) + 1
+            if error is not None:
+                self.errors += 1
+                if len(self.error_samples) < 10:
+                    self.error_samples.append(repr(error))
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.requests if self.requests else 0.0
+
+
+class LoadReport:
+
+    def __init__(self, stats: dict, duration: float, dropped=0):
+        self.stats = stats
+        self.duration = duration
+        self.dropped = dropped
+
+    @property
+    def requests(self) -> int:
+        return sum(s.requests for s in self.stats.values())
+
+    @property
+    def errors(self) -> int:
+        return sum(s.errors for s in self.stats.values())
+
+    @property
+    def throughput(self) -> float:
+        return self.requests / self.duration if self.duration else 0.0
+
+    def __getitem__(self, name) -> EndpointStats:
+        return self.stats[name]
+
+    def __str__(self):
+        lines = ["{:<20}{:>10}{:>10}{:>10}{:>12}{:>12}{:>12}{:>12}".format(
+            "endpoint", "requests", "errors", "rps", "p50(ms)", "p95(ms)", "p99(ms)", "max(ms)")]
+        for s in self.stats.values():
+            h = s.histogram
+            lines.append("{:<20}{:>10}{:>10}{:>10.1f}{:>12.2f}{:>12.2f}{:>12.2f}{:>12.2f}".format(
+                s.name, s.requests, s.errors, s.requests / self.duration if self.duration else 0,
+                h.percentile(50) * 1000, h.percentile(95) * 1000, h.percentile(99) * 1000,
+                (h.max or 0) / 1000))
+        lines.append("total: {} requests, {} errors ({:.2%}), {:.1f} req/s in {:.1f}s, dropped {}".format(
+            self.requests, self.errors, self.errors / self.requests if self.requests else 0,
+            self.throughput, self.duration, self.dropped))
+        return "\n".join(lines)
+
+
+class _LoadCase(unittest.TestCase):
+    """
+    为Convey提供断言函数，断言失败时抛出AssertionError并记为错误
+    """
+
+    def runTest(self):
+        pass
+
+
+class LoadRunner:
+    """
+    使用HttpClient的链式请求和Convey断言进行压测
+
+    runner = LoadRunner(duration=30, concurrency=16)
+    runner.add("index", lambda c: c.do("http://192.168.1.24/"),
+               check=lambda ex: ex.so_status_code(should_equal, 200))
+    runner.add("login", lambda c: c.do("http://192.168.1.24/login").with_post_json({"user": "admin"}), weight=2)
+    print(runner.run())
+
+    指定rps时以固定速率发送请求，concurrency为最大并发数；不指定rps时以固定并发数循环发送请求
+    每个线程使用独立的HttpClient，run结束时关闭，每次调用build前会重置请求(GET，没有请求头和请求体)
+    """
+
+    def __init__(self, duration=10.0, concurrency=8, rps=None, client_factory=HttpClient):
+        if concurrency < 1:
+            raise ValueError("`concurrency` must grate than 0")
+        self.duration = duration
+        self.concurrency = concurrency
+        self.rps = rps
+        self._client_factory = client_factory
+        self._endpoints = []
+        self._cum_weights = []
+        self._local = threading.local()
+        self._clients = []
+        self._clients_lock = threading.Lock()
+
+    def add(self, name, build, check=None, weight=1):
+        """
+        添加压测接口
+        :param name: 接口名称
+        :param build: 接收HttpClient，返回构建好请求的HttpClient
+        :param check: 接收Convey，进行响应断言
+        :param weight: 权重
+        :return:
+        """
+        self._endpoints.append((EndpointStats(name), build, check, weight))
+        self._cum_weights.append(self._cum_weights[-1] + weight if self._cum_weights else weight)
+        return self
+
+    def _client(self):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._client_factory()
+            self._local.client = client
+            self._local.case = _LoadCase()
+            with self._clients_lock:
+                self._clients.append(client)
+        return client
+
+    def _close_clients(self):
+        with self._clients_lock:
+            clients, self._clients = self._clients, []
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                logging.exception("close load client failed")
+        self._local = threading.local()
+
+    def _choose(self):
+        if len(self._endpoints) == 1:
+            return self._endpoints[0]
+        return random.choices(self._endpoints, cum_weights=self._cum_weights)[0]
+
+    def _fire(self, scheduled=None):
+        """
+        :param scheduled: 固定速率时计划发送的时间，延迟从该时间开始计算
+        :return:
+        """
+        stats, build, check, _ = self._choose()
+        response = None
+        try:
+            client = self._client()
+            # 同一个线程的HttpClient在各个接口间复用，清除上一个接口设置的请求方法，请求头和请求体
+            client.req.reset()
+            response = build(client).result
+            if check is not None:
+                check(Convey(self._local.case).set_response(response))
+        except Exception as e:
+            stats.record(response, e, self._latency(scheduled, response))
+        else:
+            stats.record(response, latency=self._latency(scheduled, response))
+
+    @staticmethod
+    def _latency(scheduled, response):
+        if scheduled is None or response is None:
+            return None
+        return preferred_clock() - scheduled
+
+    def _closed_loop(self, deadline):
+        while preferred_clock() < deadline:
+            self._fire()
+
+    def _open_loop(self, start, deadline, pool):
+        interval = 1.0 / self.rps
+        outstanding = threading.BoundedSemaphore(self.concurrency * 4)
+        dropped = 0
+
+        def task(at):
+            try:
+                self._fire(at)
+            finally:
+                outstanding.release()
+
+        for i in itertools.count():
+            at = start + i * interval
+            if at >= deadline:
+                break
+            delay = at - preferred_clock()
+            if delay > 0:
+                threading.Event().wait(delay)
+            if not outstanding.acquire(blocking=False):
+                dropped += 1
+                continue
+            pool.submit(task, at)
+        return dropped
+
+    def run(self) -> LoadReport:
+        if not self._endpoints:
+            raise ValueError("no endpoint to run, use `add` method")
+        dropped = 0
+        start = preferred_clock()
+        deadline = start + self.duration
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="load") as pool:
+                if self.rps:
+                    dropped = self._open_loop(start, deadline, pool)
+                else:
+                    for _ in range(self.concurrency):
+                        pool.submit(self._closed_loop, deadline)
+        finally:
+            self._close_clients()
+        elapsed = preferred_clock() - start
+        if dropped:
+            logging.warning(f"{dropped} requests dropped, target is too slow for {self.rps} rps")
+        return LoadReport({e[0].name: e[0] for e in self._endpoints}, elapsed, dropped)
+
+
+if __name__ == '__main__':
+    import http.server
+
+    from httpclient.funcions import should_equal
+
+
+    class StubHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            if self.headers.get("Content-Length") or self.headers.get("Content-Type"):
+                self.send_response(400)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.respond()
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path != "/login":
+                self.send_response(405)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.respond()
+
+        def respond(self):
+            body = b"ok"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/".format(server.server_address[1])
+
+    runner = LoadRunner(duration=5, concurrency=4)
+    runner.add("stub", lambda c: c.do(url), check=lambda ex: ex.so_status_code(should_equal, 200))
+    print(runner.run())
+
+    # GET和POST接口混合，GET请求不能带有上一个POST请求的请求体
+    runner = LoadRunner(duration=2, concurrency=2)
+    runner.add("index", lambda c: c.do(url), check=lambda ex: ex.so_status_code(should_equal, 200))
+    runner.add("login", lambda c: c.do(url + "login").with_post_json({"user": "admin"}),
+               check=lambda ex: ex.so_status_code(should_equal, 200))
+    report = runner.run()
+    print(report)
+    assert report.errors == 0 and report["index"].requests and report["login"].requests, report.errors
+
+    runner = LoadRunner(duration=5, concurrency=4, rps=200)
+    runner.add("stub", lambda c: c.do(url))
+    print(runner.run())
+    server.shutdown()
@@ -0,0 +1,286 @@
+import io
+import mimetypes
+import os
+import uuid
+
+from httpclient.strcutures import WithContext
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _fileno(stream):
+    try:
+        return stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+@WithContext
+class FileBody:
+    """
+    文件请求体，按块读取文件，不会一次性读入内存
+    使用路径创建时第一次读取才打开文件，读取完毕或发送完毕后立即关闭，重试时会重新打开
+    使用文件对象创建时从当前位置开始发送，文件由调用者负责关闭
+    普通HTTP连接上会使用sendfile直接由内核发送文件内容
+    """
+
+    def __init__(self, source, filename=None, content_type=None, chunk_size=CHUNK_SIZE):
+        """
+        :param source: 文件路径或者支持fileno的二进制文件对象
+        :param filename: multipart中使用的文件名，默认使用文件路径中的文件名
+        :param content_type: multipart中使用的文件类型，默认根据文件名推断
+        :param chunk_size: 每次读取的字节数
+        """
+        if isinstance(source, (str, bytes, os.PathLike)):
+            self.path = os.fspath(source)
+            self._file = None
+            self._owned = True
+            self.start = 0
+            self.size = os.path.getsize(self.path)
+        else:
+            fd = _fileno(source)
+            if fd is None:
+                raise ValueError("`source` must be a file path or a file object with fileno")
+            self.path = getattr(source, "name", None)
+            self._file = source
+            self._owned = False
+            self.start = source.tell()
+            self.size = max(0, os.fstat(fd).st_size - self.start)
+        if filename is None and isinstance(self.path, (str, bytes)):
+            filename = os.path.basename(os.fsdecode(self.path))
+        self.filename = filename
+        self.content_type = content_type or mimetypes.guess_type(filename or "")[0] or "application/octet-stream"
+        self.chunk_size = chunk_size
+        self._pos = 0
+
+    @classmethod
+    def wrap(cls, stream):
+        """
+        文件对象转换为FileBody，其他流原样返回
+        :param stream:
+        :return:
+        """
+        if isinstance(stream, cls) or _fileno(stream) is None:
+            return stream
+        try:
+            return cls(stream)
+        except OSError:
+            # 管道等无法获取位置的流
+            return stream
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        return self._file
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b"")
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = min(max(0, offset), self.size)
+        return self._pos
+
+    def read(self, size=-1):
+        remaining = self.size - self._pos
+        if remaining <= 0:
+            self.close()
+            return b""
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        f = self._open()
+        f.seek(self.start + self._pos)
+        data = f.read(size)
+        self._pos += len(data)
+        if not data or self._pos >= self.size:
+            self.close()
+        return data
+
+    def sendfile(self, sock):
+        """
+        把剩余内容写入socket，支持时使用os.sendfile
+        :param sock:
+        :return: 发送的字节数
+        """
+        remaining = self.size - self._pos
+        if remaining > 0:
+            sent = sock.sendfile(self._open(), self.start + self._pos, remaining)
+            self._pos += sent
+        else:
+            sent = 0
+        self.close()
+        return sent
+
+    def close(self):
+        if self._owned and self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _BytesPart:
+    __slots__ = ("data", "_pos")
+
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self._pos = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def seek(self, offset):
+        self._pos = offset
+
+    def read(self, size):
+        data = self.data[self._pos:self._pos + size].tobytes()
+        self._pos += len(data)
+        return data
+
+    def sendfile(self, sock):
+        data = self.data[self._pos:]
+        sock.sendall(data)
+        self._pos = len(self.data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+@WithContext
+class MultipartEncoder:
+    """
+    流式multipart/form-data编码器
+    创建时只生成各个部分的头部并计算总长度，文件内容在发送时按块读取，内存占用与文件大小无关
+    例如：
+        with MultipartEncoder({"name": "demo", "file": ("a.bin", "/tmp/a.bin")}) as body:
+            client.do("http://127.0.0.1/upload").with_multipart(body).result
+    """
+
+    def __init__(self, fields, boundary=None, encoding="utf-8", chunk_size=CHUNK_SIZE):
+        """
+        :param fields: 字典或者(name, value)列表，value可以是
+            字符串或字节：普通字段
+            FileBody：文件字段
+            (filename, source) 或 (filename, source, content_type)：source为文件路径、文件对象或字节
+        :param boundary: 分隔符，默认随机生成
+        :param encoding: 字段名和字段值的编码
+        :param chunk_size: 迭代时每次读取的字节数
+        """
+        self.boundary = boundary or uuid.uuid4().hex
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.content_type = "multipart/form-data; boundary={}".format(self.boundary)
+        self._parts = []
+        try:
+            self._build(fields.items() if hasattr(fields, "items") else fields)
+        except Exception:
+            self.close()
+            raise
+        self.size = sum(len(p) for p in self._parts)
+        self._index = 0
+        self._offset = 0
+
+    def _encode(self, value):
+        return value.encode(self.encoding) if isinstance(value, str) else value
+
+    def _header(self, name, filename=None, content_type=None) -> bytes:
+        disposition = 'form-data; name="{}"'.format(name)
+        if filename is not None:
+            disposition += '; filename="{}"'.format(filename)
+        lines = ["--" + self.boundary, "Content-Disposition: " + disposition]
+        if content_type:
+            lines.append("Content-Type: " + content_type)
+        return ("\r\n".join(lines) + "\r\n\r\n").encode(self.encoding)
+
+    def _add(self, data):
+        if isinstance(data, bytes):
+            # 合并相邻的字节片段，减少读取和发送的次数
+            if self._parts and isinstance(self._parts[-1], _BytesPart):
+                data = self._parts.pop().data.tobytes() + data
+            data = _BytesPart(data)
+        self._parts.append(data)
+
+    def _build(self, fields):
+        for name, value in fields:
+            if isinstance(value, tuple):
+                filename, source, *rest = value
+                content_type = rest[0] if rest else None
+                if isinstance(source, (bytes, bytearray)):
+                    content_type = content_type or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                    self._add(self._header(name, filename, content_type) + bytes(source))
+                    self._add(b"\r\n")
+                    continue
+                value = FileBody(source, filename, content_type, self.chunk_size)
+            if isinstance(value, FileBody):
+                self._add(self._header(name, value.filename, value.content_type))
+                self._add(value)
+            else:
+                self._add(self._header(name) + self._encode(value if isinstance(value, (str, bytes)) else str(value)))
+            self._add(b"\r\n")
+        self._add("--{}--\r\n".format(self.boundary).encode(self.encoding))
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b"")
+
+    def tell(self):
+        return sum(len(p) for p in self._parts[:self._index]) + self._offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.tell()
+        elif whence == io.SEEK_END:
+            offset += self.size
+        offset = min(max(0, offset), self.size)
+        self._index, self._offset = len(self._parts), 0
+        position = 0
+        for i, part in enumerate(self._parts):
+            if position + len(part) > offset and self._index == len(self._parts):
+                self._index, self._offset = i, offset - position
+                part.seek(self._offset)
+            else:
+                part.seek(0)
+            position += len(part)
+        return offset
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size
+        chunks = []
+        while size > 0 and self._index < len(self._parts):
+            data = self._parts[self._index].read(size)
+            if data:
+                chunks.append(data)
+                size -= len(data)
+                self._offset += len(data)
+            if not data or self._offset >= len(self._parts[self._index]):
+                self._index += 1
+                self._offset = 0
+        return b"".join(chunks)
+
+    def sendfile(self, sock):
+        """
+        依次发送剩余的各个部分，文件部分使用sendfile
+        :param sock:
+        :return: 发送的字节数
+        """
+        sent = 0
+        while self._index < len(self._parts):
+            sent += self._parts[self._index].sendfile(sock)
+            self._index += 1
+            self._offset = 0
+        return sent
+
+    def close(self):
+        for part in self._parts:
+            part.close()
@@ -0,0 +1,247 @@
+import email.message
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import zlib
+from datetime import timedelta
+from enum import Enum
+
+from requests.cookies import extract_cookies_to_jar
+from requests.structures import CaseInsensitiveDict
+
+from httpclient.strcutures import WithContext
+
+_ENV_MODE = "HTTPCLIENT_RECORD_MODE"
+_STORE_VERSION = 1
+
+
+class RecordMode(Enum):
+    # 直接请求网络，不记录也不回放
+    NONE = "none"
+    # 请求网络并记录响应，会覆盖已有的记录
+    RECORD = "record"
+    # 只回放已有的记录，不会请求网络
+    REPLAY = "replay"
+    # 有记录时回放，没有记录时请求网络并追加记录
+    AUTO = "auto"
+
+    @classmethod
+    def from_env(cls, default=None):
+        """
+        从环境变量HTTPCLIENT_RECORD_MODE读取模式，方便在CI中切换重新录制
+        :param default:
+        :return:
+        """
+        value = os.environ.get(_ENV_MODE)
+        if not value:
+            return default or cls.REPLAY
+        return cls(value.lower())
+
+
+class RecordNotFound(Exception):
+    pass
+
+
+def _set_cookies(response) -> list:
+    """
+    返回响应中的所有Set-Cookie，response.headers中多个Set-Cookie已经合并为一个，优先从原始响应中读取
+    :param response:
+    :return:
+    """
+    original = getattr(response.raw, "_original_response", None)
+    if original is not None:
+        return original.msg.get_all("Set-Cookie") or []
+    value = response.headers.get("Set-Cookie")
+    return [value] if value else []
+
+
+class _ReplayRaw:
+    """
+    回放响应的raw，只提供extract_cookies_to_jar需要的_original_response.msg，
+    HttpClient.send会通过它把记录的Cookie保存到会话中
+    """
+    __slots__ = ("msg",)
+
+    def __init__(self, cookies):
+        self.msg = email.message.Message()
+        for cookie in cookies:
+            self.msg["Set-Cookie"] = cookie
+
+    @property
+    def _original_response(self):
+        return self
+
+
+class ResponseSnapshot:
+    """
+    响应的紧凑表示，只保存回放需要的字段
+    """
+    __slots__ = ("status_code", "reason", "headers", "url", "content", "encoding", "elapsed", "cookies")
+
+    def __init__(self, status_code, reason, headers, url, content, encoding, elapsed, cookies=()):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.url = url
+        self.content = content
+        self.encoding = encoding
+        self.elapsed = elapsed
+        # 原始的Set-Cookie列表
+        self.cookies = list(cookies)
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(response.status_code, response.reason, list(response.headers.items()), response.url,
+                   response.content, response.encoding, response.elapsed.total_seconds(), _set_cookies(response))
+
+    def to_response(self, request, response_cls):
+        response = response_cls()
+        response.status_code = self.status_code
+        response.reason = self.reason
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.url = self.url
+        response.encoding = self.encoding
+        response._content = self.content
+        response._content_consumed = True
+        response.elapsed = timedelta(seconds=self.elapsed)
+        response.request = request
+        response.raw = _ReplayRaw(self.cookies)
+        extract_cookies_to_jar(response.cookies, request, response.raw)
+        return response
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+        if len(state) < len(self.__slots__):
+            # 旧的记录中没有cookies，使用合并后的Set-Cookie
+            value = CaseInsensitiveDict(self.headers).get("Set-Cookie")
+            self.cookies = [value] if value else []
+
+
+@WithContext
+class Recorder:
+    """
+    HttpClient的录制/回放层
+
+    client = HttpClient()
+    client.use_recorder(Recorder("api.rec", RecordMode.from_env()))
+
+    请求使用 method, url, match_headers指定的请求头和请求体的哈希值作为键，
+    同一个键记录多次时按照记录的顺序回放，回放完毕后重复最后一个响应
+    所有记录都保存在内存中，调用save或者关闭HttpClient时写入文件
+    """
+
+    def __init__(self, path, mode=RecordMode.REPLAY, match_headers=("Accept", "Content-Type")):
+        self.path = path
+        self.mode = mode
+        self.match_headers = tuple(match_headers)
+        self._records = {}
+        self._cursor = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        if mode is not RecordMode.RECORD:
+            self.load()
+
+    def should_replay(self, request) -> bool:
+        if self.mode is RecordMode.REPLAY:
+            return True
+        return self.mode is RecordMode.AUTO and self.has(request)
+
+    @property
+    def recording(self) -> bool:
+        return self.mode in (RecordMode.RECORD, RecordMode.AUTO)
+
+    def key(self, request) -> str:
+        digest = hashlib.sha1()
+        digest.update(request.method.encode())
+        digest.update(b"\n")
+        digest.update(request.url.encode())
+        for name in self.match_headers:
+            digest.update(b"\n")
+            digest.update("{}:{}".format(name.lower(), request.headers.get(name, "")).encode())
+        digest.update(b"\n")
+        digest.update(self.body_hash(request.body).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def body_hash(body) -> str:
+        if body is None:
+            return ""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if isinstance(body, (bytes, bytearray)):
+            return hashlib.sha1(body).hexdigest()
+        # 流式请求体读取后无法恢复，只能使用类型作为键
+        return "stream:{}".format(type(body).__name__)
+
+    def has(self, request) -> bool:
+        return self.key(request) in self._records
+
+    def replay(self, request, response_cls):
+        """
+        回放记录的响应，没有记录时抛出RecordNotFound
+        :param request:
+        :param response_cls: 响应对象的类型
+        :return:
+        """
+        key = self.key(request)
+        with self._lock:
+            snapshots = self._records.get(key)
+            if not snapshots:
+                raise RecordNotFound("no record for `{} {}`".format(request.method, request.url))
+            cursor = self._cursor.get(key, 0)
+            self._cursor[key] = cursor + 1
+        return snapshots[min(cursor, len(snapshots) - 1)].to_response(request, response_cls)
+
+    def record(self, request, response):
+        """
+        记录响应，会读取整个响应体
+        :param request:
+        :param response:
+        :return:
+        """
+        snapshot = ResponseSnapshot.from_response(response)
+        with self._lock:
+            self._records.setdefault(self.key(request), []).append(snapshot)
+            self._dirty = True
+        return response
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return self
+        with open(self.path, "rb") as f:
+            version, records = pickle.loads(zlib.decompress(f.read()))
+        if version != _STORE_VERSION:
+            logging.warning(f"record file `{self.path}` version {version} not supported, ignore it")
+            return self
+        with self._lock:
+            self._records = records
+            self._cursor.clear()
+        return self
+
+    def save(self):
+        """
+        将记录写入文件，先写入临时文件再替换，避免中断时损坏记录
+        :return:
+        """
+        with self._lock:
+            if not self._dirty:
+                return self
+            data = zlib.compress(pickle.dumps((_STORE_VERSION, self._records), pickle.HIGHEST_PROTOCOL))
+            self._dirty = False
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+        return self
+
+    def close(self):
+        self.save()
+
+    def __len__(self):
+        return sum(len(snapshots) for snapshots in self._records.values())
@@ -0,0 +1,213 @@
+import random
+import threading
+import time
+from enum import Enum
+from urllib.parse import urlsplit
+
+import requests
+
+from httpclient.caching import parse_http_date
+
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"))
+RETRY_STATUS = frozenset((429, 500, 502, 503, 504))
+
+
+class RetryPolicy:
+    """
+    请求重试策略，只重试幂等的请求方法
+
+    client = HttpClient()
+    client.use_retry(RetryPolicy(total=3, backoff_factor=0.5))
+
+    第n次重试前等待 backoff_factor * 2^(n-1) 秒(不超过max_backoff)，启用jitter时在0到该值之间随机，
+    响应中包含Retry-After时优先使用Retry-After
+    """
+
+    def __init__(self, total=3, status=RETRY_STATUS, methods=IDEMPOTENT_METHODS, backoff_factor=0.5,
+                 max_backoff=30.0, jitter=True, respect_retry_after=True,
+                 errors=(requests.ConnectionError, requests.Timeout)):
+        """
+        :param total: 最多重试的次数
+        :param status: 需要重试的状态码
+        :param methods: 允许重试的请求方法
+        :param backoff_factor: 退避系数
+        :param max_backoff: 最长等待时间
+        :param jitter: 是否随机等待时间
+        :param respect_retry_after: 是否使用Retry-After
+        :param errors: 需要重试的异常
+        """
+        self.total = total
+        self.status = frozenset(status)
+        self.methods = frozenset(m.upper() for m in methods)
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.respect_retry_after = respect_retry_after
+        self.errors = tuple(errors)
+
+    def can_retry(self, request, attempt: int) -> bool:
+        return attempt <= self.total and request.method.upper() in self.methods
+
+    def retry_status(self, response) -> bool:
+        return response.status_code in self.status
+
+    def retry_after(self, response):
+        value = response.headers.get("Retry-After") if response is not None else None
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        date = parse_http_date(value)
+        return max(0.0, date - time.time()) if date is not None else None
+
+    def backoff(self, attempt: int, response=None) -> float:
+        """
+        计算第attempt次请求失败后需要等待的时间
+        :param attempt: 从1开始
+        :param response: 失败的响应，连接错误时为None
+        :return:
+        """
+        if self.respect_retry_after:
+            delay = self.retry_after(response)
+            if delay is not None:
+                return min(delay, self.max_backoff)
+        delay = min(self.max_backoff, self.backoff_factor * (2 ** (attempt - 1)))
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class CircuitState(Enum):
+    # 正常请求
+    CLOSED = "CLOSED"
+    # 连续失败次数过多，直接拒绝请求
+    OPEN = "OPEN"
+    # 等待reset_timeout后允许一个请求探测服务是否恢复
+    HALF_OPEN = "HALF_OPEN"
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+class _Circuit:
+    __slots__ = ("state", "failures", "opened_at", "probing")
+
+    def __init__(self):
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+
+class CircuitBreaker:
+    """
+    按主机熔断，同一个主机连续失败failure_threshold次后，reset_timeout秒内的请求直接抛出CircuitOpenError
+
+    client = HttpClient()
+    client.use_circuit_breaker(CircuitBreaker(failure_threshold=5, reset_timeout=30))
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, failure_status=(500, 502, 503, 504)):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_status = frozenset(failure_status)
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def host(request) -> str:
+        return urlsplit(request.url).netloc
+
+    def state(self, host) -> CircuitState:
+        circuit = self._circuits.get(host)
+        return circuit.state if circuit else CircuitState.CLOSED
+
+    def before(self, request):
+        """
+        请求发送前检查熔断状态
+        :param request:
+        :return:
+        """
+        host = self.host(request)
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is None or circuit.state is CircuitState.CLOSED:
+                return
+            if circuit.state is CircuitState.OPEN:
+                if time.monotonic() - circuit.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"circuit for `{host}` is open", request=request)
+                circuit.state = CircuitState.HALF_OPEN
+                circuit.probing = False
+            if circuit.probing:
+                raise CircuitOpenError(f"circuit for `{host}` is half open and probing", request=request)
+            circuit.probing = True
+
+    def failed(self, response) -> bool:
+        return response.status_code in self.failure_status
+
+    def record(self, request, success: bool):
+        host = self.host(request)
+        with self._lock:
+            circuit = self._circuits.setdefault(host, _Circuit())
+            circuit.probing = False
+            if success:
+                circuit.state = CircuitState.CLOSED
+                circuit.failures = 0
+                return
+            circuit.failures += 1
+            if circuit.state is CircuitState.HALF_OPEN or circuit.failures >= self.failure_threshold:
+                circuit.state = CircuitState.OPEN
+                circuit.opened_at = time.monotonic()
+
+
+if __name__ == '__main__':
+    import http.server
+
+    from httpclient.HttpClient import HttpClient
+
+
+    class UnavailableHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        bodies = []
+
+        def do_PUT(self):
+            if self.headers.get("Transfer-Encoding") == "chunked":
+                body = b""
+                while True:
+                    size = int(self.rfile.readline(), 16)
+                    body += self.rfile.read(size + 2)[:size]
+                    if not size:
+                        break
+            else:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.bodies.append(body)
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), UnavailableHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/".format(server.server_address[1])
+    client = HttpClient()
+    client.use_retry(RetryPolicy(total=2, backoff_factor=0.01))
+
+    # bytes请求体可以重发
+    r = client.do(url).with_method("PUT").with_data(b"payload").result
+    assert r.status_code == 503 and r.attempts == 3, r.attempts
+    assert UnavailableHandler.bodies == [b"payload"] * 3, UnavailableHandler.bodies
+
+    # 生成器请求体发送后已经耗尽，不会重试
+    UnavailableHandler.bodies.clear()
+    r = client.do(url).with_method("PUT").with_data(iter([b"pay", b"load"])).result
+    assert r.status_code == 503 and r.attempts == 1, r.attempts
+    assert UnavailableHandler.bodies == [b"payload"], UnavailableHandler.bodies
+    print("ok")
+    client.close()
+    server.shutdown()
@@ -1,28 +1,113 @@
+import codecs
+import functools
+import itertools
 import json
 import logging
 import pickle
 import re
 
 import chardet
-import faker
 from urllib3.exceptions import InvalidHeader
 
+from httpclient.extract import Extractor, stream_windows
+from httpclient.useragent import Rotation, default_pool
+
 _COOKIE_PARSER = re.compile(r"([\w\-\d]+)\((.*)\)")
 _CLEAN_HEADER_REGEX_BYTE = re.compile(b'^\\S[^\\r\\n]*$|^$')
 _CLEAN_HEADER_REGEX_STR = re.compile(r'^\S[^\r\n]*$|^$')
 _HOST_EXTRACT = h = re.compile(r'https?://(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}[:\d]{1,6}|[\w\d.\-]?[\w\d.\-]+)/?')
 _DECODE_PARSER = re.compile(r"([\w\d\-]+)=([\w\d\-@.+]*)")
+_PATH_TOKEN = re.compile(r"\.?(?P<key>[^.\[\]'\"]+)|\[(?P<index>-?\d+|\*)\]|\[(?P<quoted>'[^']*'|\"[^\"]*\")\]")
+_MAXCACHE = 512
+_MISSING = object()
+_WILDCARD = object()
+
+
+class JSONPath:
+    """
+    编译后的JSON路径表达式，语法与JSONPath类似
+        $.name          -> admin
+        list[0]         -> 1
+        dict.li[-1]     -> 4
+        dict['age']     -> 18
+        list[*]         -> ["1","2","3"]
+    使用compile_path获取路径对象，相同的表达式只会编译一次
+    """
+    __slots__ = ("expression", "_steps", "_multi")
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self._steps = self.__compile(expression)
+        self._multi = any(step is _WILDCARD for step in self._steps)
+
+    @staticmethod
+    def __compile(expression: str) -> tuple:
+        expr = expression.strip()
+        if expr.startswith("$"):
+            expr = expr[1:]
+        steps = []
+        pos = 0
+        while pos < len(expr):
+            match = _PATH_TOKEN.match(expr, pos)
+            if not match or match.end() == pos:
+                raise SyntaxError("JSON路径语法错误: `{}` 位置 {}".format(expression, pos))
+            key, index, quoted = match.group("key"), match.group("index"), match.group("quoted")
+            if key is not None:
+                steps.append(_WILDCARD if key == "*" else key)
+            elif index is not None:
+                steps.append(_WILDCARD if index == "*" else int(index))
+            else:
+                steps.append(quoted[1:-1])
+            pos = match.end()
+        return tuple(steps)
+
+    def find(self, data, default=_MISSING):
+        """
+        在data中查找路径对应的值，路径中包含[*]时返回列表
+        :param data: 已经解析的json对象
+        :param default: 路径不存在时返回的默认值，不指定时抛出KeyError
+        :return:
+        """
+        nodes = [data]
+        for step in self._steps:
+            matched = []
+            for node in nodes:
+                if step is _WILDCARD:
+                    if isinstance(node, dict):
+                        matched.extend(node.values())
+                    elif isinstance(node, list):
+                        matched.extend(node)
+                    continue
+                try:
+                    matched.append(node[step])
+                except (KeyError, IndexError, TypeError):
+                    if not self._multi:
+                        if default is _MISSING:
+                            raise KeyError("`{}` 中没有找到 `{}`".format(self.expression, step))
+                        return default
+            nodes = matched
+        return nodes if self._multi else nodes[0]
+
+    def __repr__(self):
+        return "JSONPath({!r})".format(self.expression)
+
+
+@functools.lru_cache(maxsize=_MAXCACHE)
+def compile_path(expression: str) -> JSONPath:
+    return JSONPath(expression)
 
 
 class JSON:
     __slots__ = [
         "__d",
+        "__raw",
         "__current"
     ]
 
-    def __init__(self, t):
+    def __init__(self, t=_MISSING, raw=None, current=_MISSING):
         self.__d = t
-        self.__current = None
+        self.__raw = raw
+        self.__current = current
 
     """
     {
@@ -38,65 +123,103 @@ class JSON:
     JSON(xxx).Array("list").Index(0).Value() -> 1
     JSON(xxx).Items("dict").Item("age").Value() -> 18
     JSON(xxx).Items("dict").Array("li").Index(0) -> 1
+    JSON(xxx).path("dict.li[0]") -> 1
+
+    item/array/items/index 每一步都返回新的JSON对象，不会修改原对象，可以重复断言
     """
 
+    @classmethod
+    def loads(cls, raw):
+        """
+        延迟解析，第一次取值时才会解析json，之后的取值都复用同一个解析结果
+        :param raw: bytes或str
+        :return:
+        """
+        return cls(raw=raw)
+
+    @property
+    def document(self):
+        if self.__d is _MISSING:
+            try:
+                self.__d = json.loads(self.__raw) if self.__raw else {}
+            except json.JSONDecodeError:
+                raise ValueError("返回内容不是json")
+            self.__raw = None
+        return self.__d
+
+    def __node(self):
+        return self.document if self.__current is _MISSING else self.__current
+
+    def __walk(self, key):
+        return JSON(self.document, current=self.__node()[key])
+
     def item(self, data):
-        if self.__current:
-            self.__current = self.__current[data]
-        else:
-            self.__current = self.__d[data]
-        return self
+        return self.__walk(data)
 
     def restart(self):
-        self.__current = None
-        return self
+        return JSON(self.document)
 
     def array(self, key):
-        if self.__current:
-            self.__current = self.__current[key]
-        else:
-            self.__current = self.__d[key]
-        return self
+        return self.__walk(key)
 
     def index(self, index):
-        if isinstance(self.__current, list):
-            self.__current = self.__current[index]
-            return self
-        raise TypeError("except list but given {} ".format(self.__current.__class__))
+        node = self.__node()
+        if isinstance(node, list):
+            return JSON(self.document, current=node[index])
+        raise TypeError("except list but given {} ".format(node.__class__))
 
     @property
     def value(self):
-        data = self.__current
-
-        if self.__current:
-            self.restart()
-            return data
-        return self.__d
+        return self.__node()
 
     def items(self, key):
-        if self.__current:
-            self.__current = self.__current[key]
-        else:
-            self.__current = self.__d[key]
-        return self
+        return self.__walk(key)
+
+    def path(self, expression: str, default=_MISSING):
+        """
+        使用路径表达式取值，例如 path("dict.li[0]")
+        :param expression: 路径表达式，具体查看JSONPath类
+        :param default: 路径不存在时返回的默认值
+        :return:
+        """
+        return compile_path(expression).find(self.__node(), default)
 
     @staticmethod
     def Except(case, except_value, fn, real_value):
         return fn(case, except_value, real_value)
 
     def __str__(self):
-        return "{}".format(self.__d)
+        return "{}".format(self.__node())
 
 
 class RandomUserAgentMixin(object):
     __slots__ = ()
 
+    def user_agent(self) -> str:
+        """
+        从User-Agent池中取出一个User-Agent，STICKY模式下同一个对象始终返回同一个
+        :return:
+        """
+        pool = getattr(self, "ua_pool", None) or default_pool()
+        if pool.rotation is Rotation.STICKY:
+            ua = getattr(self, "sticky_ua", None)
+            if ua is None:
+                ua = pool.next()
+                setattr(self, "sticky_ua", ua)
+            return ua
+        return pool.next()
+
     def random(self):
-        f = faker.Faker()
-        yield f.user_agent()
+        yield self.user_agent()
 
-    def enable_random_ua(self):
+    def enable_random_ua(self, pool=None):
+        """
+        :param pool: UserAgentPool实例，不指定时使用默认的User-Agent池
+        :return:
+        """
         setattr(self, "ua", True)
+        setattr(self, "ua_pool", pool)
+        setattr(self, "sticky_ua", None)
         return self
 
     def close_random_ua(self):
@@ -104,17 +227,19 @@ class RandomUserAgentMixin(object):
             delattr(self, "ua")
         return self
 
+    disable_random_ua = close_random_ua
+
 
 class RequestMixin(object):
     __slots__ = ()
 
     def ready(self, method=None, url=None, headers=None, files=None, data=None,
               params=None, auth=None, cookies=None, hooks=None, json=None):
-        if hasattr(self, "random") and hasattr(self, "ua") and self.ua:
+        if hasattr(self, "user_agent") and hasattr(self, "ua") and self.ua:
             if headers:
-                headers.update({"User-Agent": next(self.random())})
+                headers.update({"User-Agent": self.user_agent()})
             else:
-                headers = {"User-Agent": next(self.random())}
+                headers = {"User-Agent": self.user_agent()}
         self.prepare_method(method)
         self.prepare_url(url, params)
         self.prepare_headers(headers)
@@ -169,6 +294,39 @@ class RequestMixin(object):
 class ResponseMixin:
     __slots__ = ()
 
+    # 流式模式下每次从连接读取的字节数
+    stream_chunk_size = 64 * 1024
+    # 流式模式下相邻窗口重叠的字符数，单个匹配结果的长度不能超过该值
+    stream_overlap = 4 * 1024
+
+    @property
+    def streaming(self) -> bool:
+        """
+        响应体是否还没有被读取，只有使用流式模式发送请求时才会为True
+        :return:
+        """
+        return getattr(self, "_content", None) is False and not getattr(self, "_content_consumed", True)
+
+    def iter_text(self):
+        """
+        逐块解码响应体，没有指定编码时使用第一个块检测编码
+        :return:
+        """
+        chunks = self.iter_content(self.stream_chunk_size)
+        encoding = self.encoding
+        if not encoding:
+            first = next(chunks, b"")
+            encoding = chardet.detect(first)["encoding"] or "utf-8"
+            chunks = itertools.chain((first,), chunks)
+        decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        for chunk in chunks:
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
     def get_type(self):
         """
         获取响应内容的类型
@@ -187,28 +345,48 @@ class ResponseMixin:
         """
         return chardet.detect(self.content)["encoding"]
 
-    def regex(self, pattern: str, index=0, trim=False):
+    def regex(self, pattern, index=None, trim=False):
         """
         使用正则表达式提取响应体中的内容
-        :param trim:
-        :param pattern:
-        :param index:
+        流式模式下会逐块匹配，不会将整个响应体读入内存，响应体只能被读取一次
+        :param trim: 为True时删除响应体中的换行后再匹配，使用Extractor时在创建Extractor时指定
+        :param pattern: 正则表达式或者Extractor
+        :param index: 获取第index个结果，为None时使用Extractor的index，表达式默认为0
         :return:
         """
-        data = self.text
-        if trim:
-            data = data.replace("\n", "")
-        try:
-            return re.findall(pattern, data)[index]
-        except IndexError:
-            logging.error("{}，内容没有提取到".format(pattern))
+        if isinstance(pattern, Extractor):
+            if trim:
+                raise ValueError("`trim` can not be used with an Extractor, pass it to Extractor instead")
+            return pattern(self, index)
+        return Extractor(pattern, 0 if index is None else index, trim)(self)
 
     def extract(self, fn):
         """
         执行响应体提取函数
+        流式模式下会对每个窗口执行提取函数，返回第一个不为空的结果，
+        IndexError表示当前窗口中没有结果，只有最后一个窗口的IndexError会抛出，其他异常与非流式模式相同直接抛出，
+        结果延伸到窗口末尾时可能被截断，抛出ValueError
         :param fn:
         :return:
         """
+        if self.streaming:
+            windows = stream_windows(self.iter_text(), self.stream_overlap)
+            window = next(windows, None)
+            while window is not None:
+                following = next(windows, None)
+                try:
+                    result = fn(window)
+                except IndexError:
+                    if following is None:
+                        raise
+                    result = None
+                if result:
+                    if following is not None and isinstance(result, str) and window.endswith(result):
+                        raise ValueError("提取结果延伸到窗口末尾，长度可能超过了stream_overlap({})".format(
+                            self.stream_overlap))
+                    return result
+                window = following
+            return None
         return fn(self.text)
 
     @property
@@ -216,16 +394,14 @@ class ResponseMixin:
         """
         将响应结果转为Json对象
         该JSON对象可以提取内容，具体查看JSON类
+        同一个响应只会解析一次
         :return:
         """
-        if self.content:
-            if self.get_type() == "application/json":
-                return JSON(json.loads(self.content, encoding=self.charset))
-            try:
-                return JSON(json.loads(self.content, encoding=self.charset))
-            except json.JSONDecodeError:
-                raise ValueError("返回内容不是json")
-        return JSON({})
+        js = getattr(self, "_jsonify", None)
+        if js is None:
+            js = JSON.loads(self.content)
+            setattr(self, "_jsonify", js)
+        return js
 
     def get_host(self):
         """
@@ -245,20 +421,28 @@ class ResponseMixin:
     def dump_text_context(self):
         """
         将文本响应结果保存为文件形式
-        文件名为主机名
+        文件名为主机名，流式模式下逐块写入
         :return:
         """
         with open(self.get_host(), "w") as f:
-            f.write(self.text)
+            if self.streaming:
+                for chunk in self.iter_text():
+                    f.write(chunk)
+            else:
+                f.write(self.text)
 
     def dump_binary_context(self):
         """
         将二进制响应结果保存为文件形式
-        文件名为主机名
+        文件名为主机名，流式模式下逐块写入
         :return:
         """
         with open(self.get_host(), "wb") as f:
-            f.write(self.content)
+            if self.streaming:
+                for chunk in self.iter_content(self.stream_chunk_size):
+                    f.write(chunk)
+            else:
+                f.write(self.content)
 
 
 def check_header_validity(header):
@@ -287,14 +471,13 @@ def text2dict(data):
 
 
 def WithContext(cls):
-    __enter__ = cls.__enter__
-    __exit__ = cls.__exit__
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        logging.error("Excetions:\ntype:{0}\n\tvalue:{1}\n\ttrack back:{2}\n".format(exc_type, exc_val, exc_tb))
+        if exc_type:
+            logging.error("Excetions:\ntype:{0}\n\tvalue:{1}\n\ttrack back:{2}\n".format(exc_type, exc_val, exc_tb))
         if hasattr(self, "close"):
             self.close()
 
@@ -304,5 +487,25 @@ def WithContext(cls):
     return cls
 
 
+def WithAsyncContext(cls):
+    """
+    与WithContext相同，用于close为协程的类，支持async with
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            logging.error("Excetions:\ntype:{0}\n\tvalue:{1}\n\ttrack back:{2}\n".format(exc_type, exc_val, exc_tb))
+        if hasattr(self, "close"):
+            await self.close()
+
+    cls.__aenter__ = __aenter__
+    cls.__aexit__ = __aexit__
+
+    return cls
+
+
 class NoEnableCacheRequest(Exception):
     pass
@@ -0,0 +1,110 @@
+import itertools
+import random
+import threading
+from enum import Enum
+
+import faker
+
+
+class Rotation(Enum):
+    # 每次随机选择
+    RANDOM = "random"
+    # 按照权重随机选择
+    WEIGHTED = "weighted"
+    # 按顺序轮流使用
+    ROUND_ROBIN = "round_robin"
+    # 同一个会话(HttpClient)始终使用同一个
+    STICKY = "sticky"
+
+
+class UserAgentPool:
+    """
+    User-Agent池，User-Agent只会生成或者加载一次，之后每次取值只是一次列表访问
+
+    pool = UserAgentPool(size=500, rotation=Rotation.ROUND_ROBIN)
+    pool = UserAgentPool.from_file("ua.txt", rotation=Rotation.WEIGHTED)
+
+    client = HttpClient()
+    client.enable_random_ua(pool)
+    """
+
+    def __init__(self, agents=None, size=200, rotation=Rotation.RANDOM, weights=None, seed=None):
+        """
+        :param agents: User-Agent列表，不指定时使用faker生成size个
+        :param size: 生成的数量
+        :param rotation: 轮换方式
+        :param weights: 与agents一一对应的权重，只在WEIGHTED模式使用
+        :param seed: 随机数种子
+        """
+        self.rotation = rotation
+        self._random = random.Random(seed)
+        if agents is None:
+            f = faker.Faker()
+            f.seed_instance(seed)
+            agents = [f.user_agent() for _ in range(size)]
+        self._agents = list(agents)
+        if not self._agents:
+            raise ValueError("User-Agent pool is empty")
+        if weights is not None and len(weights) != len(self._agents):
+            raise ValueError("`weights` must have the same length as `agents`")
+        self._cum_weights = list(itertools.accumulate(weights)) if weights else None
+        self._cycle = itertools.cycle(self._agents)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, filename, rotation=Rotation.RANDOM, seed=None, encoding="utf-8"):
+        """
+        从文件加载User-Agent，每行一个，空行和#开头的行会被忽略
+        行首可以指定权重，使用tab分割，例如：
+            5\tMozilla/5.0 (Windows NT 10.0; Win64; x64) ...
+        :param filename:
+        :param rotation:
+        :param seed:
+        :param encoding:
+        :return:
+        """
+        agents, weights = [], []
+        with open(filename, encoding=encoding) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                weight, sep, agent = line.partition("\t")
+                if sep and weight.replace(".", "", 1).isdigit():
+                    agents.append(agent.strip())
+                    weights.append(float(weight))
+                else:
+                    agents.append(line)
+                    weights.append(1.0)
+        return cls(agents, rotation=rotation, weights=weights, seed=seed)
+
+    def next(self) -> str:
+        if self.rotation is Rotation.ROUND_ROBIN:
+            with self._lock:
+                return next(self._cycle)
+        if self.rotation is Rotation.WEIGHTED and self._cum_weights:
+            return self._random.choices(self._agents, cum_weights=self._cum_weights)[0]
+        return self._random.choice(self._agents)
+
+    def __len__(self):
+        return len(self._agents)
+
+    def __iter__(self):
+        return iter(self._agents)
+
+
+_DEFAULT_POOL = None
+_DEFAULT_POOL_LOCK = threading.Lock()
+
+
+def default_pool() -> UserAgentPool:
+    """
+    进程内共享的默认User-Agent池，第一次使用时生成
+    :return:
+    """
+    global _DEFAULT_POOL
+    if _DEFAULT_POOL is None:
+        with _DEFAULT_POOL_LOCK:
+            if _DEFAULT_POOL is None:
+                _DEFAULT_POOL = UserAgentPool()
+    return _DEFAULT_POOL
@@ -0,0 +1,432 @@
+"""
+
+async def main():
+    async with await AsyncTcpStream.connect("127.0.0.1", 9000) as stream:
+        await stream.write_all(b"ping")
+        print(await stream.read(4))
+
+asyncio.run(main())
+"""
+import asyncio
+import logging
+import socket
+import ssl
+import time
+from ssl import SSLContext
+
+from httpclient.strcutures import WithAsyncContext
+from net.ssl_tcp import TlsStream, TLSTcpServer
+from net.tcp import TcpStream, TcpListener, SocketProfile, SockLevel, SockOpt
+
+
+@WithAsyncContext
+class AsyncTcpStream:
+    """
+    TcpStream的异步版本，基于asyncio的StreamReader/StreamWriter
+    读取方法与TcpStream相同，连接在读取完毕前关闭时抛出EOFError(asyncio.IncompleteReadError)，
+    asyncio的传输层不支持MsgFlag，读写不接受flags参数
+    """
+    buffer_size = TcpStream.buffer_size
+    profile: SocketProfile = TcpStream.profile
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, addr=None):
+        self.reader = reader
+        self.writer = writer
+        self._addr = addr if addr is not None else writer.get_extra_info("peername")
+        # 收发的字节数(TLS连接为明文)
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    @classmethod
+    async def _open(cls, ip, port, timeout, profile, **kwargs):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(ip, port, limit=cls.buffer_size, **kwargs), timeout)
+        profile = profile or cls.profile
+        if profile is not None:
+            profile.apply(writer.get_extra_info("socket"))
+        return cls(reader, writer, ip)
+
+    @classmethod
+    async def connect(cls, ip, port, timeout=None, profile: SocketProfile = None):
+        """
+        :param ip:
+        :param port:
+        :param timeout: 连接超时时间，None表示一直等待
+        :param profile: socket选项，默认使用cls.profile
+        :return:
+        """
+        return await cls._open(ip, port, timeout, profile)
+
+    @property
+    def addr(self):
+        return self._addr
+
+    @property
+    def closed(self) -> bool:
+        return self.writer.is_closing()
+
+    def fileno(self) -> int:
+        sock = self.writer.get_extra_info("socket")
+        return sock.fileno() if sock is not None else -1
+
+    def at_eof(self) -> bool:
+        """
+        对端已经关闭并且缓冲区中的数据已经读取完毕
+        :return:
+        """
+        return self.reader.at_eof()
+
+    async def read(self, buff_len) -> bytes:
+        """
+        读取最多buff_len个字节，连接关闭时返回b""
+        :param buff_len:
+        :return:
+        """
+        data = await self.reader.read(buff_len)
+        self.bytes_received += len(data)
+        return data
+
+    async def readexactly(self, length) -> bytes:
+        data = await self.reader.readexactly(length)
+        self.bytes_received += length
+        return data
+
+    async def readexactly_into(self, buffer) -> int:
+        """
+        读取len(buffer)个字节到buffer中
+        :param buffer: bytearray，memoryview等可写的缓冲区
+        :return: 读取的字节数
+        """
+        view = memoryview(buffer).cast("B")
+        view[:] = await self.readexactly(len(view))
+        return len(view)
+
+    async def readuntil(self, delimiter=b"\n", limit=None) -> bytes:
+        """
+        读取到delimiter为止，返回的数据包括delimiter
+        StreamReader的缓冲区最多为buffer_size，超过时先把已经查找过的数据取出到单独的缓冲区中再继续读取，
+        因此limit可以大于buffer_size，内存占用最多为limit + buffer_size
+        :param delimiter: 分隔符
+        :param limit: 最多读取的字节数(不包括分隔符)，默认为缓冲区大小，超过时抛出ValueError
+        :return:
+        """
+        limit = limit or self.buffer_size
+        parts = bytearray()
+        while True:
+            try:
+                data = await self.reader.readuntil(delimiter)
+                break
+            except asyncio.LimitOverrunError as e:
+                # e.consumed之前的数据不包含完整的分隔符
+                chunk = await self.reader.readexactly(e.consumed)
+            self.bytes_received += len(chunk)
+            parts += chunk
+            if len(parts) > limit:
+                raise ValueError("delimiter {!r} not found in {} bytes".format(delimiter, limit))
+        self.bytes_received += len(data)
+        if parts:
+            parts += data
+            data = bytes(parts)
+        if len(data) - len(delimiter) > limit:
+            raise ValueError("delimiter {!r} not found in {} bytes".format(delimiter, limit))
+        return data
+
+    async def write_all(self, data):
+        """
+        写入数据，等待发送缓冲区低于高水位
+        :param data:
+        :return:
+        """
+        self.writer.write(data)
+        self.bytes_sent += len(data)
+        await self.writer.drain()
+
+    async def writev(self, buffers) -> int:
+        """
+        写入多个缓冲区，传输层支持时使用sendmsg一起发送
+        :param buffers: bytes，bytearray，memoryview列表
+        :return: 写入的字节数
+        """
+        total = sum(memoryview(b).nbytes for b in buffers)
+        self.writer.writelines(buffers)
+        self.bytes_sent += total
+        await self.writer.drain()
+        return total
+
+    async def close(self):
+        if self.writer.is_closing():
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+
+class AsyncTlsStream(AsyncTcpStream):
+    """
+    TlsStream的异步版本
+    asyncio的连接不支持传入SSLSession，每次连接都会完整握手
+    """
+    default_ssl_conf = TlsStream.default_ssl_conf
+    profile = TlsStream.profile
+
+    @classmethod
+    async def connect(cls, ip, port, timeout=None, context: SSLContext = None, server_hostname=None,
+                      profile: SocketProfile = None):
+        """
+        :param ip:
+        :param port:
+        :param timeout: 连接和握手的超时时间
+        :param context: 默认使用default_ssl_conf
+        :param server_hostname: 用于SNI和证书校验的主机名，默认为ip
+        :param profile: socket选项，默认使用cls.profile
+        :return:
+        """
+        return await cls._open(ip, port, timeout, profile, ssl=context or cls.default_ssl_conf,
+                               server_hostname=server_hostname or ip)
+
+    @property
+    def ssl_object(self) -> ssl.SSLObject:
+        return self.writer.get_extra_info("ssl_object")
+
+    @property
+    def alpn_protocol(self):
+        return self.ssl_object.selected_alpn_protocol()
+
+    @property
+    def session(self):
+        return self.ssl_object.session
+
+    @property
+    def session_reused(self) -> bool:
+        return self.ssl_object.session_reused
+
+
+@WithAsyncContext
+class AsyncTcpListener:
+    """
+    TcpListener的异步版本，在创建时绑定端口，serve_forever在当前事件循环中处理所有连接
+    handle为协程，与TcpListener.serve_forever相同，每次处理一个请求后返回，连接继续保持，
+    返回False或者关闭stream时关闭连接，对端关闭连接后不再调用，handle中必须读取数据，否则会被反复调用
+    """
+    profile: SocketProfile = TcpListener.profile
+    stream_cls = AsyncTcpStream
+
+    def __init__(self, addr: str, ip: int, backlog=socket.SOMAXCONN, profile: SocketProfile = None):
+        """
+        :param addr: 监听的地址
+        :param ip: 监听的端口，0表示随机端口
+        :param backlog: 等待accept的连接队列长度
+        :param profile: 接受的连接使用的socket选项，默认使用cls.profile
+        """
+        if profile is not None:
+            self.profile = profile
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(SockLevel.SOL_SOCKET.value, SockOpt.SO_REUSEADDR.value, int(True))
+        self._sock.bind((addr, ip))
+        self._sock.listen(backlog)
+        self._sock.setblocking(False)
+        self._server = None
+        self._closing = False
+        self._streams = set()
+        self._started = time.monotonic()
+        # 当前保持的连接数和累计接受的连接数
+        self.connections = 0
+        self.accepted = 0
+        # 已经关闭的连接收发的字节数
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    @property
+    def local_addr(self):
+        return self._sock.getsockname()
+
+    def _server_kwargs(self) -> dict:
+        return {}
+
+    async def start(self, handle):
+        """
+        开始接受连接，不等待服务器停止
+        :param handle: 处理函数，参数为AsyncTcpStream的协程函数
+        :return:
+        """
+        self._started = time.monotonic()
+        self._server = await asyncio.start_server(
+            lambda reader, writer: self._serve(handle, reader, writer), sock=self._sock,
+            limit=self.stream_cls.buffer_size, **self._server_kwargs())
+
+    async def serve_forever(self, handle):
+        """
+        处理连接直到调用close
+        :param handle: 处理函数，参数为AsyncTcpStream的协程函数
+        :return:
+        """
+        if self._server is None:
+            await self.start(handle)
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            if not self._closing:
+                raise
+
+    async def _serve(self, handle, reader, writer):
+        if self.profile is not None:
+            self.profile.apply(writer.get_extra_info("socket"))
+        stream = self.stream_cls(reader, writer)
+        self.accepted += 1
+        self.connections += 1
+        self._streams.add(stream)
+        self._connected(stream)
+        try:
+            while not stream.at_eof() and not stream.closed:
+                if await handle(stream) is False:
+                    break
+        except EOFError:
+            pass
+        except (ConnectionError, ssl.SSLError) as e:
+            logging.debug("connection from {} lost: {}".format(stream.addr, e))
+        except Exception:
+            logging.exception("handler error, closing connection from {}".format(stream.addr))
+        finally:
+            self.connections -= 1
+            self._streams.discard(stream)
+            self.bytes_received += stream.bytes_received
+            self.bytes_sent += stream.bytes_sent
+            await stream.close()
+
+    def _connected(self, stream):
+        """
+        新连接交给handle之前调用，子类用于统计
+        """
+
+    def metrics(self) -> dict:
+        """
+        服务器统计，速率按开始接受连接后的时间计算
+            throughput: 每秒收发的字节数，包括当前保持的连接
+        :return:
+        """
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        live = list(self._streams)
+        received = self.bytes_received + sum(s.bytes_received for s in live)
+        sent = self.bytes_sent + sum(s.bytes_sent for s in live)
+        return {
+            "accepted": self.accepted,
+            "connections": self.connections,
+            "bytes_received": received,
+            "bytes_sent": sent,
+            "throughput": (received + sent) / elapsed,
+        }
+
+    async def close(self):
+        """
+        停止接受连接并关闭所有连接
+        :return:
+        """
+        self._closing = True
+        if self._server is not None:
+            self._server.close()
+        for stream in list(self._streams):
+            await stream.close()
+        if self._server is not None:
+            await self._server.wait_closed()
+        self._sock.close()
+
+
+class AsyncTLSTcpServer(AsyncTcpListener):
+    """
+    TLSTcpServer的异步版本，握手由asyncio完成，握手失败的连接不会交给handle
+    会话票据和ALPN由context决定，参考get_tls_for_server
+    """
+    profile = TLSTcpServer.profile
+    stream_cls = AsyncTlsStream
+
+    def __init__(self, context: SSLContext, addr="0.0.0.0", ip=0, backlog=socket.SOMAXCONN, handshake_timeout=10.0,
+                 profile: SocketProfile = None):
+        """
+        :param context: 服务端SSLContext
+        :param addr: 监听的地址
+        :param ip: 监听的端口，0表示随机端口
+        :param backlog: 等待accept的连接队列长度
+        :param handshake_timeout: 握手超时时间
+        :param profile: 接受的连接使用的socket选项，默认关闭Nagle算法
+        """
+        super().__init__(addr, ip, backlog, profile)
+        self.context = context
+        self.handshake_timeout = handshake_timeout
+        # 完成的握手数，其中恢复会话的握手数
+        self.handshakes = 0
+        self.resumed = 0
+
+    def _server_kwargs(self) -> dict:
+        return {"ssl": self.context, "ssl_handshake_timeout": self.handshake_timeout}
+
+    def _connected(self, stream: AsyncTlsStream):
+        self.handshakes += 1
+        if stream.session_reused:
+            self.resumed += 1
+
+    def metrics(self) -> dict:
+        """
+        在AsyncTcpListener.metrics的基础上增加
+            handshakes: 完成的握手数
+            resumed: 恢复会话的握手数
+            handshake_rate: 每秒完成的握手数
+        :return:
+        """
+        metrics = super().metrics()
+        metrics.update(handshakes=self.handshakes, resumed=self.resumed,
+                       handshake_rate=self.handshakes / max(time.monotonic() - self._started, 1e-9))
+        return metrics
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+
+    from net.ssl_tcp import get_tls_for_server
+    from tools.certificate import X509Cert, X509Name, X509SubjectAlternativeName, load_config
+
+    CLIENTS = 500
+    ROUNDS = 20
+
+    async def echo(stream: AsyncTcpStream):
+        line = await stream.readuntil(b"\n")
+        await stream.write_all(line)
+
+    async def client(stream_cls, port, **kwargs):
+        async with await stream_cls.connect("127.0.0.1", port, **kwargs) as stream:
+            for i in range(ROUNDS):
+                message = "ping {}\n".format(i).encode()
+                await stream.write_all(message)
+                assert await stream.readuntil(b"\n") == message
+
+    async def bench(name, server, stream_cls, **kwargs):
+        await server.start(echo)
+        port = server.local_addr[1]
+        begin = time.perf_counter()
+        await asyncio.gather(*(client(stream_cls, port, **kwargs) for _ in range(CLIENTS)))
+        cost = time.perf_counter() - begin
+        print("{:<6} {} clients x {} round trips: {:.0f}ms, {:.0f} req/s".format(
+            name, CLIENTS, ROUNDS, cost * 1000, CLIENTS * ROUNDS / cost))
+        print("       {}".format(server.metrics()))
+        await server.close()
+
+    config = load_config()
+    config.set("X509Name", "common_name", "localhost")
+    config.set("AlternativeName", "dns", '["localhost"]')
+    key = X509Cert.generate_private_key(2048)
+    cert = X509Cert.generate_self_signed(key, X509Name(config), X509SubjectAlternativeName(config))
+    directory = tempfile.mkdtemp()
+    cert_file, key_file = os.path.join(directory, "server.pem"), os.path.join(directory, "server.key")
+    X509Cert.save_cert_file(cert_file, cert)
+    X509Cert.save_private_key(key_file, key)
+
+    async def main():
+        profile = SocketProfile(nodelay=True, keepalive=True, keepidle=60)
+        await bench("tcp", AsyncTcpListener("127.0.0.1", 0, profile=profile), AsyncTcpStream, profile=profile)
+        await bench("tls", AsyncTLSTcpServer(get_tls_for_server(cert_file, key_file), "127.0.0.1", 0),
+                    AsyncTlsStream, context=ssl.create_default_context(cafile=cert_file),
+                    server_hostname="localhost")
+
+    asyncio.run(main())
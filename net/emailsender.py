@@ -1,15 +1,29 @@
+import asyncio
+import base64
 import logging
+import mimetypes
+import os
+import queue
+import re
 import smtplib
 import socket
 import ssl
+import threading
+import time
+from concurrent.futures import Future
 from email import message, utils, policy
 from enum import Enum
-from typing import Union, List, Dict, Tuple
+from typing import Union, List, Dict, Tuple, Iterable
 
-from httpclient.strcutures import WithContext
+from httpclient.strcutures import WithContext, WithAsyncContext
+from net.aio import AsyncTcpStream, AsyncTlsStream
 from tools import unimplemented
 
 
+class EmailSendError(Exception):
+    pass
+
+
 class EmailStruct(Enum):
     FROM = "From"
     TO = "To"
@@ -18,12 +32,16 @@ class EmailStruct(Enum):
 
 
 class Email:
+    # base64每行76个字符，对应57个字节，按57的倍数读取附件可以让每块都以完整的行结束
+    _BASE64_LINE = 57
 
     def __init__(self, send_from, email_policy=policy.SMTP):
         self._msg = message.EmailMessage(email_policy)
         self._msg[EmailStruct.FROM.value] = send_from
         self._msg[EmailStruct.DATE.value] = utils.formatdate(localtime=True)
         self._msg[EmailStruct.MSG_ID.value] = utils.make_msgid()
+        # (bytes或文件路径, 文件名, MIME类型)，发送时才读取和编码
+        self._attachments = []
 
     def __getitem__(self, item: EmailStruct):
         return self._msg[item.value]
@@ -44,8 +62,121 @@ class Email:
         self._msg["Subject"] = sub
         return self
 
+    def html(self, html):
+        """
+        HTML正文，已经设置了content时作为multipart/alternative的另一种格式
+        :param html:
+        :return:
+        """
+        if self._msg.get_payload() is None:
+            self._msg.set_content(html, subtype="html")
+        else:
+            self._msg.add_alternative(html, subtype="html")
+        return self
+
+    def attach(self, data: bytes, filename, mimetype=None):
+        """
+        添加附件
+        :param data: 附件内容
+        :param filename: 附件名
+        :param mimetype: 例如"application/zip"，默认根据文件名判断
+        :return:
+        """
+        self._attachments.append((bytes(data), filename, mimetype))
+        return self
+
+    def attach_file(self, path, filename=None, mimetype=None):
+        """
+        添加文件作为附件，发送时才分块读取，不会整个加载到内存中
+        :param path: 文件路径
+        :param filename: 附件名，默认为path的文件名
+        :param mimetype: 例如"application/zip"，默认根据文件名判断
+        :return:
+        """
+        self._attachments.append((os.fspath(path), filename or os.path.basename(path), mimetype))
+        return self
+
     def to_message(self) -> bytes:
-        return self._msg.as_bytes()
+        if not self._attachments:
+            return self._msg.as_bytes()
+        return b"".join(self.iter_message())
+
+    def iter_message(self, chunk_size=64 * 1024):
+        """
+        分块生成邮件内容，附件在生成时才读取，按块进行base64编码，每块都以完整的行结束
+        :param chunk_size: 附件每块编码后的大约字节数
+        :return: bytes的生成器
+        """
+        if not self._attachments:
+            yield self._msg.as_bytes()
+            return
+        raw, markers = self._skeleton()
+        read_size = max(chunk_size // 76, 1) * self._BASE64_LINE
+        linesep = self._msg.policy.linesep.encode()
+        pos = 0
+        for (source, _, _), marker in zip(self._attachments, markers):
+            # 附件的位置使用随机内容占位，编码后占一行
+            index = raw.index(marker, pos)
+            yield raw[pos:index]
+            pos = index + len(marker)
+            for chunk in self._read_attachment(source, read_size):
+                yield base64.encodebytes(chunk).replace(b"\n", linesep)
+        yield raw[pos:]
+
+    def _skeleton(self):
+        """
+        与EmailMessage.make_mixed相同，把正文移到子部分中，但不修改self._msg，
+        附件使用占位内容，由email库生成所有头部和边界
+        :return: (序列化的邮件, [每个附件占位内容所在的行])
+        """
+        msg_policy = self._msg.policy
+        skeleton = message.EmailMessage(msg_policy)
+        skeleton._headers = [(name, value) for name, value in self._msg._headers
+                             if not name.lower().startswith("content-")]
+        if "MIME-Version" not in skeleton:
+            skeleton["MIME-Version"] = "1.0"
+        skeleton["Content-Type"] = "multipart/mixed"
+        if self._msg.get_payload() is not None:
+            body = message.MIMEPart(msg_policy)
+            body._headers = [(name, value) for name, value in self._msg._headers
+                             if name.lower().startswith("content-")]
+            body._payload = self._msg._payload
+            skeleton.attach(body)
+        markers = []
+        for _, filename, mimetype in self._attachments:
+            mimetype = mimetype or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            maintype, subtype = mimetype.split("/", 1)
+            if maintype in ("message", "multipart"):
+                # 复合类型不能使用base64编码(RFC 2046)，set_content也不接受bytes，作为普通文件发送
+                maintype, subtype = "application", "octet-stream"
+            placeholder = os.urandom(24)
+            part = message.MIMEPart(msg_policy)
+            part.set_content(placeholder, maintype, subtype, filename=filename)
+            skeleton.attach(part)
+            markers.append(base64.b64encode(placeholder) + msg_policy.linesep.encode())
+        return skeleton.as_bytes(), markers
+
+    @staticmethod
+    def _read_attachment(source, read_size):
+        if isinstance(source, bytes):
+            for start in range(0, len(source), read_size):
+                yield source[start:start + read_size]
+            return
+        with open(source, "rb") as f:
+            while True:
+                chunk = f.read(read_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def envelope(self) -> Tuple[str, List[str]]:
+        """
+        SMTP信封的发件人和收件人，"a <a@x.com>, b@x.com"会拆分为多个地址
+        :return: (发件人地址, [收件人地址])
+        """
+        sender = utils.parseaddr(str(self._msg[EmailStruct.FROM.value]))[1]
+        recipients = utils.getaddresses([str(to) for to in self._msg.get_all(EmailStruct.TO.value, [])])
+        return sender, [addr for _, addr in recipients if addr]
 
     @staticmethod
     def convert_to_str(data: Union[List[str], str]):
@@ -61,9 +192,7 @@ class SMTPSender:
         try:
             self._client = smtplib.SMTP(server, port)
         except (socket.gaierror, socket.error, socket.herror, smtplib.SMTPException) as e:
-            logging.error("you email may not have been send")
-            logging.error(e)
-            exit(1)
+            raise EmailSendError("connect to {}:{} failed: {}".format(server, port, e)) from e
         self._support_tls = False
         self._tls_conf_func = None
         self._ready = False
@@ -76,29 +205,27 @@ class SMTPSender:
         try:
             self._client.login(username, passwd, initial_response_ok=initial_response_ok)
         except smtplib.SMTPException as e:
-            logging.error("Authentication failed", exc_info=e)
-            exit(1)
+            raise EmailSendError("Authentication failed: {}".format(e)) from e
 
     def send_email(self, em: Email) -> Dict[str, Tuple[int, bytes]]:
         if not self._ready:
             self.ready()
+        sender, recipients = em.envelope()
         return self._client.sendmail(
-            from_addr=em[EmailStruct.FROM],
-            to_addrs=em[EmailStruct.TO],
+            from_addr=sender,
+            to_addrs=recipients,
             msg=em.to_message()
         )
 
     def ready(self):
         # step 1: check server support EHLO or HELO
         if not self.ping():
-            logging.error("Remote server do not support `HELO` or `EHLO`, exit process")
-            exit(1)
+            raise EmailSendError("Remote server do not support `HELO` or `EHLO`")
         # step 2:  does remote server support tls ?
         if self.enable_tls_if_need():
             # server support trying send EHLO
             if not self.tls_ping():
-                logging.error("Remote server create tls connection failed, exit process")
-                exit(1)
+                raise EmailSendError("Remote server create tls connection failed")
         else:
             logging.info("connection not base on tls")
         # step 3: ready to send email
@@ -143,7 +270,7 @@ class SMTPSender:
             logging.info("Remote server do not support `EHLO` trying use `HELO`")
             code = self._client.helo()[0]
             if not (200 <= code <= 299):
-                logging.error("Remote server refused `HELO`,code: ", code)
+                logging.error("Remote server refused `HELO`,code: {}".format(code))
                 return False
         else:
             if self._client.has_extn("starttls"):
@@ -155,6 +282,517 @@ class SMTPSender:
         self._client.quit()
 
 
+_LINE_END = re.compile(br"\r\n|\r|\n")
+_LEADING_DOT = re.compile(br"^\.", re.MULTILINE)
+
+
+def _smtp_lines(data: bytes) -> bytes:
+    """
+    换行统一为CRLF，行首的"."转义为".."，data必须从行首开始
+    """
+    # 大部分内容(policy.SMTP生成的邮件，base64编码的附件)不需要修改，count和find比正则替换快得多
+    crlf = data.count(b"\r\n")
+    if data.count(b"\n") != crlf or data.count(b"\r") != crlf:
+        data = _LINE_END.sub(b"\r\n", data)
+    if data.startswith(b".") or b"\n." in data:
+        data = _LEADING_DOT.sub(b"..", data)
+    return data
+
+
+def _data_payload(data: bytes) -> bytes:
+    """
+    DATA命令之后发送的内容，以"\r\n.\r\n"结束
+    """
+    data = _smtp_lines(data)
+    if not data.endswith(b"\r\n"):
+        data += b"\r\n"
+    return data + b".\r\n"
+
+
+class _Job:
+    __slots__ = ("email", "future", "attempts", "in_flight", "sender", "recipients", "commands", "data")
+
+    def __init__(self, email: Email, future: Future):
+        self.email = email
+        self.future = future
+        self.attempts = 0
+        # 命令已经发送给服务器
+        self.in_flight = False
+        self.sender = None
+        self.recipients = None
+        self.commands = None
+        self.data = None
+
+
+@WithContext
+class BulkSMTPSender:
+    """
+    批量发送邮件，使用多个已认证的SMTP连接并发发送，每个连接由一个线程负责，
+    服务器支持PIPELINING时，MAIL/RCPT/DATA一起发送，并且和上一封邮件的内容一起发送，每封邮件只需要一次往返，
+    连接断开或者服务器返回421时重新连接，并重新发送未完成的邮件(内容已经发送但没有收到响应的邮件可能会重复)
+    """
+
+    def __init__(self, server, port, connections=4, username=None, password=None, starttls=None, use_ssl=False,
+                 tls_context: ssl.SSLContext = None, timeout=30.0, pipeline_depth=32, max_retries=2,
+                 retry_interval=0.5):
+        """
+        :param server: SMTP服务器地址
+        :param port:
+        :param connections: 连接数
+        :param username: 为None时不认证
+        :param password:
+        :param starttls: None表示服务器支持时使用STARTTLS，True表示必须使用，False表示不使用
+        :param use_ssl: 是否直接使用TLS连接(465端口)
+        :param tls_context: 默认为ssl.create_default_context()
+        :param timeout: socket超时时间
+        :param pipeline_depth: 每个连接一次最多取出的邮件数
+        :param max_retries: 连接出错时每封邮件最多重新发送的次数
+        :param retry_interval: 连接出错后等待多久重新连接
+        """
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.use_ssl = use_ssl
+        self.tls_context = tls_context
+        self.timeout = timeout
+        self.pipeline_depth = pipeline_depth
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.reconnects = 0
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work, name="smtp-sender-{}".format(i), daemon=True)
+                         for i in range(connections)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, em: Email) -> Future:
+        """
+        提交一封邮件
+        :param em:
+        :return: Future，结果与smtplib.SMTP.sendmail相同，为被拒绝的收件人{收件人: (code, msg)}，
+                 发送失败时为SMTPSenderRefused，SMTPRecipientsRefused，SMTPDataError等异常
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("sender is closed")
+            self._queue.put(_Job(em, future))
+        return future
+
+    def send_all(self, emails: Iterable[Email]) -> List[Future]:
+        return [self.submit(em) for em in emails]
+
+    def _context(self) -> ssl.SSLContext:
+        return self.tls_context or ssl.create_default_context()
+
+    def _connect(self) -> smtplib.SMTP:
+        if self.use_ssl:
+            client = smtplib.SMTP_SSL(self.server, self.port, timeout=self.timeout, context=self._context())
+        else:
+            client = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            code, msg = client.ehlo()
+            if not (200 <= code <= 299) and not (200 <= client.helo()[0] <= 299):
+                raise EmailSendError("Remote server refused `EHLO` and `HELO`: {} {}".format(code, msg))
+            if not self.use_ssl and self.starttls is not False and client.has_extn("starttls"):
+                client.starttls(context=self._context())
+                client.ehlo()
+            elif self.starttls and not self.use_ssl:
+                raise EmailSendError("Remote server do not support `STARTTLS`")
+            if self.username is not None:
+                client.login(self.username, self.password)
+        except BaseException:
+            client.close()
+            raise
+        with self._lock:
+            self.reconnects += 1
+        return client
+
+    def _take(self):
+        job = self._queue.get()
+        if job is None:
+            return None
+        jobs = [job]
+        while len(jobs) < self.pipeline_depth:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                # 留给其他线程或者下一次_take
+                self._queue.put(None)
+                break
+            jobs.append(job)
+        return jobs
+
+    def _work(self):
+        client = None
+        while True:
+            jobs = self._take()
+            if jobs is None:
+                break
+            jobs = [job for job in jobs if self._prepare(job)]
+            if not jobs:
+                continue
+            connected = False
+            try:
+                if client is None:
+                    client = self._connect()
+                connected = True
+                if client.has_extn("pipelining"):
+                    self._deliver_pipelined(client, jobs)
+                else:
+                    self._deliver(client, jobs)
+            except (smtplib.SMTPException, OSError, EmailSendError) as e:
+                logging.warning("smtp connection to {}:{} failed: {}".format(self.server, self.port, e))
+                if client is not None:
+                    client.close()
+                    client = None
+                self._retry(jobs, e, connected)
+                time.sleep(self.retry_interval)
+        if client is not None:
+            try:
+                client.quit()
+            except (smtplib.SMTPException, OSError):
+                client.close()
+
+    def _prepare(self, job: _Job) -> bool:
+        if not job.future.running() and not job.future.set_running_or_notify_cancel():
+            return False
+        if job.data is None:
+            try:
+                job.sender, job.recipients = job.email.envelope()
+                if not job.recipients:
+                    raise smtplib.SMTPRecipientsRefused({})
+                commands = ["MAIL FROM:{}\r\n".format(smtplib.quoteaddr(job.sender))]
+                commands.extend("RCPT TO:{}\r\n".format(smtplib.quoteaddr(rcpt)) for rcpt in job.recipients)
+                commands.append("DATA\r\n")
+                job.commands = "".join(commands).encode("ascii")
+                job.data = job.email.to_message()
+            except Exception as e:
+                self._done(job, error=e)
+                return False
+        return True
+
+    def _retry(self, jobs: List[_Job], error, connected):
+        for job in jobs:
+            if job.future.done():
+                continue
+            # 流水线中还没有发送的邮件不计入重试次数
+            if job.in_flight or not connected:
+                job.attempts += 1
+            job.in_flight = False
+            with self._lock:
+                # 关闭后队列末尾是结束标记，不能再放回
+                retry = job.attempts <= self.max_retries and not self._closed
+                if retry:
+                    self.retried += 1
+                    self._queue.put(job)
+            if not retry:
+                self._done(job, error=error)
+
+    def _done(self, job: _Job, result=None, error=None):
+        with self._lock:
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+        if error is None:
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(error)
+
+    @staticmethod
+    def _reply(client: smtplib.SMTP):
+        code, msg = client.getreply()
+        if code == 421:
+            # 服务器将要关闭连接
+            raise smtplib.SMTPResponseException(code, msg)
+        return code, msg
+
+    def _deliver_pipelined(self, client: smtplib.SMTP, jobs: List[_Job]):
+        jobs[0].in_flight = True
+        client.send(jobs[0].commands)
+        for i, job in enumerate(jobs):
+            mail = self._reply(client)
+            rcpts = [self._reply(client) for _ in job.recipients]
+            data = self._reply(client)
+            refused = {rcpt: reply for rcpt, reply in zip(job.recipients, rcpts) if reply[0] not in (250, 251)}
+            accepted = mail[0] == 250 and len(refused) < len(job.recipients)
+            if data[0] == 354:
+                # 没有接受的收件人时服务器仍然返回354，发送空内容结束
+                payload = _data_payload(job.data) if accepted else b".\r\n"
+            elif mail[0] == 250:
+                payload = b"RSET\r\n"
+            else:
+                payload = b""
+            if i + 1 < len(jobs):
+                jobs[i + 1].in_flight = True
+                payload += jobs[i + 1].commands
+            if payload:
+                client.send(payload)
+            final = self._reply(client) if data[0] == 354 or mail[0] == 250 else None
+
+            if mail[0] != 250:
+                self._done(job, error=smtplib.SMTPSenderRefused(mail[0], mail[1], job.sender))
+            elif not accepted:
+                self._done(job, error=smtplib.SMTPRecipientsRefused(refused))
+            elif data[0] != 354:
+                self._done(job, error=smtplib.SMTPDataError(*data))
+            elif final[0] != 250:
+                self._done(job, error=smtplib.SMTPDataError(*final))
+            else:
+                self._done(job, refused)
+
+    def _deliver(self, client: smtplib.SMTP, jobs: List[_Job]):
+        for job in jobs:
+            job.in_flight = True
+            try:
+                refused = client.sendmail(job.sender, job.recipients, job.data)
+            except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                if e.smtp_code == 421:
+                    raise
+                self._done(job, error=e)
+            except smtplib.SMTPRecipientsRefused as e:
+                self._done(job, error=e)
+            else:
+                self._done(job, refused)
+
+    def metrics(self) -> dict:
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        with self._lock:
+            return {
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "reconnects": self.reconnects,
+                "queued": self._queue.qsize(),
+                "rate": self.sent / elapsed,
+            }
+
+    def close(self, wait=True):
+        """
+        发送完已经提交的邮件后关闭所有连接
+        :param wait: 是否等待发送完成
+        :return:
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for _ in self._workers:
+                self._queue.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+
+@WithAsyncContext
+class AsyncSMTPSender:
+    """
+    基于asyncio的SMTP客户端，第一次发送时连接，服务器支持PIPELINING时MAIL/RCPT/DATA一起发送，
+    邮件内容通过Email.iter_message分块生成并直接写入socket，大附件不会整个加载到内存，
+    同一个连接上的邮件依次发送，需要并发时创建多个AsyncSMTPSender
+    """
+
+    def __init__(self, server, port, username=None, password=None, starttls=None, use_ssl=False,
+                 tls_context: ssl.SSLContext = None, timeout=30.0, chunk_size=64 * 1024):
+        """
+        :param server: SMTP服务器地址
+        :param port:
+        :param username: 为None时不认证
+        :param password:
+        :param starttls: None表示服务器支持时使用STARTTLS，True表示必须使用，False表示不使用
+        :param use_ssl: 是否直接使用TLS连接(465端口)
+        :param tls_context: 默认为ssl.create_default_context()
+        :param timeout: 连接和等待每个响应的超时时间
+        :param chunk_size: 附件每次编码和写入的大约字节数
+        """
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.use_ssl = use_ssl
+        self.tls_context = tls_context
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.extensions = {}
+        self._stream = None
+        self._lock = asyncio.Lock()
+
+    def has_extn(self, name) -> bool:
+        return name.upper() in self.extensions
+
+    async def _reply(self) -> Tuple[int, bytes]:
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self._stream.readuntil(b"\n"), self.timeout)
+            lines.append(line[4:].strip())
+            # "250-"表示后面还有行，"250 "为最后一行
+            if line[3:4] != b"-":
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        if code == 421:
+            await self._disconnect()
+            raise smtplib.SMTPServerDisconnected("server closing connection: {!r}".format(b"\n".join(lines)))
+        return code, b"\n".join(lines)
+
+    async def _command(self, command: str) -> Tuple[int, bytes]:
+        await self._stream.write_all(command.encode("ascii") + b"\r\n")
+        return await self._reply()
+
+    async def _ehlo(self):
+        code, msg = await self._command("EHLO {}".format(socket.getfqdn()))
+        self.extensions = {}
+        if not (200 <= code <= 299):
+            code, msg = await self._command("HELO {}".format(socket.getfqdn()))
+            if not (200 <= code <= 299):
+                raise EmailSendError("Remote server refused `EHLO` and `HELO`: {} {}".format(code, msg))
+            return
+        for line in msg.decode("latin-1").split("\n")[1:]:
+            name, _, params = line.partition(" ")
+            self.extensions[name.upper()] = params
+
+    async def connect(self):
+        """
+        连接服务器，EHLO，需要时STARTTLS和认证
+        :return:
+        """
+        context = self.tls_context or ssl.create_default_context()
+        if self.use_ssl:
+            self._stream = await AsyncTlsStream.connect(self.server, self.port, self.timeout, context)
+        else:
+            self._stream = await AsyncTcpStream.connect(self.server, self.port, self.timeout)
+        try:
+            code, msg = await self._reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, msg)
+            await self._ehlo()
+            if not self.use_ssl and self.starttls is not False and self.has_extn("starttls"):
+                code, msg = await self._command("STARTTLS")
+                if code != 220:
+                    raise smtplib.SMTPResponseException(code, msg)
+                if not hasattr(self._stream.writer, "start_tls"):
+                    raise EmailSendError("STARTTLS requires Python 3.11+")
+                await asyncio.wait_for(
+                    self._stream.writer.start_tls(context, server_hostname=self.server), self.timeout)
+                await self._ehlo()
+            elif self.starttls and not self.use_ssl:
+                raise EmailSendError("Remote server do not support `STARTTLS`")
+            if self.username is not None:
+                await self._login()
+        except BaseException:
+            await self._disconnect()
+            raise
+
+    async def _login(self):
+        mechanisms = self.extensions.get("AUTH", "").upper().split()
+        if "PLAIN" in mechanisms:
+            token = base64.b64encode("\0{}\0{}".format(self.username, self.password).encode()).decode()
+            code, msg = await self._command("AUTH PLAIN {}".format(token))
+        elif "LOGIN" in mechanisms:
+            code, msg = await self._command("AUTH LOGIN {}".format(base64.b64encode(self.username.encode()).decode()))
+            if code == 334:
+                code, msg = await self._command(base64.b64encode(self.password.encode()).decode())
+        else:
+            raise EmailSendError("Remote server do not support AUTH PLAIN or LOGIN")
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, msg)
+
+    async def _disconnect(self):
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            await stream.close()
+
+    async def send_email(self, em: Email) -> Dict[str, Tuple[int, bytes]]:
+        """
+        发送邮件，结果和异常与SMTPSender.send_email相同
+        :param em:
+        :return: 被拒绝的收件人{收件人: (code, msg)}
+        """
+        sender, recipients = em.envelope()
+        if not recipients:
+            raise smtplib.SMTPRecipientsRefused({})
+        async with self._lock:
+            if self._stream is None:
+                await self.connect()
+            try:
+                return await self._send(em, sender, recipients)
+            except (ConnectionError, asyncio.TimeoutError, EOFError) as e:
+                # 连接状态未知，下次发送时重新连接
+                await self._disconnect()
+                raise smtplib.SMTPServerDisconnected(str(e)) from e
+
+    async def _send(self, em: Email, sender, recipients):
+        commands = ["MAIL FROM:{}".format(smtplib.quoteaddr(sender))]
+        commands.extend("RCPT TO:{}".format(smtplib.quoteaddr(rcpt)) for rcpt in recipients)
+        commands.append("DATA")
+        if self.has_extn("pipelining"):
+            await self._stream.write_all("".join(command + "\r\n" for command in commands).encode("ascii"))
+            replies = [await self._reply() for _ in commands]
+        else:
+            # 与smtplib.SMTP.sendmail相同，MAIL失败或者所有收件人都被拒绝时不再发送后面的命令
+            replies = [await self._command(commands[0])]
+            if replies[0][0] == 250:
+                for command in commands[1:-1]:
+                    replies.append(await self._command(command))
+                if any(code in (250, 251) for code, _ in replies[1:]):
+                    replies.append(await self._command(commands[-1]))
+            replies.extend([(503, b"not sent")] * (len(commands) - len(replies)))
+        mail, rcpts, data = replies[0], replies[1:-1], replies[-1]
+        refused = {rcpt: reply for rcpt, reply in zip(recipients, rcpts) if reply[0] not in (250, 251)}
+        accepted = mail[0] == 250 and len(refused) < len(recipients)
+
+        if data[0] == 354 and not accepted:
+            await self._command(".")
+        elif data[0] != 354 and mail[0] == 250:
+            await self._command("RSET")
+        if mail[0] != 250:
+            raise smtplib.SMTPSenderRefused(mail[0], mail[1], sender)
+        if not accepted:
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data[0] != 354:
+            raise smtplib.SMTPDataError(*data)
+
+        try:
+            ends_with_crlf = True
+            for chunk in em.iter_message(self.chunk_size):
+                if chunk:
+                    chunk = _smtp_lines(chunk)
+                    await self._stream.write_all(chunk)
+                    ends_with_crlf = chunk.endswith(b"\r\n")
+            await self._stream.write_all(b".\r\n" if ends_with_crlf else b"\r\n.\r\n")
+            code, msg = await self._reply()
+        except BaseException:
+            # 邮件内容已经开始发送(附件读取失败，任务被取消等)，服务器停留在DATA状态，只能断开连接
+            await self._disconnect()
+            raise
+        if code != 250:
+            raise smtplib.SMTPDataError(code, msg)
+        return refused
+
+    async def close(self):
+        if self._stream is None:
+            return
+        try:
+            await self._command("QUIT")
+        except (smtplib.SMTPException, ConnectionError, asyncio.TimeoutError, EOFError):
+            pass
+        await self._disconnect()
+
+
 @unimplemented
 @WithContext
 class POP3Sender:
@@ -165,3 +803,169 @@ class POP3Sender:
 @WithContext
 class IMAPSender:
     pass
+
+
+if __name__ == '__main__':
+    import email
+    import tempfile
+    import tracemalloc
+    from net.aio import AsyncTcpListener
+    from net.proxy import FaultProxy, Faults
+    from net.tcp import SocketProfile
+
+    MESSAGES = 500
+    delivered = []
+
+    async def smtp_stub(stream: AsyncTcpStream):
+        # 最简单的SMTP服务器，支持PIPELINING，拒绝reject@开头的收件人
+        await stream.write_all(b"220 stub ESMTP\r\n")
+        recipients = 0
+        while True:
+            line = await stream.readuntil(b"\r\n")
+            verb = line[:4].upper()
+            if verb == b"EHLO":
+                reply = b"250-stub\r\n250-PIPELINING\r\n250-8BITMIME\r\n250 AUTH PLAIN LOGIN\r\n"
+            elif verb == b"AUTH":
+                reply = b"235 2.7.0 Authentication successful\r\n"
+            elif verb == b"MAIL":
+                recipients = 0
+                reply = b"250 OK\r\n"
+            elif verb == b"RCPT":
+                if line[9:].lstrip(b"<").startswith(b"reject@"):
+                    reply = b"550 no such user\r\n"
+                else:
+                    recipients += 1
+                    reply = b"250 OK\r\n"
+            elif verb == b"DATA":
+                if not recipients:
+                    reply = b"554 no valid recipients\r\n"
+                else:
+                    await stream.write_all(b"354 go ahead\r\n")
+                    size = 0
+                    while True:
+                        data = await stream.readuntil(b"\n")
+                        if data == b".\r\n":
+                            break
+                        size += len(data)
+                    delivered.append(size)
+                    reply = b"250 queued\r\n"
+            elif verb == b"QUIT":
+                await stream.write_all(b"221 bye\r\n")
+                return False
+            else:
+                reply = b"250 OK\r\n"
+            await stream.write_all(reply)
+
+    loop = asyncio.new_event_loop()
+    # 每个响应单独写入，需要关闭Nagle算法，否则流水线中的后续响应要等待对端的延迟确认
+    listener = AsyncTcpListener("127.0.0.1", 0, profile=SocketProfile(nodelay=True))
+    loop.run_until_complete(listener.start(smtp_stub))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    # 每个方向1ms延迟，模拟局域网中的SMTP服务器
+    proxy = FaultProxy(*listener.local_addr, faults=Faults(latency=0.001))
+    host, port = proxy.start_in_thread()
+
+    def emails(count):
+        return [Email("bench <bench@example.com>").to(["user{}@example.com".format(i), "ops@example.com"])
+                .subject("notification {}".format(i)).content("hello\n.\nbody {}\n".format(i) * 20)
+                for i in range(count)]
+
+    def bench(name, connections=None, count=MESSAGES, max_retries=2):
+        batch = emails(count)
+        delivered.clear()
+        failed = 0
+        begin = time.perf_counter()
+        if connections is None:
+            with SMTPSender(host, port) as sender:
+                for em in batch:
+                    sender.send_email(em)
+            metrics = {}
+        else:
+            with BulkSMTPSender(host, port, connections=connections, username="u", password="p",
+                                max_retries=max_retries) as sender:
+                for future in sender.send_all(batch):
+                    if future.exception() is not None:
+                        failed += 1
+                metrics = sender.metrics()
+        cost = time.perf_counter() - begin
+        print("{:<22} {:>7.0f} msg/s, delivered {}, failed {} {}".format(
+            name, count / cost, len(delivered), failed, metrics))
+
+    bench("SMTPSender", count=MESSAGES // 5)
+    bench("Bulk 1 connection", 1)
+    bench("Bulk 8 connections", 8)
+    # 之后的每个连接转发16KB后被重置，验证重新连接和重新发送
+    proxy.add_rule(lambda conn: True, Faults(latency=0.001, reset_after=16 * 1024))
+    logging.getLogger().setLevel(logging.ERROR)
+    # 流水线中的邮件在每次重置时都会重新发送，需要更多的重试次数
+    bench("Bulk 8 with resets", 8, max_retries=10)
+    proxy.rules.clear()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    async def send_async(name, senders, count=MESSAGES):
+        batch = emails(count)
+        delivered.clear()
+        begin = time.perf_counter()
+
+        async def send(part):
+            async with AsyncSMTPSender(host, port, username="u", password="p") as sender:
+                for em in part:
+                    await sender.send_email(em)
+
+        await asyncio.gather(*(send(batch[i::senders]) for i in range(senders)))
+        print("{:<22} {:>7.0f} msg/s, delivered {}".format(
+            name, count / (time.perf_counter() - begin), len(delivered)))
+
+    asyncio.run(send_async("Async 1 connection", 1, MESSAGES // 5))
+    asyncio.run(send_async("Async 8 connections", 8))
+
+    # 16MB附件，比较发送时Python分配内存的峰值，直接连接服务器，避免计入代理的缓冲区
+    with tempfile.NamedTemporaryFile(suffix=".zip") as report:
+        report.write(os.urandom(16 * 1024 * 1024))
+        report.flush()
+        stub_host, stub_port = listener.local_addr
+
+        async def send_report():
+            async with AsyncSMTPSender(stub_host, stub_port) as sender:
+                await sender.send_email(Email("bench@example.com").to("ops@example.com").subject("report")
+                                        .html("<h1>report</h1>").attach_file(report.name))
+
+        tracemalloc.start()
+        begin = time.perf_counter()
+        asyncio.run(send_report())
+        streamed = tracemalloc.get_traced_memory()[1], time.perf_counter() - begin
+        tracemalloc.reset_peak()
+        begin = time.perf_counter()
+        with SMTPSender(stub_host, stub_port) as sender:
+            sender.send_email(Email("bench@example.com").to("ops@example.com").subject("report")
+                              .html("<h1>report</h1>").attach_file(report.name))
+        buffered = tracemalloc.get_traced_memory()[1], time.perf_counter() - begin
+        tracemalloc.stop()
+        print("16MB attachment: AsyncSMTPSender peak {:.1f}MB in {:.2f}s, SMTPSender peak {:.1f}MB in {:.2f}s".format(
+            streamed[0] / 1024 / 1024, streamed[1], buffered[0] / 1024 / 1024, buffered[1]))
+
+    # 不同类型的附件，生成的邮件可以由email库解析出原始内容
+    attachments = [(b"From: a@example.com\r\nSubject: inner\r\n\r\nforwarded\r\n", "report.eml"),
+                   (os.urandom(100000), "data.zip"), (b"line\n" * 1000, "notes.txt"),
+                   (b"<h1>report</h1>", "report.html"), (os.urandom(57 * 3), "raw.bin")]
+    em = Email("bench@example.com").to("ops@example.com").subject("attachments").content("see attachments")
+    for data, filename in attachments:
+        em.attach(data, filename)
+    parsed = email.message_from_bytes(em.to_message(), policy=policy.default)
+    parts = list(parsed.iter_attachments())
+    assert [p.get_filename() for p in parts] == [f for _, f in attachments], [p.get_filename() for p in parts]
+    for part, (data, _) in zip(parts, attachments):
+        assert part.get_payload(decode=True) == data, part.get_filename()
+    assert parsed.get_body().get_content().strip() == "see attachments"
+
+    with BulkSMTPSender(host, port, connections=1) as sender:
+        bad = sender.submit(Email("bench@example.com").to("reject@example.com").subject("x").content("x"))
+        partial = sender.submit(Email("bench@example.com").to("reject@example.com, ok@example.com")
+                                .subject("x").content("x"))
+        try:
+            bad.result()
+        except smtplib.SMTPRecipientsRefused as e:
+            print("refused:", e.recipients)
+        print("partially refused:", partial.result())
+    proxy.stop()
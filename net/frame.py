@@ -0,0 +1,313 @@
+"""
+
+stream = FramedStream(TcpStream.connect("127.0.0.1", 9000), LengthPrefixFramer("u32"), JSONCodec())
+stream.send({"cmd": "ping"})
+stream.send_many([{"id": i} for i in range(1000)])
+print(stream.recv())
+"""
+import abc
+import json
+import struct
+
+from httpclient.strcutures import WithContext
+from net.tcp import TcpStream
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 默认的最大消息长度，防止错误的长度前缀导致分配过大的内存
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class FrameError(Exception):
+    pass
+
+
+class Framer(metaclass=abc.ABCMeta):
+    """
+    分帧方式，parts返回一个消息在连接上的各个部分，read_frame从连接中读取一个消息
+    """
+
+    @abc.abstractmethod
+    def parts(self, payload) -> tuple:
+        pass
+
+    @abc.abstractmethod
+    def read_frame(self, stream: TcpStream) -> bytes:
+        pass
+
+
+def encode_varint(value: int) -> bytes:
+    """
+    无符号LEB128编码，每个字节的低7位保存数据，最高位表示后面是否还有字节
+    :param value:
+    :return:
+    """
+    if value < 0:
+        raise ValueError("varint must not be negative")
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def read_varint(stream: TcpStream, max_bytes=10) -> int:
+    value = 0
+    for shift in range(0, max_bytes * 7, 7):
+        byte = stream.readexactly(1)[0]
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value
+    raise FrameError("varint longer than {} bytes".format(max_bytes))
+
+
+class LengthPrefixFramer(Framer):
+    """
+    长度前缀分帧，消息前面是消息体的长度
+        u16: 2字节大端序
+        u32: 4字节大端序
+        varint: 1到10字节的LEB128
+    """
+    _FORMATS = {"u16": struct.Struct(">H"), "u32": struct.Struct(">I")}
+
+    def __init__(self, prefix="u32", max_size=MAX_FRAME_SIZE):
+        """
+        :param prefix: u16，u32或varint
+        :param max_size: 最大消息长度
+        """
+        if prefix != "varint" and prefix not in self._FORMATS:
+            raise ValueError("unsupported prefix `{}`, use u16, u32 or varint".format(prefix))
+        self.prefix = prefix
+        self._struct = self._FORMATS.get(prefix)
+        limit = (1 << (self._struct.size * 8)) - 1 if self._struct else max_size
+        self.max_size = min(max_size, limit)
+
+    def header(self, length: int) -> bytes:
+        if length > self.max_size:
+            raise FrameError("frame of {} bytes exceeds max size {}".format(length, self.max_size))
+        if self._struct is None:
+            return encode_varint(length)
+        return self._struct.pack(length)
+
+    def parts(self, payload) -> tuple:
+        return self.header(len(payload)), payload
+
+    def read_frame(self, stream: TcpStream) -> bytes:
+        if self._struct is None:
+            length = read_varint(stream)
+        else:
+            length, = self._struct.unpack(stream.readexactly(self._struct.size))
+        if length > self.max_size:
+            raise FrameError("frame of {} bytes exceeds max size {}".format(length, self.max_size))
+        return stream.readexactly(length)
+
+
+class DelimiterFramer(Framer):
+    """
+    分隔符分帧，消息体中不能包含分隔符，例如按行分隔的文本协议
+    """
+
+    def __init__(self, delimiter=b"\n", max_size=MAX_FRAME_SIZE):
+        """
+        :param delimiter: 分隔符
+        :param max_size: 最大消息长度
+        """
+        self.delimiter = delimiter
+        self.max_size = max_size
+
+    def parts(self, payload) -> tuple:
+        if self.delimiter in payload:
+            raise FrameError("frame must not contain delimiter {!r}".format(self.delimiter))
+        if len(payload) > self.max_size:
+            raise FrameError("frame of {} bytes exceeds max size {}".format(len(payload), self.max_size))
+        return payload, self.delimiter
+
+    def read_frame(self, stream: TcpStream) -> bytes:
+        return stream.readuntil(self.delimiter, self.max_size)[:-len(self.delimiter)]
+
+
+class FixedSizeFramer(Framer):
+    """
+    定长分帧，每个消息的长度相同
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def parts(self, payload) -> tuple:
+        if len(payload) != self.size:
+            raise FrameError("frame must be {} bytes, got {}".format(self.size, len(payload)))
+        return payload,
+
+    def read_frame(self, stream: TcpStream) -> bytes:
+        return stream.readexactly(self.size)
+
+
+class RawCodec:
+    """
+    不做任何转换，消息为bytes
+    """
+
+    @staticmethod
+    def encode(obj) -> bytes:
+        return obj
+
+    @staticmethod
+    def decode(data: bytes):
+        return data
+
+
+class JSONCodec:
+
+    def __init__(self, encoding="utf-8"):
+        self.encoding = encoding
+
+    def encode(self, obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode(self.encoding)
+
+    def decode(self, data: bytes):
+        return json.loads(data.decode(self.encoding))
+
+
+class MsgpackCodec:
+    """
+    需要安装msgpack
+    """
+
+    def __init__(self, **unpack_kwargs):
+        if msgpack is None:
+            raise ImportError("MsgpackCodec requires msgpack, install it with `pip install msgpack`")
+        self._packer = msgpack.Packer()
+        self._unpack_kwargs = unpack_kwargs
+
+    def encode(self, obj) -> bytes:
+        return self._packer.pack(obj)
+
+    def decode(self, data: bytes):
+        return msgpack.unpackb(data, **self._unpack_kwargs)
+
+
+@WithContext
+class FramedStream:
+    """
+    在TcpStream上按消息收发
+    发送时消息头和消息体通过sendmsg一起发送，不需要拼接，send_many一次系统调用发送多个消息，
+    接收时使用TcpStream的缓冲区，多个小消息只需要一次recv
+    """
+
+    def __init__(self, stream: TcpStream, framer: Framer = None, codec=None):
+        """
+        :param stream: TcpStream或者TlsStream
+        :param framer: 分帧方式，默认使用u32长度前缀
+        :param codec: 编解码方式，默认不转换
+        """
+        self.stream = stream
+        self.framer = framer or LengthPrefixFramer()
+        self.codec = codec or RawCodec()
+
+    def send(self, obj) -> int:
+        """
+        发送一个消息
+        :param obj:
+        :return: 发送的字节数
+        """
+        return self.stream.writev(self.framer.parts(self.codec.encode(obj)))
+
+    def send_many(self, objs) -> int:
+        """
+        批量发送消息，所有消息的各个部分放在一起通过sendmsg发送，超过IOV_MAX时分多次发送
+        :param objs:
+        :return: 发送的字节数
+        """
+        encode, parts = self.codec.encode, self.framer.parts
+        buffers = []
+        for obj in objs:
+            buffers.extend(parts(encode(obj)))
+        return self.stream.writev(buffers)
+
+    def recv(self):
+        """
+        接收一个消息，连接关闭时抛出EOFError
+        :return:
+        """
+        return self.codec.decode(self.framer.read_frame(self.stream))
+
+    def __iter__(self):
+        """
+        依次接收消息，直到连接关闭
+        :return:
+        """
+        while True:
+            try:
+                yield self.recv()
+            except EOFError:
+                return
+
+    def close(self):
+        self.stream.close()
+
+
+if __name__ == '__main__':
+    import socket
+    import threading
+    import time
+
+    COUNT = 100000
+    messages = [{"id": i, "name": "user{}".format(i)} for i in range(COUNT)]
+    payloads = [JSONCodec().encode(m) for m in messages]
+
+    def drain(sock):
+        buffer = bytearray(1024 * 1024)
+        while sock.recv_into(buffer):
+            pass
+
+    def run(name, send, count=COUNT):
+        # 接收端只读取字节，测量发送端的系统调用开销
+        left, right = socket.socketpair()
+        reader = threading.Thread(target=drain, args=(right,))
+        reader.start()
+        sender = FramedStream(TcpStream(left, "left"), LengthPrefixFramer("varint"))
+        begin = time.perf_counter()
+        send(sender)
+        cost = time.perf_counter() - begin
+        sender.close()
+        reader.join()
+        right.close()
+        print("{:<24} {:>9.0f} msg/s".format(name, count / cost))
+
+    def concat_send(sender):
+        header = sender.framer.header
+        for payload in payloads:
+            sender.stream.write_all(header(len(payload)) + payload)
+
+    def batched(sender, batch=256):
+        for i in range(0, COUNT, batch):
+            sender.send_many(payloads[i:i + batch])
+
+    run("concat + sendall", concat_send)
+    run("send (sendmsg)", lambda sender: [sender.send(p) for p in payloads])
+    run("send_many (256/batch)", batched)
+
+    big = [b"x" * (4 * 1024 * 1024)] * 64
+
+    def concat_big(sender):
+        for payload in big:
+            sender.stream.write_all(sender.framer.header(len(payload)) + payload)
+
+    run("4MB concat + sendall", concat_big, len(big))
+    run("4MB send (sendmsg)", lambda sender: [sender.send(p) for p in big], len(big))
+
+    left, right = socket.socketpair()
+    sender = FramedStream(TcpStream(left, "left"), LengthPrefixFramer("varint"), JSONCodec())
+    receiver = FramedStream(TcpStream(right, "right"), LengthPrefixFramer("varint"), JSONCodec())
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(receiver))
+    reader.start()
+    sender.send_many(messages)
+    sender.close()
+    reader.join()
+    assert received == messages
@@ -0,0 +1,326 @@
+"""
+
+pool = ConnectionPool(max_size=8, idle_timeout=30)
+with pool.connection("127.0.0.1", 8443, get_default_tls_for_client()) as stream:
+    stream.write_all(b"ping")
+    print(stream.read(4))
+"""
+import select
+import ssl
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from httpclient.strcutures import WithContext
+from net.ssl_tcp import TlsStream
+from net.tcp import TcpStream, SocketProfile
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PoolStats:
+    """
+    连接池统计
+        created: 新建的连接数
+        reused: 从连接池中取出的空闲连接数
+        resumed: 恢复TLS会话的新连接数(跳过了完整握手)
+        evicted: 空闲超时或超过最长使用时间被关闭的连接数
+        discarded: 健康检查失败或者使用时出错被关闭的连接数
+    """
+    __slots__ = ("created", "reused", "resumed", "evicted", "discarded")
+
+    def __init__(self):
+        self.created = 0
+        self.reused = 0
+        self.resumed = 0
+        self.evicted = 0
+        self.discarded = 0
+
+    def as_dict(self) -> dict:
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+    def __repr__(self):
+        return "PoolStats({})".format(", ".join("{}={}".format(k, v) for k, v in self.as_dict().items()))
+
+
+# 检查TLS连接时最多处理的可读次数，每次可能是多个NewSessionTicket
+_TLS_DRAIN_ATTEMPTS = 4
+
+
+def _readable(stream: TcpStream) -> bool:
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(stream.fileno(), select.POLLIN)
+        return bool(poller.poll(0))
+    readable, _, _ = select.select([stream], [], [], 0)
+    return bool(readable)
+
+
+def _drain_tls(stream: TlsStream) -> bool:
+    """
+    TLS 1.3的服务器在握手后发送NewSessionTicket等握手后消息，没有读取时socket可读但连接仍然可用，
+    非阻塞读取一次交给SSL层处理，只有这些消息时抛出SSLWantReadError
+    :return: 连接是否可用
+    """
+    sock = stream._sock
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        for _ in range(_TLS_DRAIN_ATTEMPTS):
+            try:
+                sock.recv(1)
+            except ssl.SSLWantReadError:
+                if not _readable(stream):
+                    return True
+                continue
+            # 收到了多余的应用数据，或者对端已经关闭(b"")
+            return False
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def _alive(stream: TcpStream) -> bool:
+    """
+    空闲连接不应该可读，可读说明对端已经关闭或者发送了多余的数据，
+    TLS连接的pending包括SSL层已经解密的数据，握手后消息由_drain_tls处理
+    """
+    if stream.closed or stream.pending():
+        return False
+    try:
+        if not _readable(stream):
+            return True
+        if isinstance(stream, TlsStream):
+            return _drain_tls(stream)
+        return False
+    except (OSError, ValueError):
+        return False
+
+
+class _Slot:
+    """
+    同一个(host, port, context, server_hostname)的连接
+    """
+    __slots__ = ("key", "idle", "in_use", "session")
+
+    def __init__(self, key):
+        self.key = key
+        # (stream, 创建时间, 放回时间)，右侧为最近放回的连接
+        self.idle = deque()
+        self.in_use = 0
+        self.session = None
+
+
+@WithContext
+class ConnectionPool:
+    """
+    TcpStream/TlsStream连接池，按照(host, port, TLS context, server_hostname)分组
+    取出时优先使用最近放回的连接，并检查连接是否仍然可用，
+    TLS连接放回时保存会话，新建连接时使用该会话恢复，服务器支持时跳过完整握手
+    """
+
+    def __init__(self, max_size=10, idle_timeout=60.0, max_lifetime=None, connect_timeout=None, acquire_timeout=None,
+                 profile: SocketProfile = None):
+        """
+        :param max_size: 每组最多的连接数(包括正在使用的连接)
+        :param idle_timeout: 空闲超过该时间的连接会被关闭，None表示不限制
+        :param max_lifetime: 连接创建后超过该时间不再复用，None表示不限制
+        :param connect_timeout: 新建连接的超时时间
+        :param acquire_timeout: 连接数达到max_size时等待的最长时间，超时抛出PoolTimeout，None表示一直等待
+        :param profile: 新建连接使用的socket选项，默认使用TcpStream.profile或TlsStream.profile
+        """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.connect_timeout = connect_timeout
+        self.acquire_timeout = acquire_timeout
+        self.profile = profile
+        self.stats = PoolStats()
+        self._slots = {}
+        # 正在使用的连接 -> (key, 创建时间)
+        self._in_use = {}
+        self._cond = threading.Condition()
+        self._closed = False
+
+    @staticmethod
+    def key(host, port, context=None, server_hostname=None) -> tuple:
+        return host, port, context, server_hostname if context is not None else None
+
+    def acquire(self, host, port, context=None, server_hostname=None) -> TcpStream:
+        """
+        取出一个连接，使用完毕后需要调用release
+        :param host:
+        :param port:
+        :param context: SSLContext，为None时使用TCP连接
+        :param server_hostname: TLS的SNI主机名，默认为host
+        :return: TcpStream或TlsStream
+        """
+        key = self.key(host, port, context, server_hostname)
+        deadline = None if self.acquire_timeout is None else time.monotonic() + self.acquire_timeout
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("connection pool is closed")
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = _Slot(key)
+            while True:
+                stream = self._take_idle(slot)
+                if stream is not None:
+                    return stream
+                if slot.in_use < self.max_size:
+                    slot.in_use += 1
+                    session = slot.session
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout("no connection available for {}:{} after {}s".format(
+                        host, port, self.acquire_timeout))
+                self._cond.wait(remaining)
+
+        # 在锁外建立连接，避免阻塞其他分组
+        try:
+            if context is None:
+                stream = TcpStream.connect(host, port, self.connect_timeout, self.profile)
+            else:
+                stream = TlsStream.connect(host, port, self.connect_timeout, context, server_hostname, session,
+                                           self.profile)
+        except Exception:
+            with self._cond:
+                slot.in_use -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.stats.created += 1
+            if context is not None and stream.session_reused:
+                self.stats.resumed += 1
+            self._in_use[stream] = (key, time.monotonic())
+        return stream
+
+    def _take_idle(self, slot: _Slot):
+        now = time.monotonic()
+        self._evict(slot, now)
+        while slot.idle:
+            stream, created, _ = slot.idle.pop()
+            if _alive(stream):
+                slot.in_use += 1
+                self._in_use[stream] = (slot.key, created)
+                self.stats.reused += 1
+                return stream
+            stream.close()
+            self.stats.discarded += 1
+        return None
+
+    def _evict(self, slot: _Slot, now):
+        # 左侧为最早放回的连接
+        while slot.idle:
+            stream, created, released = slot.idle[0]
+            if ((self.idle_timeout is None or now - released < self.idle_timeout)
+                    and (self.max_lifetime is None or now - created < self.max_lifetime)):
+                break
+            slot.idle.popleft()
+            stream.close()
+            self.stats.evicted += 1
+
+    def release(self, stream: TcpStream, reuse=True):
+        """
+        放回连接
+        :param stream: acquire取出的连接
+        :param reuse: 为False时关闭连接，例如协议状态未知时
+        :return:
+        """
+        with self._cond:
+            key, created = self._in_use.pop(stream)
+            slot = self._slots[key]
+            slot.in_use -= 1
+            if isinstance(stream, TlsStream) and not stream.closed and stream.session is not None:
+                # TLS 1.3的会话票据在握手之后才收到，放回时保存最新的会话
+                slot.session = stream.session
+            now = time.monotonic()
+            if (not reuse or self._closed or stream.closed
+                    or (self.max_lifetime is not None and now - created >= self.max_lifetime)):
+                stream.close()
+                if reuse is False:
+                    self.stats.discarded += 1
+            else:
+                slot.idle.append((stream, created, now))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, host, port, context=None, server_hostname=None):
+        """
+        取出一个连接，with语句结束时放回，发生异常时关闭该连接
+        :param host:
+        :param port:
+        :param context: SSLContext，为None时使用TCP连接
+        :param server_hostname: TLS的SNI主机名
+        :return:
+        """
+        stream = self.acquire(host, port, context, server_hostname)
+        try:
+            yield stream
+        except BaseException:
+            self.release(stream, reuse=False)
+            raise
+        self.release(stream)
+
+    def prune(self):
+        """
+        关闭所有空闲超时的连接
+        :return:
+        """
+        with self._cond:
+            now = time.monotonic()
+            for slot in self._slots.values():
+                self._evict(slot, now)
+
+    def idle_count(self) -> int:
+        with self._cond:
+            return sum(len(slot.idle) for slot in self._slots.values())
+
+    def close(self):
+        """
+        关闭所有空闲连接，正在使用的连接放回时关闭
+        :return:
+        """
+        with self._cond:
+            self._closed = True
+            for slot in self._slots.values():
+                while slot.idle:
+                    slot.idle.pop()[0].close()
+            self._cond.notify_all()
+
+
+if __name__ == '__main__':
+    from net.tcp import TcpListener
+
+    REQUESTS = 5000
+
+    def echo(stream: TcpStream):
+        stream.write_all(stream.read(1024))
+
+    listener = TcpListener("127.0.0.1", 0)
+    server = threading.Thread(target=listener.serve_forever, args=(echo,), daemon=True)
+    server.start()
+    host, port = listener.local_addr
+
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        with TcpStream.connect(host, port) as stream:
+            stream.write_all(b"ping")
+            stream.read(4)
+    fresh = time.perf_counter() - start
+
+    pool = ConnectionPool()
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        with pool.connection(host, port) as stream:
+            stream.write_all(b"ping")
+            stream.read(4)
+    pooled = time.perf_counter() - start
+    pool.close()
+    listener.close()
+    print("{} requests: connect per request {:.0f}ms, pooled {:.0f}ms, {}".format(
+        REQUESTS, fresh * 1000, pooled * 1000, pool.stats))
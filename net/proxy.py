@@ -0,0 +1,558 @@
+"""
+
+proxy = FaultProxy("127.0.0.1", 8080, faults=Faults(latency=0.1, jitter=0.02, down_rate=64 * 1024))
+proxy.add_rule(lambda conn: conn.id % 10 == 0, Faults(reset_after=4096))
+host, port = proxy.start_in_thread()
+# 客户端连接host:port，请求经过代理转发到127.0.0.1:8080
+proxy.faults = Faults.speed("gprs")  # 之后的新连接使用GPRS的网速
+proxy.stop()
+"""
+import asyncio
+import logging
+import random
+import socket
+import threading
+import time
+from collections import deque
+from ssl import SSLContext
+
+from httpclient.strcutures import WithAsyncContext
+from net.tcp import SocketProfile, SockLevel, SockOpt
+
+# 与AppDriver.set_net_work_speed相同的网速，(上行kbps, 下行kbps)
+NET_SPEEDS = {
+    "gsm": (14.4, 14.4),
+    "scsd": (14.4, 57.6),
+    "gprs": (28.8, 57.6),
+    "edge": (473.6, 473.6),
+    "umts": (384.0, 384.0),
+    "hsdpa": (5760.0, 13980.0),
+    "lte": (58000.0, 173000.0),
+    "evdo": (75000.0, 280000.0),
+    "full": (0.0, 0.0),
+}
+
+# 每个方向排队等待发送的数据超过该值时暂停读取来源连接
+_HIGH_WATER = 256 * 1024
+_LOW_WATER = 64 * 1024
+# 关闭连接时发送RST
+_RESET_PROFILE = SocketProfile(linger=0)
+
+
+class Faults:
+    """
+    连接上注入的故障，up为客户端到上游，down为上游到客户端，值为None或0的故障不注入
+
+    Faults(latency=0.2, jitter=0.05)         # 每个方向增加200ms~250ms的延迟
+    Faults(down_rate=32 * 1024, fragment=1)  # 下行限速32KB/s，每个字节单独发送
+    Faults(reset_after=1024)                 # 转发1KB后发送RST
+    Faults(stall_after=0, stall_time=None)   # 连接建立后不再转发任何数据
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, up_rate=None, down_rate=None, fragment=None, reset_after=None,
+                 reset_rate=0.0, stall_after=None, stall_time=None):
+        """
+        :param latency: 每个方向增加的延迟(秒)
+        :param jitter: 额外的随机延迟，0到jitter秒，数据的顺序不变
+        :param up_rate: 上行带宽(字节/秒)
+        :param down_rate: 下行带宽(字节/秒)
+        :param fragment: 每次写入的最大字节数，数据被拆分成多个小包发送
+        :param reset_after: 转发的字节数(两个方向之和)达到该值时发送RST关闭连接
+        :param reset_rate: 连接被选中在收到第一个数据时发送RST的概率
+        :param stall_after: 转发的字节数达到该值时停止转发stall_time秒
+        :param stall_time: 停止转发的时间，None表示不再转发
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.up_rate = up_rate
+        self.down_rate = down_rate
+        self.fragment = fragment
+        self.reset_after = reset_after
+        self.reset_rate = reset_rate
+        self.stall_after = stall_after
+        self.stall_time = stall_time
+
+    @classmethod
+    def speed(cls, name, **kwargs):
+        """
+        使用NET_SPEEDS中的网速，与AppDriver.set_net_work_speed的参数相同
+        :param name: gsm，gprs，edge，umts，hsdpa，lte，evdo，full等
+        :param kwargs: 其他故障
+        :return:
+        """
+        up, down = NET_SPEEDS[name.lower()]
+        return cls(up_rate=up * 1000 / 8 or None, down_rate=down * 1000 / 8 or None, **kwargs)
+
+    @property
+    def shaping(self) -> bool:
+        """
+        是否需要延迟，限速或拆分数据，否则直接转发
+        :return:
+        """
+        return bool(self.latency or self.jitter or self.up_rate or self.down_rate or self.fragment)
+
+    def __repr__(self):
+        return "Faults({})".format(", ".join("{}={!r}".format(k, v) for k, v in vars(self).items() if v))
+
+
+class _Direction:
+    """
+    一个方向的发送队列，free_at为带宽被占用到的时间，last_at为最后一个数据发出的时间
+    队列中为(发出时间, 数据)，按顺序发出，每个方向只有一个定时器
+    """
+    __slots__ = ("rate", "free_at", "last_at", "queue", "timer", "queued", "paused", "eof", "lost")
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.free_at = 0.0
+        self.last_at = 0.0
+        self.queue = deque()
+        self.timer = None
+        self.queued = 0
+        self.paused = False
+        # 来源已经半关闭或者断开，队列中的数据发送完毕后关闭目标
+        self.eof = False
+        self.lost = False
+
+
+class _Side(asyncio.Protocol):
+    """
+    代理连接的一侧，收到的数据交给ProxyConnection转发到另一侧
+    """
+
+    def __init__(self, conn, upstream: bool, proxy=None):
+        """
+        :param conn: ProxyConnection，客户端一侧在连接建立后由proxy创建
+        :param upstream: 是否为上游一侧
+        :param proxy: 客户端一侧所属的FaultProxy
+        """
+        self.conn = conn
+        self.upstream = upstream
+        self.proxy = proxy
+        self.transport = None
+        self.peer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.conn is None:
+            self.proxy._accepted(self)
+
+    def data_received(self, data):
+        self.conn.forward(self, data)
+
+    def eof_received(self):
+        self.conn.eof(self)
+        # 半关闭，仍然可以向这一侧发送数据，TLS连接不支持半关闭
+        return self.transport.get_extra_info("sslcontext") is None
+
+    def connection_lost(self, exc):
+        self.conn.lost(self)
+
+    def pause_writing(self):
+        # 这一侧的写缓冲区已满，暂停读取另一侧
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.resume_reading()
+
+
+class ProxyConnection:
+    """
+    一个被代理的连接，faults可以在连接过程中修改
+    """
+
+    def __init__(self, proxy, conn_id, client: _Side):
+        self.proxy = proxy
+        self.id = conn_id
+        self.client = client
+        self.upstream = None
+        self.client_addr = client.transport.get_extra_info("peername")
+        self.faults = proxy.faults
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.started = time.monotonic()
+        self.closed = False
+        self._up = None
+        self._down = None
+        self._doomed = False
+        self._stalled = False
+
+    @property
+    def bytes_total(self) -> int:
+        return self.bytes_up + self.bytes_down
+
+    def _start(self, faults: Faults):
+        self.faults = faults
+        self._up = _Direction(faults.up_rate)
+        self._down = _Direction(faults.down_rate)
+        self._doomed = bool(faults.reset_rate) and random.random() < faults.reset_rate
+
+    def connected(self, upstream: _Side):
+        self.upstream = upstream
+        upstream.peer, self.client.peer = self.client, upstream
+        self.client.transport.resume_reading()
+
+    def forward(self, src: _Side, data: bytes):
+        if self.closed:
+            return
+        up = src is self.client
+        if up:
+            self.bytes_up += len(data)
+        else:
+            self.bytes_down += len(data)
+        faults = self.faults
+        if self._doomed or (faults.reset_after is not None and self.bytes_total >= faults.reset_after):
+            self.reset()
+            return
+        loop = self.proxy.loop
+        if faults.stall_after is not None and not self._stalled and self.bytes_total >= faults.stall_after:
+            self._stalled = True
+            self.proxy.stalls += 1
+            if faults.stall_time is None:
+                # 不再转发，连接保持直到有一侧关闭
+                self.client.transport.pause_reading()
+                self.upstream.transport.pause_reading()
+                return
+            until = loop.time() + faults.stall_time
+            for direction in (self._up, self._down):
+                direction.free_at = max(direction.free_at, until)
+        if self._stalled and faults.stall_time is None:
+            return
+        direction = self._up if up else self._down
+        dst = src.peer
+        now = loop.time()
+        if not faults.shaping and not direction.queued and direction.free_at <= now:
+            dst.transport.write(data)
+            return
+        self._schedule(src, dst, direction, data, now)
+
+    def _schedule(self, src, dst, direction: _Direction, data, now):
+        faults = self.faults
+        size = faults.fragment or len(data)
+        view = memoryview(data)
+        for i in range(0, len(data), size):
+            piece = bytes(view[i:i + size])
+            # 按带宽计算数据发送完毕的时间，再加上传输延迟，保持数据顺序
+            start = max(now, direction.free_at)
+            direction.free_at = start + (len(piece) / direction.rate if direction.rate else 0.0)
+            delay = faults.latency + (random.uniform(0, faults.jitter) if faults.jitter else 0.0)
+            direction.last_at = max(direction.last_at, direction.free_at + delay)
+            direction.queue.append((direction.last_at, piece))
+            direction.queued += len(piece)
+        if direction.timer is None:
+            direction.timer = self.proxy.loop.call_at(direction.queue[0][0], self._drain, src, dst, direction)
+        if direction.queued > _HIGH_WATER and not direction.paused:
+            direction.paused = True
+            src.transport.pause_reading()
+
+    def _drain(self, src, dst, direction: _Direction):
+        direction.timer = None
+        if self.closed or dst.transport.is_closing():
+            return
+        queue = direction.queue
+        now = self.proxy.loop.time()
+        while queue and queue[0][0] <= now:
+            _, piece = queue.popleft()
+            direction.queued -= len(piece)
+            dst.transport.write(piece)
+        if queue:
+            direction.timer = self.proxy.loop.call_at(queue[0][0], self._drain, src, dst, direction)
+        if direction.paused and direction.queued < _LOW_WATER:
+            direction.paused = False
+            if not src.transport.is_closing():
+                src.transport.resume_reading()
+        if direction.eof and not direction.queued:
+            self._finish(dst, direction)
+
+    def eof(self, src: _Side):
+        self._source_done(src, lost=False)
+
+    def lost(self, src: _Side):
+        self._source_done(src, lost=True)
+
+    def _source_done(self, src: _Side, lost):
+        if self.closed:
+            return
+        peer = src.peer
+        if peer is None or peer.transport.is_closing():
+            self.close()
+            return
+        direction = self._up if src is self.client else self._down
+        direction.eof = True
+        direction.lost = direction.lost or lost
+        if not direction.queued:
+            self._finish(peer, direction)
+
+    def _finish(self, dst: _Side, direction: _Direction):
+        # 来源半关闭时关闭目标的写方向，来源断开或者TLS连接不支持半关闭时关闭整个连接
+        if direction.lost or not dst.transport.can_write_eof():
+            self.close()
+            return
+        dst.transport.write_eof()
+        if self._up.eof and self._down.eof:
+            self.close()
+
+    def reset(self):
+        """
+        向两侧发送RST并关闭连接
+        :return:
+        """
+        if self.closed:
+            return
+        self.proxy.resets += 1
+        for side in (self.client, self.upstream):
+            if side is not None and side.transport is not None:
+                sock = side.transport.get_extra_info("socket")
+                if sock is not None:
+                    _RESET_PROFILE.apply(sock)
+                side.transport.abort()
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for direction in (self._up, self._down):
+            if direction is not None and direction.timer is not None:
+                direction.timer.cancel()
+        for side in (self.client, self.upstream):
+            if side is not None and side.transport is not None and not side.transport.is_closing():
+                side.transport.close()
+        self.proxy._closed(self)
+
+
+@WithAsyncContext
+class FaultProxy:
+    """
+    在本地监听端口，把连接转发到上游，并按照Faults注入延迟，限速，拆包，RST和停顿
+    所有连接在一个事件循环中处理，没有故障的方向直接在data_received中转发，不经过协程和定时器，
+    两侧的写缓冲区和故障队列都有高水位，超过时暂停读取来源连接
+    可以在客户端一侧终止TLS(ssl_context)，并使用TLS连接上游(upstream_ssl)
+    """
+
+    def __init__(self, upstream_host, upstream_port, addr="127.0.0.1", port=0, faults: Faults = None,
+                 ssl_context: SSLContext = None, upstream_ssl: SSLContext = None, upstream_hostname=None,
+                 profile: SocketProfile = None, backlog=socket.SOMAXCONN):
+        """
+        :param upstream_host: 上游地址
+        :param upstream_port: 上游端口
+        :param addr: 监听的地址
+        :param port: 监听的端口，0表示随机端口
+        :param faults: 新连接默认的故障，None表示不注入故障
+        :param ssl_context: 服务端SSLContext，不为None时客户端使用TLS连接代理
+        :param upstream_ssl: 客户端SSLContext，不为None时使用TLS连接上游
+        :param upstream_hostname: 上游TLS的SNI主机名，默认为upstream_host
+        :param profile: 两侧连接使用的socket选项，默认关闭Nagle算法，拆包和限速的小包会立即发出
+        :param backlog: 等待accept的连接队列长度
+        """
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.faults = faults or Faults()
+        self.ssl_context = ssl_context
+        self.upstream_ssl = upstream_ssl
+        self.upstream_hostname = upstream_hostname
+        self.profile = profile or SocketProfile(nodelay=True)
+        self.rules = []
+        self.connections = {}
+        self.loop = None
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(SockLevel.SOL_SOCKET.value, SockOpt.SO_REUSEADDR.value, int(True))
+        self._sock.bind((addr, port))
+        self._sock.listen(backlog)
+        self._sock.setblocking(False)
+        self._server = None
+        self._thread = None
+        self._ids = 0
+        # 累计接受的连接数，已经关闭的连接转发的字节数，RST和停顿的次数，连接上游失败的次数
+        self.accepted = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.resets = 0
+        self.stalls = 0
+        self.upstream_errors = 0
+
+    @property
+    def local_addr(self):
+        return self._sock.getsockname()
+
+    def add_rule(self, predicate, faults: Faults):
+        """
+        添加规则，新连接使用第一个predicate(conn)为True的规则的故障，都不匹配时使用self.faults
+        :param predicate: 参数为ProxyConnection，可以使用conn.id，conn.client_addr
+        :param faults:
+        :return:
+        """
+        self.rules.append((predicate, faults))
+        return self
+
+    def _faults_for(self, conn: ProxyConnection) -> Faults:
+        for predicate, faults in self.rules:
+            if predicate(conn):
+                return faults
+        return self.faults
+
+    def _accepted(self, client: _Side):
+        self._ids += 1
+        self.accepted += 1
+        conn = ProxyConnection(self, self._ids, client)
+        client.conn = conn
+        conn._start(self._faults_for(conn))
+        self.connections[conn.id] = conn
+        self.profile.apply(client.transport.get_extra_info("socket"))
+        # 上游连接建立前不读取客户端的数据
+        client.transport.pause_reading()
+        self.loop.create_task(self._connect_upstream(conn))
+
+    async def _connect_upstream(self, conn: ProxyConnection):
+        try:
+            kwargs = {}
+            if self.upstream_ssl is not None:
+                kwargs = {"ssl": self.upstream_ssl, "server_hostname": self.upstream_hostname or self.upstream_host}
+            transport, upstream = await self.loop.create_connection(
+                lambda: _Side(conn, upstream=True), self.upstream_host, self.upstream_port, **kwargs)
+        except OSError as e:
+            self.upstream_errors += 1
+            logging.debug("proxy connection {} to upstream failed: {}".format(conn.id, e))
+            conn.reset()
+            return
+        if conn.closed:
+            transport.close()
+            return
+        self.profile.apply(transport.get_extra_info("socket"))
+        conn.connected(upstream)
+
+    def _closed(self, conn: ProxyConnection):
+        self.connections.pop(conn.id, None)
+        self.bytes_up += conn.bytes_up
+        self.bytes_down += conn.bytes_down
+
+    def metrics(self) -> dict:
+        live = list(self.connections.values())
+        return {
+            "accepted": self.accepted,
+            "connections": len(live),
+            "bytes_up": self.bytes_up + sum(c.bytes_up for c in live),
+            "bytes_down": self.bytes_down + sum(c.bytes_down for c in live),
+            "resets": self.resets,
+            "stalls": self.stalls,
+            "upstream_errors": self.upstream_errors,
+        }
+
+    async def start(self):
+        """
+        在当前事件循环中开始接受连接
+        :return: 监听的地址
+        """
+        self.loop = asyncio.get_running_loop()
+        self._server = await self.loop.create_server(
+            lambda: _Side(None, upstream=False, proxy=self), sock=self._sock, ssl=self.ssl_context)
+        return self.local_addr
+
+    async def close(self):
+        """
+        停止接受连接并关闭所有连接
+        :return:
+        """
+        if self._server is not None:
+            self._server.close()
+        for conn in list(self.connections.values()):
+            conn.close()
+        if self._server is not None:
+            await self._server.wait_closed()
+        self._sock.close()
+
+    def start_in_thread(self):
+        """
+        在后台线程的事件循环中运行，用于同步的测试代码
+        :return: 监听的地址
+        """
+        loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=loop.run_forever, name="fault-proxy", daemon=True)
+        self._thread.start()
+        return asyncio.run_coroutine_threadsafe(self.start(), loop).result()
+
+    def stop(self):
+        """
+        停止start_in_thread启动的代理
+        :return:
+        """
+        loop = self.loop
+        asyncio.run_coroutine_threadsafe(self.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
+
+
+if __name__ == '__main__':
+    from net.aio import AsyncTcpListener, AsyncTcpStream
+
+    CLIENTS = 2000
+    ROUNDS = 10
+    BULK = 64 * 1024 * 1024
+
+    async def echo(stream):
+        data = await stream.read(64 * 1024)
+        if data:
+            await stream.write_all(data)
+
+    async def client(port, rounds=ROUNDS):
+        async with await AsyncTcpStream.connect("127.0.0.1", port) as stream:
+            for i in range(rounds):
+                message = "ping {}\n".format(i).encode()
+                await stream.write_all(message)
+                assert await stream.readuntil(b"\n") == message
+
+    async def bulk(port):
+        async with await AsyncTcpStream.connect("127.0.0.1", port) as stream:
+            chunk = b"x" * (256 * 1024)
+
+            async def send():
+                for _ in range(BULK // len(chunk)):
+                    await stream.write_all(chunk)
+
+            sender = asyncio.ensure_future(send())
+            received = 0
+            while received < BULK:
+                received += len(await stream.read(1024 * 1024))
+            await sender
+
+    async def timed(coro):
+        begin = time.perf_counter()
+        await coro
+        return time.perf_counter() - begin
+
+    async def main():
+        upstream = AsyncTcpListener("127.0.0.1", 0)
+        await upstream.start(echo)
+        proxy = FaultProxy(*upstream.local_addr)
+        _, port = await proxy.start()
+
+        cost = await timed(asyncio.gather(*(client(port) for _ in range(CLIENTS))))
+        print("{} concurrent clients x {} round trips through proxy: {:.0f} req/s".format(
+            CLIENTS, ROUNDS, CLIENTS * ROUNDS / cost))
+        cost = await timed(bulk(port))
+        print("bulk echo {}MB through proxy: {:.0f}MB/s".format(BULK // 1024 // 1024, BULK / cost / 1024 / 1024))
+
+        proxy.faults = Faults(latency=0.05)
+        cost = await timed(client(port))
+        print("latency 50ms each way: {:.0f}ms per round trip".format(cost / ROUNDS * 1000))
+
+        proxy.faults = Faults.speed("edge", fragment=512)
+        begin = time.perf_counter()
+        async with await AsyncTcpStream.connect("127.0.0.1", port) as stream:
+            await stream.write_all(b"y" * 32 * 1024)
+            await stream.readexactly(32 * 1024)
+        print("edge 32KB echo: {:.2f}s".format(time.perf_counter() - begin))
+
+        proxy.faults = Faults()
+        proxy.add_rule(lambda conn: conn.id % 2 == 0, Faults(reset_after=1))
+        results = await asyncio.gather(*(client(port, 1) for _ in range(10)), return_exceptions=True)
+        print("reset rule: {} of 10 connections failed, {}".format(
+            sum(isinstance(r, Exception) for r in results), proxy.metrics()))
+
+        await proxy.close()
+        await upstream.close()
+
+    asyncio.run(main())
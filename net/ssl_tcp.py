@@ -1,9 +1,13 @@
+import logging
+import selectors
 import socket
 import ssl
+import time
+from collections import deque
 from ssl import SSLContext
 
 from httpclient.strcutures import WithContext
-from net.tcp import TcpStream, SockLevel, SockOpt
+from net.tcp import TcpStream, TcpListener, SocketProfile
 
 
 def get_default_tls_for_server(cafile) -> SSLContext:
@@ -13,6 +17,28 @@ def get_default_tls_for_server(cafile) -> SSLContext:
     return tls
 
 
+def get_tls_for_server(certfile, keyfile=None, password=None, cafile=None, alpn_protocols=None,
+                       num_tickets=2) -> SSLContext:
+    """
+    TLSTcpServer使用的配置
+    :param certfile: 证书文件，可以使用tools.certificate.X509Cert生成自签名证书
+    :param keyfile: 私钥文件，为None时从certfile中读取
+    :param password: 私钥的密码
+    :param cafile: 校验客户端证书的CA，为None时不要求客户端证书
+    :param alpn_protocols: 支持的应用层协议，例如["h2", "http/1.1"]
+    :param num_tickets: TLS 1.3握手后发送的会话票据数量，客户端使用票据恢复会话，0表示不发送
+    :return:
+    """
+    tls = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH, cafile=cafile)
+    tls.load_cert_chain(certfile, keyfile, password)
+    if cafile is not None:
+        tls.verify_mode = ssl.CERT_REQUIRED
+    if alpn_protocols:
+        tls.set_alpn_protocols(alpn_protocols)
+    tls.num_tickets = num_tickets
+    return tls
+
+
 def get_default_tls_for_client() -> SSLContext:
     purpose = ssl.Purpose.SERVER_AUTH
     tls = ssl.create_default_context(purpose=purpose)
@@ -23,30 +49,361 @@ def get_default_tls_for_client() -> SSLContext:
 @WithContext
 class TlsStream(TcpStream):
     default_ssl_conf = get_default_tls_for_client()
+    # 握手和每个TLS记录都是单独的小包，关闭Nagle算法避免与延迟确认叠加产生40ms的等待
+    profile = SocketProfile(nodelay=True)
 
     @classmethod
-    def connect(cls, ip, port):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock = cls.default_ssl_conf.wrap_socket(sock)
-        sock.connect((ip, port))
+    def connect(cls, ip, port, timeout=None, context: SSLContext = None, server_hostname=None, session=None,
+                profile: SocketProfile = None):
+        """
+        :param ip:
+        :param port:
+        :param timeout: 连接和读写的超时时间
+        :param context: 默认使用default_ssl_conf
+        :param server_hostname: 用于SNI和证书校验的主机名，默认为ip
+        :param session: 之前连接的SSLSession，服务器支持时恢复会话，跳过完整握手
+        :param profile: socket选项，默认使用cls.profile
+        :return:
+        """
+        context = context or cls.default_ssl_conf
+        sock = (profile or cls.profile).apply(socket.create_connection((ip, port), timeout))
+        try:
+            sock = context.wrap_socket(sock, server_hostname=server_hostname or ip, session=session)
+        except Exception:
+            sock.close()
+            raise
         return cls(sock, ip)
 
+    def pending(self) -> int:
+        # 包括SSL层已经解密但是还没有读取的数据
+        return super().pending() + self._sock.pending()
+
+    @property
+    def alpn_protocol(self):
+        """
+        握手时协商的应用层协议，没有协商时为None
+        :return:
+        """
+        return self._sock.selected_alpn_protocol()
+
+    @property
+    def session(self):
+        return self._sock.session
+
+    @property
+    def session_reused(self) -> bool:
+        return self._sock.session_reused
+
+
+class _MeteredSocket:
+    """
+    统计TLS连接收发的明文字节数，其他属性转发给SSLSocket
+    """
+    __slots__ = ("sock", "received", "sent")
+
+    def __init__(self, sock: ssl.SSLSocket):
+        self.sock = sock
+        self.received = 0
+        self.sent = 0
+
+    def recv(self, bufsize, flags=0):
+        data = self.sock.recv(bufsize, flags)
+        self.received += len(data)
+        return data
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        n = self.sock.recv_into(buffer, nbytes, flags)
+        self.received += n
+        return n
+
+    def send(self, data, flags=0):
+        n = self.sock.send(data, flags)
+        self.sent += n
+        return n
+
+    def sendall(self, data, flags=0):
+        self.sock.sendall(data, flags)
+        self.sent += len(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class _Handshake:
+    """
+    非阻塞的服务端TLS握手，握手完成前连接不会交给handle
+    """
+    __slots__ = ("server", "sock", "addr", "started", "done")
+
+    def __init__(self, server, sock: ssl.SSLSocket, addr):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.started = time.monotonic()
+        self.done = False
+
+    def __call__(self, selector):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            selector.modify(self.sock, selectors.EVENT_READ, self)
+        except ssl.SSLWantWriteError:
+            selector.modify(self.sock, selectors.EVENT_WRITE, self)
+        except OSError as e:
+            self.server._handshake_failed(selector, self, e)
+        else:
+            self.server._handshake_done(selector, self)
+
+    def close(self):
+        self.done = True
+        self.sock.close()
+
 
 @WithContext
-class TLSTcpServer:
+class TLSTcpServer(TcpListener):
+    """
+    TLS服务器，serve_forever在selector中以非阻塞方式完成握手，握手期间不占用线程，
+    握手完成后的连接与TcpListener一样交给handle处理，handle的参数为TlsStream
+    会话票据和ALPN由context决定，参考get_tls_for_server
+
+    context = get_tls_for_server("server.pem", "server.key", alpn_protocols=["echo"])
+    server = TLSTcpServer(context, "0.0.0.0", 8443)
+    server.serve_forever(handle, workers=8)
+    """
+    profile = TlsStream.profile
 
-    def __init__(self, context: SSLContext):
+    def __init__(self, context: SSLContext, addr="0.0.0.0", ip=0, backlog=socket.SOMAXCONN, handshake_timeout=10.0,
+                 profile: SocketProfile = None):
+        """
+        :param context: 服务端SSLContext
+        :param addr: 监听的地址
+        :param ip: 监听的端口，0表示随机端口
+        :param backlog: 等待accept的连接队列长度
+        :param handshake_timeout: 握手超时时间，超时的连接会被关闭，None表示不限制
+        :param profile: 接受的连接使用的socket选项，默认关闭Nagle算法
+        """
+        super().__init__(addr, ip, backlog, profile)
         self.context = context
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock.setsockopt(SockLevel.SOL_SOCKET.value, SockOpt.SO_REUSEADDR.value, 1)
-        self._ssl_sock = self.context.wrap_socket(self._sock, server_side=True)
+        self.handshake_timeout = handshake_timeout
+        # 完成的握手数，其中恢复会话的握手数，失败或超时的握手数，握手总耗时(秒)
+        self.handshakes = 0
+        self.resumed = 0
+        self.handshake_errors = 0
+        self.handshake_time = 0.0
+        # 已经关闭的连接收发的明文字节数
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._started = time.monotonic()
+        self._handshaking = deque()
+        self._streams = set()
 
     def incoming(self, handle, disable_auto_close=False):
-        sock, ip = self._ssl_sock.accept()
+        """
+        依次处理请求，每个连接完成握手并处理完毕后再接受下一个连接
+        @handle: handle必须为callable对象，参数为TlsStream
+        @disable_auto_close: 为True时由handle负责关闭连接
+        """
+        self._started = time.monotonic()
         while True:
-            wrap_sock = self.context.wrap_socket(sock, server_side=False, server_hostname=ip)
+            sock, addr = self._sock.accept()
+            self.accepted += 1
+            started = time.monotonic()
+            self._apply_profile(sock)
+            sock.settimeout(self.handshake_timeout)
+            try:
+                sock = self.context.wrap_socket(sock, server_side=True)
+            except OSError as e:
+                sock.close()
+                self.handshake_errors += 1
+                logging.warning("TLS handshake with {} failed: {}".format(addr, e))
+                continue
+            sock.settimeout(None)
+            self._count_handshake(sock, started)
             if not disable_auto_close:
-                with TlsStream(wrap_sock, ip) as tls_client:
-                    handle(tls_client)
+                with TlsStream(sock, addr) as stream:
+                    handle(stream)
             else:
-                handle(wrap_sock, ip)
+                handle(TlsStream(sock, addr))
+
+    def serve_forever(self, handle, workers=0, poll_interval=0.5):
+        self._started = time.monotonic()
+        super().serve_forever(handle, workers, poll_interval)
+
+    def _register(self, selector, sock, addr):
+        sock.setblocking(False)
+        try:
+            sock = self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        except OSError as e:
+            sock.close()
+            self.handshake_errors += 1
+            logging.debug("TLS setup for {} failed: {}".format(addr, e))
+            return
+        handshake = _Handshake(self, sock, addr)
+        selector.register(sock, selectors.EVENT_READ, handshake)
+        self._handshaking.append(handshake)
+        # ClientHello通常已经到达，不用等待下一次select
+        handshake(selector)
+
+    def _handshake_done(self, selector, handshake: _Handshake):
+        handshake.done = True
+        sock = handshake.sock
+        sock.setblocking(True)
+        self._count_handshake(sock, handshake.started)
+        stream = TlsStream(_MeteredSocket(sock), handshake.addr)
+        selector.modify(sock, selectors.EVENT_READ, stream)
+        self._streams.add(stream)
+        self.connections += 1
+
+    def _handshake_failed(self, selector, handshake: _Handshake, error):
+        try:
+            selector.unregister(handshake.sock)
+        except (KeyError, ValueError):
+            pass
+        handshake.close()
+        self.handshake_errors += 1
+        logging.debug("TLS handshake with {} failed: {}".format(handshake.addr, error))
+
+    def _count_handshake(self, sock: ssl.SSLSocket, started):
+        self.handshakes += 1
+        self.handshake_time += time.monotonic() - started
+        if sock.session_reused:
+            self.resumed += 1
+
+    def _housekeeping(self, selector):
+        # 握手按开始时间排队，只需要检查队首
+        now = time.monotonic()
+        queue = self._handshaking
+        while queue:
+            handshake = queue[0]
+            if not handshake.done and (self.handshake_timeout is None
+                                       or now - handshake.started < self.handshake_timeout):
+                break
+            queue.popleft()
+            if not handshake.done:
+                self._handshake_failed(selector, handshake, "timeout")
+
+    @staticmethod
+    def _peer_closed(stream) -> bool:
+        if stream.pending():
+            return False
+        try:
+            # SSLSocket.recv不支持flags，直接查看底层的TCP连接
+            return socket.socket.recv(stream._sock.sock, 1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True
+
+    def _release(self, stream):
+        super()._release(stream)
+        self._streams.discard(stream)
+        self.bytes_received += stream._sock.received
+        self.bytes_sent += stream._sock.sent
+
+    def metrics(self) -> dict:
+        """
+        服务器统计，速率按serve_forever开始后的时间计算
+            handshake_rate: 每秒完成的握手数
+            avg_handshake_ms: 平均握手耗时(从accept开始)
+            throughput: 每秒收发的明文字节数，包括当前保持的连接
+        :return:
+        """
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        live = list(self._streams)
+        received = self.bytes_received + sum(s._sock.received for s in live)
+        sent = self.bytes_sent + sum(s._sock.sent for s in live)
+        return {
+            "accepted": self.accepted,
+            "connections": self.connections,
+            "handshakes": self.handshakes,
+            "resumed": self.resumed,
+            "handshake_errors": self.handshake_errors,
+            "handshake_rate": self.handshakes / elapsed,
+            "avg_handshake_ms": self.handshake_time / self.handshakes * 1000 if self.handshakes else 0.0,
+            "bytes_received": received,
+            "bytes_sent": sent,
+            "throughput": (received + sent) / elapsed,
+        }
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    import threading
+
+    from net.pool import ConnectionPool
+    from tools.certificate import X509Cert, X509Name, X509SubjectAlternativeName, load_config
+
+    CONNECTIONS = 300
+    CHUNK = 64 * 1024
+    TOTAL = 256 * 1024 * 1024
+
+    # 使用X509Cert生成localhost的自签名证书
+    config = load_config()
+    config.set("X509Name", "common_name", "localhost")
+    config.set("AlternativeName", "dns", '["localhost"]')
+    key = X509Cert.generate_private_key(2048)
+    cert = X509Cert.generate_self_signed(key, X509Name(config), X509SubjectAlternativeName(config),
+                                         ip_addresses=["127.0.0.1"])
+    directory = tempfile.mkdtemp()
+    cert_file, key_file = os.path.join(directory, "server.pem"), os.path.join(directory, "server.key")
+    X509Cert.save_cert_file(cert_file, cert)
+    X509Cert.save_private_key(key_file, key)
+
+    def echo(stream: TlsStream):
+        data = stream.read(CHUNK)
+        if data:
+            stream.write_all(data)
+
+    server = TLSTcpServer(get_tls_for_server(cert_file, key_file, alpn_protocols=["echo"]), "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, args=(echo,), daemon=True).start()
+    host, port = server.local_addr
+    client_tls = ssl.create_default_context(cafile=cert_file)
+    client_tls.set_alpn_protocols(["echo"])
+
+    def ping(stream):
+        stream.write_all(b"ping")
+        # TLS 1.3的会话票据在握手之后到达，读取响应时处理
+        assert stream.readexactly(4) == b"ping"
+
+    def bench(name, connect):
+        begin = time.perf_counter()
+        for _ in range(CONNECTIONS):
+            connect()
+        cost = time.perf_counter() - begin
+        print("{:<24} {:>7.0f} conn/s".format(name, CONNECTIONS / cost))
+
+    def full_handshake():
+        with TlsStream.connect(host, port, context=client_tls, server_hostname="localhost") as stream:
+            assert stream.alpn_protocol == "echo"
+            ping(stream)
+
+    pool = ConnectionPool()
+
+    def resumed_handshake():
+        # 每次新建连接，使用连接池保存的会话
+        stream = pool.acquire(host, port, client_tls, "localhost")
+        ping(stream)
+        pool.release(stream, reuse=False)
+
+    def pooled():
+        with pool.connection(host, port, client_tls, "localhost") as stream:
+            ping(stream)
+
+    bench("full handshake", full_handshake)
+    bench("resumed handshake", resumed_handshake)
+    bench("pooled connection", pooled)
+    print(pool.stats)
+
+    payload = os.urandom(CHUNK)
+    with TlsStream.connect(host, port, context=client_tls, server_hostname="localhost") as stream:
+        begin = time.perf_counter()
+        for _ in range(TOTAL // CHUNK):
+            stream.write_all(payload)
+            stream.readexactly(CHUNK)
+        cost = time.perf_counter() - begin
+    print("echo {}MB: {:.0f}MB/s".format(TOTAL // 1024 // 1024, TOTAL / cost / 1024 / 1024))
+    pool.close()
+    for name, value in server.metrics().items():
+        print("  {:<18} {:.1f}".format(name, value))
+    server.close()
@@ -1,8 +1,22 @@
+import logging
+import os
+import selectors
 import socket
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 from httpclient.strcutures import WithContext
 
+# serve_forever中用于唤醒selector的socket
+_WAKEUP = object()
+# sendmsg一次最多发送的缓冲区数量
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
 
 class MsgFlag(Enum):
     # 告诉内核，目标主机在本地网络，不用查路由表
@@ -47,15 +61,138 @@ class SockOpt(Enum):
     # 指定发送缓冲区大小
     SO_SNDBUF = socket.SO_SNDBUF
     # 禁止发送合并的Nagle算法。
+    # 注意：Linux上TCP_NODELAY与SO_DEBUG的值都是1，在Enum中是SO_DEBUG的别名，需要与SockLevel.IPPROTO_TCP一起使用
     TCP_NODELAY = socket.TCP_NODELAY
 
 
+class SocketProfile:
+    """
+    声明式的socket选项，TcpStream，TcpListener和net.aio中的异步连接都使用它设置新连接
+    值为None的选项不设置，当前平台不支持的选项会被忽略
+
+    profile = SocketProfile(nodelay=True, keepalive=True, keepidle=60, rcvbuf=256 * 1024)
+    stream = TcpStream.connect("127.0.0.1", 9000, profile=profile)
+    """
+
+    def __init__(self, nodelay=None, keepalive=None, keepidle=None, keepintvl=None, keepcnt=None,
+                 rcvbuf=None, sndbuf=None, linger=None, options=()):
+        """
+        :param nodelay: 是否禁止Nagle算法
+        :param keepalive: 是否发送保持活动的包
+        :param keepidle: 连接空闲多少秒后开始发送保持活动的包
+        :param keepintvl: 保持活动的包的发送间隔(秒)
+        :param keepcnt: 没有响应多少次后认为连接已经断开
+        :param rcvbuf: 接收缓冲区大小
+        :param sndbuf: 发送缓冲区大小
+        :param linger: 关闭时等待未发送数据的秒数，0表示直接丢弃并发送RST
+        :param options: 其他选项，(level, option, value)列表
+        """
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.keepidle = keepidle
+        self.keepintvl = keepintvl
+        self.keepcnt = keepcnt
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.linger = linger
+        self.extra = list(options)
+
+    def options(self) -> list:
+        """
+        需要设置的(level, option, value)列表
+        :return:
+        """
+        sol, tcp = SockLevel.SOL_SOCKET.value, SockLevel.IPPROTO_TCP.value
+        options = []
+        if self.nodelay is not None:
+            options.append((tcp, socket.TCP_NODELAY, int(self.nodelay)))
+        if self.keepalive is not None:
+            options.append((sol, SockOpt.SO_KEEPALIVE.value, int(self.keepalive)))
+        # macOS上空闲时间的选项为TCP_KEEPALIVE
+        for name, value in (("TCP_KEEPIDLE", self.keepidle), ("TCP_KEEPINTVL", self.keepintvl),
+                            ("TCP_KEEPCNT", self.keepcnt)):
+            if value is None:
+                continue
+            option = getattr(socket, name, None)
+            if option is None and name == "TCP_KEEPIDLE":
+                option = getattr(socket, "TCP_KEEPALIVE", None)
+            if option is not None:
+                options.append((tcp, option, value))
+        if self.rcvbuf is not None:
+            options.append((sol, SockOpt.SO_RCVBUF.value, self.rcvbuf))
+        if self.sndbuf is not None:
+            options.append((sol, SockOpt.SO_SNDBUF.value, self.sndbuf))
+        if self.linger is not None:
+            options.append((sol, SockOpt.SO_LINGER.value, struct.pack("ii", 1, self.linger)))
+        options.extend(self.extra)
+        return options
+
+    def apply(self, sock):
+        """
+        设置socket选项，sock可以是socket，SSLSocket或者asyncio传输层的socket
+        :param sock:
+        :return: sock
+        """
+        for level, option, value in self.options():
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as e:
+                logging.debug("setsockopt({}, {}, {!r}) failed: {}".format(level, option, value, e))
+        return sock
+
+    def __repr__(self):
+        attrs = ("nodelay", "keepalive", "keepidle", "keepintvl", "keepcnt", "rcvbuf", "sndbuf", "linger")
+        return "SocketProfile({})".format(", ".join(
+            "{}={!r}".format(attr, getattr(self, attr)) for attr in attrs if getattr(self, attr) is not None))
+
+
 @WithContext
 class TcpStream:
+    """
+    TCP连接，读取时使用预先分配的缓冲区
+    readexactly和readuntil一次从socket读取尽可能多的数据放入缓冲区，后续的读取直接从缓冲区取出，
+    大于缓冲区的数据直接recv_into到结果中，不会产生多余的复制，缓冲区在第一次需要时才分配
+    """
+    # 默认的读缓冲区大小
+    buffer_size = 64 * 1024
+    # writev中总长度不超过该值时拼接后发送
+    coalesce_size = 16 * 1024
+    # connect默认使用的socket选项
+    profile: SocketProfile = None
 
-    def __init__(self, sock: socket.socket, addr):
+    def __init__(self, sock: socket.socket, addr, buffer_size=None):
+        """
+        :param sock:
+        :param addr:
+        :param buffer_size: 读缓冲区大小，默认使用TcpStream.buffer_size
+        """
         self._sock = sock
         self._addr = addr
+        if buffer_size is not None:
+            self.buffer_size = buffer_size
+        self._buf = None
+        self._view = None
+        # 缓冲区中未读取的数据为 _buf[_start:_end]
+        self._start = 0
+        self._end = 0
+
+    @property
+    def addr(self):
+        return self._addr
+
+    @property
+    def closed(self) -> bool:
+        return self._sock.fileno() == -1
+
+    def fileno(self) -> int:
+        return self._sock.fileno()
+
+    def pending(self) -> int:
+        """
+        缓冲区中还没有读取的字节数
+        :return:
+        """
+        return self._end - self._start
 
     def write_all(self, data):
         # C语言实现，在发送循环中会释放GIL，python其他线程在发生数据完成前不会竞争资源
@@ -65,6 +202,37 @@ class TcpStream:
         #   byte_sent += sock.send(message_remaining)
         self._sock.sendall(data)
 
+    def writev(self, buffers) -> int:
+        """
+        一次系统调用发送多个缓冲区，例如消息头和消息体
+        总长度不超过coalesce_size时拼接后发送，小数据复制的开销比sendmsg处理多个缓冲区更小，
+        否则使用sendmsg直接发送各个缓冲区，大的消息体不会被复制，不支持sendmsg的socket(例如TLS)拼接后发送
+        :param buffers: bytes，bytearray，memoryview列表
+        :return: 发送的字节数
+        """
+        total = sum(len(b) for b in buffers)
+        if total <= self.coalesce_size:
+            self._sock.sendall(b"".join(buffers))
+            return total
+        views = [memoryview(b) for b in buffers if len(b)]
+        i = 0
+        while i < len(views):
+            try:
+                sent = self._sock.sendmsg(views[i:i + IOV_MAX])
+            except NotImplementedError:
+                self._sock.sendall(b"".join(views[i:]))
+                break
+            # 部分发送时跳过已经发送的缓冲区
+            while sent:
+                size = views[i].nbytes
+                if sent >= size:
+                    sent -= size
+                    i += 1
+                else:
+                    views[i] = views[i].cast("B")[sent:]
+                    sent = 0
+        return total
+
     def write(self, data, flags: MsgFlag) -> int:
         # 在发送数据时会碰到以下3种情况
         # 1. 网卡正好空闲，缓冲区未满，send会立即返回的是整个数据的长度
@@ -72,33 +240,183 @@ class TcpStream:
         # 3. 发送缓冲区快满了，但有一定空间，发生的部分数据进入发送缓冲区等待发送，剩余数据必须等待，send会返回发送的部分数据长度
         return self._sock.send(data, flags.value if flags else 0)
 
-    def read(self, buff_len, flags: MsgFlag) -> bytes:
+    def read(self, buff_len, flags: MsgFlag = None) -> bytes:
+        """
+        读取最多buff_len个字节，缓冲区中有数据时直接从缓冲区返回
+        :param buff_len:
+        :param flags:
+        :return:
+        """
+        if self._start < self._end:
+            end = min(self._end, self._start + buff_len)
+            data = bytes(self._view[self._start:end])
+            if not (flags and flags.value & socket.MSG_PEEK):
+                self._consume(end - self._start)
+            return data
         return self._sock.recv(buff_len, flags.value if flags else 0)
 
-    def read_len(self, length, flags: MsgFlag) -> bytes:
-        data = b''
-        while len(data) < length:
-            more = self._sock.recv(length - len(data), flags.value if flags else 0)
-            if not more:
+    def read_len(self, length, flags: MsgFlag = None) -> bytes:
+        if flags:
+            return self.readexactly(length, flags.value)
+        return self.readexactly(length)
+
+    def recv_into(self, buffer, nbytes=0) -> int:
+        """
+        读取数据到buffer中，缓冲区中有数据时直接从缓冲区复制
+        :param buffer: bytearray，memoryview等可写的缓冲区
+        :param nbytes: 最多读取的字节数，0表示buffer的大小
+        :return: 读取的字节数，0表示连接已经关闭
+        """
+        view = memoryview(buffer).cast("B")
+        if nbytes:
+            view = view[:nbytes]
+        if self._start < self._end:
+            return self._take(view)
+        return self._sock.recv_into(view)
+
+    def readexactly_into(self, buffer, flags=0) -> int:
+        """
+        读取len(buffer)个字节到buffer中，可以重复使用同一个buffer接收多个消息
+        :param buffer: bytearray，memoryview等可写的缓冲区
+        :param flags:
+        :return: 读取的字节数
+        """
+        view = memoryview(buffer).cast("B")
+        length = len(view)
+        pos = self._take(view)
+        while pos < length:
+            remaining = length - pos
+            if remaining >= self.buffer_size:
+                # 大块数据直接读到结果中
+                n = self._sock.recv_into(view[pos:], remaining, flags)
+            else:
+                n = self._fill(flags)
+                if n:
+                    n = self._take(view[pos:])
+            if not n:
+                raise EOFError(
+                    f"was except {length} bytes buf only received {pos} bytes before the socket closed")
+            pos += n
+        return pos
+
+    def readexactly(self, length, flags=0) -> bytes:
+        """
+        读取length个字节，连接在读取完毕前关闭时抛出EOFError
+        :param length:
+        :param flags:
+        :return:
+        """
+        if self._view is not None and length <= self._end - self._start:
+            data = bytes(self._view[self._start:self._start + length])
+            self._consume(length)
+            return data
+        result = bytearray(length)
+        self.readexactly_into(result, flags)
+        return bytes(result)
+
+    def readuntil(self, delimiter=b"\n", limit=None) -> bytes:
+        """
+        读取到delimiter为止，返回的数据包括delimiter
+        :param delimiter: 分隔符
+        :param limit: 最多读取的字节数，默认为缓冲区大小，超过时抛出ValueError
+        :return:
+        """
+        limit = limit or self.buffer_size
+        self._ensure_buffer(min(self.buffer_size, limit + len(delimiter)))
+        # 已经查找过的字节数，相对于_start
+        offset = 0
+        while True:
+            index = self._buf.find(delimiter, self._start + offset, self._end)
+            if index >= 0:
+                end = index + len(delimiter)
+                data = bytes(self._view[self._start:end])
+                self._consume(end - self._start)
+                return data
+            pending = self._end - self._start
+            if pending >= limit:
+                raise ValueError("delimiter {!r} not found in {} bytes".format(delimiter, limit))
+            # 分隔符可能跨越两次读取，下一次从最后len(delimiter) - 1个字节开始查找
+            offset = max(0, pending - len(delimiter) + 1)
+            if pending == len(self._buf):
+                # 缓冲区已满，按需扩大，最多到limit
+                self._ensure_buffer(min(len(self._buf) * 2, limit + len(delimiter)))
+            if not self._fill():
                 raise EOFError(
-                    f"was except {length} bytes buf only received {len(data)} bytes before the socket closed")
-            data += more
-        return data
+                    f"connection closed before {delimiter!r}, {pending} bytes received")
+
+    def _ensure_buffer(self, size):
+        if self._buf is None or len(self._buf) < size:
+            buf = bytearray(max(size, self.buffer_size))
+            if self._buf is not None:
+                pending = self._end - self._start
+                buf[:pending] = self._view[self._start:self._end]
+                self._start, self._end = 0, pending
+            self._buf = buf
+            self._view = memoryview(buf)
+
+    def _fill(self, flags=0) -> int:
+        """
+        从socket读取数据追加到缓冲区，返回读取的字节数
+        """
+        self._ensure_buffer(self.buffer_size)
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buf):
+            # 未读数据移动到缓冲区开头
+            pending = self._end - self._start
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+        n = self._sock.recv_into(self._view[self._end:], 0, flags)
+        self._end += n
+        return n
+
+    def _take(self, view) -> int:
+        n = min(len(view), self._end - self._start)
+        if n:
+            view[:n] = self._view[self._start:self._start + n]
+            self._consume(n)
+        return n
+
+    def _consume(self, n):
+        self._start += n
+        if self._start == self._end:
+            self._start = self._end = 0
 
     @classmethod
-    def connect(cls, ip, port):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((ip, port))
+    def connect(cls, ip, port, timeout=None, profile: SocketProfile = None):
+        """
+        :param ip:
+        :param port:
+        :param timeout: 连接和读写的超时时间，None表示一直阻塞
+        :param profile: socket选项，默认使用cls.profile
+        :return:
+        """
+        sock = socket.create_connection((ip, port), timeout)
+        profile = profile or cls.profile
+        if profile is not None:
+            profile.apply(sock)
         return cls(sock, ip)
 
     def close(self):
         self._sock.close()
+        self._buf = self._view = None
+        self._start = self._end = 0
 
 
 @WithContext
 class TcpListener:
+    # 接受的连接默认使用的socket选项
+    profile: SocketProfile = None
 
-    def __init__(self, addr: str, ip: int):
+    def __init__(self, addr: str, ip: int, backlog=socket.SOMAXCONN, profile: SocketProfile = None):
+        """
+        :param addr: 监听的地址
+        :param ip: 监听的端口，0表示随机端口
+        :param backlog: 等待accept的连接队列长度
+        :param profile: 接受的连接使用的socket选项，默认使用TcpListener.profile
+        """
+        if profile is not None:
+            self.profile = profile
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # TCP_NODELAY选项禁止Nagle算法
         # Nagle算法通过将未确认的数据存入缓冲区直到蓄足一个包一起发送的方法，来减少主机发送的零碎小数据包的数目
@@ -106,20 +424,253 @@ class TcpListener:
         # 应用程序认为某个TCO链接关闭了，网络栈会在一个等待状态中将该记录保持4分钟，RFC称为CLOSE-WAIT和TIME-WAIT
         self._sock.setsockopt(SockLevel.SOL_SOCKET.value, SockOpt.SO_REUSEADDR.value, int(True))
         self._sock.bind((addr, ip))
+        self._sock.listen(backlog)
+        self._wakeup = None
+        self._serving = False
+        # serve_forever中当前保持的连接数和累计接受的连接数
+        self.connections = 0
+        self.accepted = 0
+
+    @property
+    def local_addr(self):
+        return self._sock.getsockname()
 
     def incoming(self, handle, disable_auto_close=False):
         """
-        处理请求
+        依次处理请求，每个连接处理完毕后再接受下一个连接
         @handle: handle必须为callable对象
         @disable_auto_close: 如果为True将会采用With语句进行管理客户端socket
         """
-        sock, addr = self._sock.accept()
         while True:
+            sock, addr = self._sock.accept()
+            self._apply_profile(sock)
             if not disable_auto_close:
                 with TcpStream(sock, addr) as stream:
                     handle(stream)
             else:
                 handle(TcpStream(sock, addr))
 
+    def serve_forever(self, handle, workers=0, poll_interval=0.5):
+        """
+        使用selectors(Linux上为epoll)同时处理多个连接
+        连接有数据可读时调用handle(stream)，handle每次处理一个请求后返回，连接继续保持，
+        handle关闭stream或者返回False时关闭连接，对端关闭连接时自动关闭，不会调用handle
+        workers为0时handle在当前线程中执行，只能读取已经到达的数据，不能阻塞，
+        workers大于0时handle在线程池中执行，适合会阻塞的handle，同一个连接同一时间只会有一个handle在执行
+        调用shutdown停止
+        :param handle: 处理函数，参数为TcpStream
+        :param workers: 线程池大小
+        :param poll_interval: 检查是否停止的间隔
+        :return:
+        """
+        selector = selectors.DefaultSelector()
+        wakeup_r, self._wakeup = socket.socketpair()
+        wakeup_r.setblocking(False)
+        self._sock.setblocking(False)
+        selector.register(self._sock, selectors.EVENT_READ)
+        selector.register(wakeup_r, selectors.EVENT_READ, _WAKEUP)
+        pool = ThreadPoolExecutor(workers, thread_name_prefix="tcp-handler") if workers else None
+        finished = deque()
+        self._serving = True
+        try:
+            while self._serving:
+                for key, _ in selector.select(poll_interval):
+                    if key.data is None:
+                        self._accept(selector)
+                    elif key.data is _WAKEUP:
+                        self._drain(wakeup_r)
+                    elif callable(key.data):
+                        # 还没有完成的连接准备工作，例如TLS握手
+                        key.data(selector)
+                    elif self._peer_closed(key.data):
+                        self._close(selector, key.data)
+                    elif pool is None:
+                        if not self._handle(handle, key.data):
+                            self._close(selector, key.data)
+                    else:
+                        # 处理完毕前不再监听该连接
+                        selector.unregister(key.fileobj)
+                        pool.submit(self._handle_in_pool, handle, key.data, finished)
+                while finished:
+                    stream, keep = finished.popleft()
+                    if keep:
+                        selector.register(stream, selectors.EVENT_READ, stream)
+                    else:
+                        self._release(stream)
+                self._housekeeping(selector)
+        finally:
+            self._serving = False
+            if pool is not None:
+                pool.shutdown(wait=True)
+            for stream, _ in finished:
+                self._release(stream)
+            for key in list(selector.get_map().values()):
+                if isinstance(key.data, TcpStream):
+                    self._close(selector, key.data)
+                elif callable(key.data):
+                    key.data.close()
+            selector.close()
+            wakeup_r.close()
+            self._wakeup.close()
+            self._wakeup = None
+            if self._sock.fileno() != -1:
+                self._sock.setblocking(True)
+
+    def shutdown(self):
+        """
+        停止serve_forever，可以在其他线程或者handle中调用
+        :return:
+        """
+        self._serving = False
+        self._wake()
+
+    def _accept(self, selector):
+        # 一次取出所有等待的连接
+        while True:
+            try:
+                sock, addr = self._sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # 文件描述符耗尽等错误，等待下一次可读
+                logging.warning("accept failed: {}".format(e))
+                return
+            self.accepted += 1
+            self._apply_profile(sock)
+            self._register(selector, sock, addr)
+
+    def _apply_profile(self, sock):
+        if self.profile is not None:
+            self.profile.apply(sock)
+
+    def _register(self, selector, sock, addr):
+        """
+        新连接加入selector，子类可以先注册一个callable完成握手等准备工作，
+        callable在连接可读写时以selector为参数调用，serve_forever停止时调用它的close
+        """
+        sock.setblocking(True)
+        stream = TcpStream(sock, addr)
+        selector.register(stream, selectors.EVENT_READ, stream)
+        self.connections += 1
+
+    def _housekeeping(self, selector):
+        """
+        serve_forever每次循环调用一次，子类用于处理超时等
+        """
+
+    @staticmethod
+    def _drain(sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    @staticmethod
+    def _peer_closed(stream) -> bool:
+        if stream.pending():
+            return False
+        try:
+            return stream._sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True
+
+    @staticmethod
+    def _handle(handle, stream) -> bool:
+        # 缓冲区中还有数据(例如客户端连续发送了多个请求)时继续处理，selector不会再通知这些数据
+        while True:
+            try:
+                keep = handle(stream) is not False
+            except Exception:
+                logging.exception("handler error, closing connection from {}".format(stream.addr))
+                return False
+            if not keep or stream.closed:
+                return False
+            if not stream.pending():
+                return True
+
+    def _handle_in_pool(self, handle, stream, finished):
+        finished.append((stream, self._handle(handle, stream)))
+        self._wake()
+
+    def _wake(self):
+        wakeup = self._wakeup
+        if wakeup is not None:
+            try:
+                wakeup.send(b"\0")
+            except OSError:
+                pass
+
+    def _close(self, selector, stream):
+        try:
+            selector.unregister(stream)
+        except (KeyError, ValueError):
+            pass
+        self._release(stream)
+
+    def _release(self, stream):
+        stream.close()
+        self.connections -= 1
+
     def close(self):
+        self.shutdown()
         self._sock.close()
+
+
+if __name__ == '__main__':
+    import threading
+    import time
+
+    CLIENTS = 2000
+
+    def echo(stream: TcpStream):
+        data = stream.read(4096, None)
+        stream.write_all(data)
+
+    listener = TcpListener("127.0.0.1", 0)
+    server = threading.Thread(target=listener.serve_forever, args=(echo,), daemon=True)
+    server.start()
+    host, port = listener.local_addr
+
+    start = time.perf_counter()
+    clients = [TcpStream.connect(host, port) for _ in range(CLIENTS)]
+    for i, client in enumerate(clients):
+        client.write_all("ping {}".format(i).encode())
+    for i, client in enumerate(clients):
+        assert client.read(4096, None) == "ping {}".format(i).encode()
+    print("{} concurrent connections served in {:.0f}ms, open connections: {}".format(
+        CLIENTS, (time.perf_counter() - start) * 1000, listener.connections))
+    for client in clients:
+        client.close()
+    listener.close()
+    server.join()
+
+    # 读取大帧：逐块拼接 vs 预分配缓冲区
+    FRAME = 8 * 1024 * 1024
+    FRAMES = 8
+    payload = b"x" * FRAME
+
+    def reader(read):
+        left, right = socket.socketpair()
+        writer = threading.Thread(target=lambda: [left.sendall(payload) for _ in range(FRAMES)])
+        writer.start()
+        stream = TcpStream(right, "socketpair")
+        begin = time.perf_counter()
+        for _ in range(FRAMES):
+            assert len(read(stream)) == FRAME
+        cost = time.perf_counter() - begin
+        writer.join()
+        left.close()
+        stream.close()
+        return FRAMES * FRAME / cost / 1024 / 1024
+
+    def concat(stream):
+        data = b""
+        while len(data) < FRAME:
+            data += stream._sock.recv(FRAME - len(data))
+        return data
+
+    print("read {} x {}MB frames: concat {:.0f}MB/s, readexactly {:.0f}MB/s".format(
+        FRAMES, FRAME // 1024 // 1024, reader(concat), reader(lambda stream: stream.readexactly(FRAME))))
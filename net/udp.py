@@ -0,0 +1,522 @@
+"""
+
+server = UdpEndpoint.bind("127.0.0.1", 8125)
+for data, addr in server.recv_batch(timeout=1):
+    print(bytes(data), addr)
+
+client = UdpEndpoint.connect("127.0.0.1", 8125)
+client.send_batch([b"requests:1|c", b"latency:12|ms"])
+"""
+import errno
+import logging
+import os
+import selectors
+import socket
+import struct
+import time
+
+from httpclient.strcutures import WithContext
+from net.tcp import SocketProfile
+
+try:
+    import ctypes
+    import ctypes.util
+
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _recvmmsg = _libc.recvmmsg
+    _sendmmsg = _libc.sendmmsg
+except (ImportError, OSError, AttributeError, TypeError):
+    # 非Linux平台没有recvmmsg/sendmmsg，使用逐个收发的循环
+    ctypes = None
+    _recvmmsg = _sendmmsg = None
+
+if ctypes is not None:
+    class _IoVec(ctypes.Structure):
+        _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+    class _MsgHdr(ctypes.Structure):
+        _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                    ("msg_iov", ctypes.POINTER(_IoVec)), ("msg_iovlen", ctypes.c_size_t),
+                    ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                    ("msg_flags", ctypes.c_int)]
+
+    class _MMsgHdr(ctypes.Structure):
+        _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+
+    # 直接读写mmsghdr数组的内存，比逐个访问ctypes字段快得多
+    _MMSG_SIZE = ctypes.sizeof(_MMsgHdr)
+    _NAMELEN_OFFSET = _MsgHdr.msg_namelen.offset
+    _FLAGS_OFFSET = _MsgHdr.msg_flags.offset
+    _LEN_OFFSET = _MMsgHdr.msg_len.offset
+    # (msg_namelen, msg_flags, msg_len)
+    _MMSG_FIELDS = struct.Struct("={}xI{}xi{}xI{}x".format(
+        _NAMELEN_OFFSET, _FLAGS_OFFSET - _NAMELEN_OFFSET - 4, _LEN_OFFSET - _FLAGS_OFFSET - 4,
+        _MMSG_SIZE - _LEN_OFFSET - 4))
+    _UINT32 = struct.Struct("=I")
+    _IOV_SIZE = ctypes.sizeof(_IoVec)
+    _IOV_LEN_OFFSET = _IoVec.iov_len.offset
+    _SIZE_T = struct.Struct("@N")
+
+# sockaddr_storage的大小
+_SOCKADDR_SIZE = 128
+_FAMILY = struct.Struct("=H")
+_PORT = struct.Struct("!H")
+
+
+def _decode_addr(raw: bytes, length):
+    family, = _FAMILY.unpack_from(raw)
+    port, = _PORT.unpack_from(raw, 2)
+    if family == socket.AF_INET:
+        return socket.inet_ntop(socket.AF_INET, raw[4:8]), port
+    if family == socket.AF_INET6 and length >= 28:
+        flowinfo, = struct.unpack_from("!I", raw, 4)
+        scope_id, = struct.unpack_from("=I", raw, 24)
+        return socket.inet_ntop(socket.AF_INET6, raw[8:24]), port, flowinfo, scope_id
+    return None
+
+
+def _encode_addr(addr) -> bytes:
+    """
+    (ip, port)编码为sockaddr_in或sockaddr_in6，ip不是IP地址时抛出OSError
+    """
+    host, port = addr[0], addr[1]
+    if ":" in host:
+        flowinfo = addr[2] if len(addr) > 2 else 0
+        scope_id = addr[3] if len(addr) > 3 else 0
+        return (_FAMILY.pack(socket.AF_INET6) + _PORT.pack(port) + struct.pack("!I", flowinfo)
+                + socket.inet_pton(socket.AF_INET6, host) + struct.pack("=I", scope_id))
+    return _FAMILY.pack(socket.AF_INET) + _PORT.pack(port) + socket.inet_pton(socket.AF_INET, host) + bytes(8)
+
+
+class UdpStats:
+    """
+    UDP统计
+        received/received_bytes: 接收的数据报数量和字节数
+        sent/sent_bytes: 发送的数据报数量和字节数
+        truncated: 超过max_size被截断的数据报数量
+        recv_calls/send_calls: 接收和发送的系统调用次数，批量收发时远小于数据报数量
+    """
+    __slots__ = ("received", "received_bytes", "sent", "sent_bytes", "truncated", "recv_calls", "send_calls",
+                 "started")
+
+    def __init__(self):
+        self.received = 0
+        self.received_bytes = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.truncated = 0
+        self.recv_calls = 0
+        self.send_calls = 0
+        self.started = time.monotonic()
+
+    def as_dict(self) -> dict:
+        """
+        统计值，以及从创建开始计算的每秒接收数据报数和字节数
+        :return:
+        """
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        stats = {attr: getattr(self, attr) for attr in self.__slots__ if attr != "started"}
+        stats["recv_rate"] = self.received / elapsed
+        stats["recv_throughput"] = self.received_bytes / elapsed
+        return stats
+
+    def __repr__(self):
+        return "UdpStats({})".format(", ".join(
+            "{}={}".format(attr, getattr(self, attr)) for attr in self.__slots__ if attr != "started"))
+
+
+@WithContext
+class UdpEndpoint:
+    """
+    UDP端点，接收时一次系统调用读取多个数据报(Linux上使用recvmmsg，其他平台循环读取直到没有数据)，
+    数据报放在预先分配的缓冲区中，recv_batch返回的memoryview在下一次recv_batch之前有效，
+    send_batch在Linux上使用sendmmsg一次发送多个数据报
+    """
+
+    def __init__(self, sock: socket.socket, batch_size=64, max_size=8192, batched=True):
+        """
+        :param sock: UDP socket
+        :param batch_size: 一次最多接收或发送的数据报数量
+        :param max_size: 每个数据报的最大长度，超过的部分被截断
+        :param batched: 为False时不使用recvmmsg/sendmmsg
+        """
+        self._sock = sock
+        self._sock.setblocking(False)
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self.batched = batched and _recvmmsg is not None
+        self.stats = UdpStats()
+        self._buf = bytearray(batch_size * max_size)
+        self._view = memoryview(self._buf)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._sock, selectors.EVENT_READ)
+        self._serving = False
+        self._addr_cache = {}
+        if self.batched:
+            self._setup_mmsg()
+
+    def _setup_mmsg(self):
+        n = self.batch_size
+        base = ctypes.addressof(ctypes.c_char.from_buffer(self._buf))
+        self._names = ctypes.create_string_buffer(n * _SOCKADDR_SIZE)
+        names = ctypes.addressof(self._names)
+        self._recv_iov = (_IoVec * n)()
+        self._recv_msgs = (_MMsgHdr * n)()
+        for i in range(n):
+            self._recv_iov[i].iov_base = base + i * self.max_size
+            self._recv_iov[i].iov_len = self.max_size
+            hdr = self._recv_msgs[i].msg_hdr
+            hdr.msg_name = names + i * _SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self._recv_iov[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_namelen = _SOCKADDR_SIZE
+        self._recv_raw = memoryview(self._recv_msgs).cast("B")
+        # 每次接收前用初始状态覆盖msg_namelen和msg_flags
+        self._recv_template = bytes(self._recv_raw)
+        self._names_view = memoryview(self._names).cast("B")
+        self._addr_names = {}
+        # 发送时数据和地址复制到预先分配的缓冲区，避免为每个数据报创建ctypes对象
+        self._send_buf = bytearray(n * self.max_size)
+        self._send_view = memoryview(self._send_buf)
+        send_base = ctypes.addressof(ctypes.c_char.from_buffer(self._send_buf))
+        self._send_names = ctypes.create_string_buffer(n * _SOCKADDR_SIZE)
+        self._send_names_view = memoryview(self._send_names).cast("B")
+        send_names = ctypes.addressof(self._send_names)
+        self._send_iov = (_IoVec * n)()
+        self._send_msgs = (_MMsgHdr * n)()
+        for i in range(n):
+            self._send_iov[i].iov_base = send_base + i * self.max_size
+            hdr = self._send_msgs[i].msg_hdr
+            hdr.msg_name = send_names + i * _SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self._send_iov[i])
+            hdr.msg_iovlen = 1
+        self._send_raw = memoryview(self._send_msgs).cast("B")
+        self._send_iov_raw = memoryview(self._send_iov).cast("B")
+
+    @classmethod
+    def bind(cls, addr="0.0.0.0", port=0, profile: SocketProfile = None, **kwargs):
+        """
+        创建监听addr:port的端点，用于服务器
+        :param addr: 监听的地址
+        :param port: 0表示随机端口
+        :param profile: socket选项，例如SocketProfile(rcvbuf=4 * 1024 * 1024)
+        :param kwargs: batch_size，max_size，batched
+        :return:
+        """
+        sock = socket.socket(socket.AF_INET6 if ":" in addr else socket.AF_INET, socket.SOCK_DGRAM)
+        if profile is not None:
+            profile.apply(sock)
+        sock.bind((addr, port))
+        return cls(sock, **kwargs)
+
+    @classmethod
+    def connect(cls, host, port, profile: SocketProfile = None, **kwargs):
+        """
+        创建只与host:port通信的端点，用于客户端，发送时不需要指定地址
+        :param host:
+        :param port:
+        :param profile: socket选项，例如SocketProfile(sndbuf=4 * 1024 * 1024)
+        :param kwargs: batch_size，max_size，batched
+        :return:
+        """
+        family, _, _, _, sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        if profile is not None:
+            profile.apply(sock)
+        sock.connect(sockaddr)
+        return cls(sock, **kwargs)
+
+    @property
+    def local_addr(self):
+        return self._sock.getsockname()
+
+    @property
+    def closed(self) -> bool:
+        return self._sock.fileno() == -1
+
+    def fileno(self) -> int:
+        return self._sock.fileno()
+
+    def _wait(self, timeout) -> bool:
+        return bool(self._selector.select(timeout))
+
+    def recv_batch(self, timeout=None) -> list:
+        """
+        等待数据报到达，然后读取已经到达的数据报，最多batch_size个
+        :param timeout: 等待的最长时间，None表示一直等待，0表示不等待
+        :return: [(memoryview, 地址)]，memoryview在下一次recv_batch之前有效，需要保存时使用bytes(data)复制
+        """
+        if not self._wait(timeout):
+            return []
+        if self.batched:
+            return self._recv_mmsg()
+        return self._recv_loop()
+
+    def _recv_mmsg(self) -> list:
+        raw, n = self._recv_raw, self.batch_size
+        raw[:] = self._recv_template
+        count = _recvmmsg(self._sock.fileno(), self._recv_msgs, n, socket.MSG_DONTWAIT, None)
+        self.stats.recv_calls += 1
+        if count < 0:
+            code = ctypes.get_errno()
+            if code in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(code, os.strerror(code))
+        names, addrs, view, size = self._names_view, self._addr_names, self._view, self.max_size
+        result = []
+        received_bytes = 0
+        offset = 0
+        for i, (namelen, flags, length) in enumerate(_MMSG_FIELDS.iter_unpack(raw[:count * _MMSG_SIZE])):
+            if flags & socket.MSG_TRUNC:
+                self.stats.truncated += 1
+            name = bytes(names[i * _SOCKADDR_SIZE:i * _SOCKADDR_SIZE + namelen])
+            addr = addrs.get(name)
+            if addr is None:
+                if len(addrs) > 4096:
+                    addrs.clear()
+                addr = addrs[name] = _decode_addr(name, namelen) if namelen else None
+            result.append((view[offset:offset + length], addr))
+            received_bytes += length
+            offset += size
+        self.stats.received += count
+        self.stats.received_bytes += received_bytes
+        return result
+
+    def _recv_loop(self) -> list:
+        view, size = self._view, self.max_size
+        recvmsg_into = getattr(self._sock, "recvmsg_into", None)
+        result = []
+        for i in range(self.batch_size):
+            slot = view[i * size:(i + 1) * size]
+            try:
+                if recvmsg_into is not None:
+                    length, _, flags, addr = recvmsg_into([slot])
+                    if flags & socket.MSG_TRUNC:
+                        self.stats.truncated += 1
+                else:
+                    length, addr = self._sock.recvfrom_into(slot)
+            except (BlockingIOError, InterruptedError):
+                break
+            finally:
+                self.stats.recv_calls += 1
+            result.append((slot[:length], addr))
+            self.stats.received_bytes += length
+        self.stats.received += len(result)
+        return result
+
+    def recv(self, timeout=None):
+        """
+        接收一个数据报
+        :param timeout: 等待的最长时间，None表示一直等待，超时返回(None, None)
+        :return: (bytes, 地址)
+        """
+        if not self._wait(timeout):
+            return None, None
+        try:
+            data, addr = self._sock.recvfrom(self.max_size)
+        except (BlockingIOError, InterruptedError):
+            return None, None
+        self.stats.recv_calls += 1
+        self.stats.received += 1
+        self.stats.received_bytes += len(data)
+        return data, addr
+
+    def send(self, data, addr=None) -> int:
+        """
+        发送一个数据报，发送缓冲区满时等待
+        :param data:
+        :param addr: connect创建的端点不需要指定
+        :return: 发送的字节数
+        """
+        while True:
+            try:
+                n = self._sock.send(data) if addr is None else self._sock.sendto(data, addr)
+                break
+            except (BlockingIOError, InterruptedError):
+                self._wait_writable()
+        self.stats.send_calls += 1
+        self.stats.sent += 1
+        self.stats.sent_bytes += n
+        return n
+
+    def _wait_writable(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._sock, selectors.EVENT_WRITE)
+            selector.select()
+
+    def send_batch(self, datagrams) -> int:
+        """
+        批量发送数据报
+        :param datagrams: connect创建的端点为bytes列表，否则为(bytes, 地址)列表
+        :return: 发送的数据报数量
+        """
+        datagrams = list(datagrams)
+        if not datagrams:
+            return 0
+        connected = not isinstance(datagrams[0], tuple)
+        if not self.batched:
+            for item in datagrams:
+                if connected:
+                    self.send(item)
+                else:
+                    self.send(item[0], item[1])
+            return len(datagrams)
+        for start in range(0, len(datagrams), self.batch_size):
+            self._send_mmsg(datagrams[start:start + self.batch_size], connected)
+        return len(datagrams)
+
+    def _encode(self, addr):
+        encoded = self._addr_cache.get(addr)
+        if encoded is None:
+            if len(self._addr_cache) > 4096:
+                self._addr_cache.clear()
+            try:
+                encoded = _encode_addr(addr)
+            except OSError:
+                # 主机名需要解析，解析结果可能变化，不缓存
+                family, _, _, _, sockaddr = socket.getaddrinfo(addr[0], addr[1], type=socket.SOCK_DGRAM)[0]
+                return _encode_addr(sockaddr)
+            self._addr_cache[addr] = encoded
+        return encoded
+
+    def _send_mmsg(self, datagrams, connected):
+        raw, iov = self._send_raw, self._send_iov_raw
+        view, names, size = self._send_view, self._send_names_view, self.max_size
+        count = 0
+        for item in datagrams:
+            data, addr = (item, None) if connected else item
+            length = len(data)
+            if length > size:
+                # 超过预分配大小的数据报单独发送
+                self._flush_mmsg(count)
+                count = 0
+                self.send(data, addr)
+                continue
+            offset = count * size
+            view[offset:offset + length] = data
+            _SIZE_T.pack_into(iov, count * _IOV_SIZE + _IOV_LEN_OFFSET, length)
+            if addr is None:
+                _UINT32.pack_into(raw, count * _MMSG_SIZE + _NAMELEN_OFFSET, 0)
+            else:
+                encoded = self._encode(addr)
+                offset = count * _SOCKADDR_SIZE
+                names[offset:offset + len(encoded)] = encoded
+                _UINT32.pack_into(raw, count * _MMSG_SIZE + _NAMELEN_OFFSET, len(encoded))
+            self.stats.sent_bytes += length
+            count += 1
+        self._flush_mmsg(count)
+
+    def _flush_mmsg(self, total):
+        sent = 0
+        base = ctypes.addressof(self._send_msgs)
+        while sent < total:
+            pointer = ctypes.cast(base + sent * ctypes.sizeof(_MMsgHdr), ctypes.POINTER(_MMsgHdr))
+            count = _sendmmsg(self._sock.fileno(), pointer, total - sent, 0)
+            self.stats.send_calls += 1
+            if count < 0:
+                code = ctypes.get_errno()
+                if code in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._wait_writable()
+                    continue
+                if code == errno.EINTR:
+                    continue
+                raise OSError(code, os.strerror(code))
+            sent += count
+        self.stats.sent += total
+
+    def serve_forever(self, handle, poll_interval=0.5):
+        """
+        批量接收数据报并调用handle(data, addr)，handle返回bytes时作为响应发回，
+        同一批的响应通过send_batch一起发送，调用shutdown停止
+        :param handle: 处理函数，data为memoryview，只在handle中有效
+        :param poll_interval: 检查是否停止的间隔
+        :return:
+        """
+        self._serving = True
+        while self._serving:
+            replies = []
+            for data, addr in self.recv_batch(poll_interval):
+                try:
+                    reply = handle(data, addr)
+                except Exception:
+                    logging.exception("handler error for datagram from {}".format(addr))
+                    continue
+                if reply:
+                    replies.append((reply, addr))
+            if replies:
+                self.send_batch(replies)
+
+    def shutdown(self):
+        self._serving = False
+
+    def close(self):
+        self._serving = False
+        self._selector.close()
+        self._sock.close()
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    import threading
+
+    COUNT = 64 * 4000
+    payload = b"app.requests.latency:12|ms|#env:test"
+
+    def blast(port, count):
+        # 在独立进程中发送，避免和接收端竞争GIL
+        with UdpEndpoint.connect("127.0.0.1", port) as sender:
+            for _ in range(0, count, 64):
+                sender.send_batch([payload] * 64)
+            sender.send_batch([b""] * 64)
+
+    def bench_send(batched):
+        sink = UdpEndpoint.bind("127.0.0.1", 0)
+        with UdpEndpoint.connect(*sink.local_addr, batched=batched) as client:
+            begin = time.perf_counter()
+            for _ in range(0, COUNT, 64):
+                client.send_batch([payload] * 64)
+            cost = time.perf_counter() - begin
+            print("send {:<7} {:>8.0f} dgram/s, {} syscalls".format(
+                "batched" if batched else "loop", COUNT / cost, client.stats.send_calls))
+        sink.close()
+
+    def bench_recv(batched):
+        server = UdpEndpoint.bind("127.0.0.1", 0, SocketProfile(rcvbuf=8 * 1024 * 1024), batched=batched)
+        sender = multiprocessing.Process(target=blast, args=(server.local_addr[1], COUNT))
+        sender.start()
+        begin = end = None
+        finished = False
+        while not finished:
+            # 结束标记可能丢失，以最后一次收到数据的时间为准
+            batch = server.recv_batch(1)
+            if not batch:
+                break
+            end = time.perf_counter()
+            begin = begin or end
+            finished = any(len(data) == 0 for data, _ in batch)
+        cost = end - begin
+        sender.join()
+        print("recv {:<7} {:>8.0f} dgram/s, received {}/{} ({:.1%} lost), {} syscalls".format(
+            "batched" if batched else "loop", server.stats.received / cost, server.stats.received, COUNT + 64,
+            1 - server.stats.received / (COUNT + 64), server.stats.recv_calls))
+        server.close()
+
+    for mode in ((True, False) if _recvmmsg is not None else (False,)):
+        bench_send(mode)
+    for mode in ((True, False) if _recvmmsg is not None else (False,)):
+        bench_recv(mode)
+
+    # 请求响应
+    echo = UdpEndpoint.bind("127.0.0.1", 0)
+    threading.Thread(target=echo.serve_forever, args=(lambda data, addr: bytes(data).upper(),), daemon=True).start()
+    client = UdpEndpoint.connect(*echo.local_addr)
+    client.send_batch([b"a", b"b", b"c"])
+    replies = []
+    while len(replies) < 3:
+        replies.extend(bytes(data) for data, _ in client.recv_batch(1))
+    print(sorted(replies), echo.stats)
+    client.close()
+    echo.close()
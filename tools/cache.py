@@ -52,26 +52,28 @@ class DoubleList:
         return self.size >= self.cap
 
     def __insert_head(self, node):
+        node.prev = None
         if not self.head:
+            node.next = None
             self.head = node
             self.tail = node
         else:
             node.next = self.head
             self.head.prev = node
             self.head = node
-            self.head.prev = None
         self.size += 1
         return node
 
     def __append(self, node):
+        node.next = None
         if not self.tail:
+            node.prev = None
             self.tail = node
             self.head = node
         else:
             self.tail.next = node
             node.prev = self.tail
             self.tail = node
-            self.tail.next = None
         self.size += 1
         return node
 
@@ -103,35 +105,39 @@ class DoubleList:
         if not self.head:
             return
         node = self.head
-        if not node:
-            self.head = self.tail = None
-            return
         self.head = node.next
-        self.prev = None
+        if self.head:
+            self.head.prev = None
+        else:
+            self.tail = None
+        node.next = node.prev = None
         self.size -= 1
         return node
 
     def __remove_tail(self):
         if not self.tail:
             return
-        if self.head == self.tail:
-            self.head = self.tail = None
-            return
         node = self.tail
         self.tail = node.prev
-        self.tail.next = None
+        if self.tail:
+            self.tail.next = None
+        else:
+            self.head = None
+        node.next = node.prev = None
         self.size -= 1
         return node
 
     def __rm(self, node):
         node.prev.next = node.next
-        node.nexr.pre = node.prev
+        node.next.prev = node.prev
+        node.next = node.prev = None
         self.size -= 1
 
     def __remove(self, node):
-        if self.head == node:
+        # 使用is比较，Node.__eq__会比较value，缓存较大的值时开销很大
+        if self.head is node:
             return self.__remove_head()
-        elif self.tail == node:
+        elif self.tail is node:
             return self.__remove_tail()
         else:
             self.__rm(node)
@@ -166,6 +172,15 @@ class Cache(metaclass=abc.ABCMeta):
     def put(self, key, value):
         pass
 
+    @abc.abstractmethod
+    def delete(self, key):
+        """
+        删除key，返回被删除的值，不存在时返回None
+        :param key:
+        :return:
+        """
+        pass
+
     def capacity(self):
         return self.__cap
 
@@ -207,6 +222,13 @@ class FiIFOCache(Cache):
             self.map[key] = node
         self.list.append(node)
 
+    def delete(self, key):
+        node = self.map.pop(key, None)
+        if node is None:
+            return None
+        self.list.remove(node)
+        return node.value
+
 
 class LRUCache(Cache):
 
@@ -235,6 +257,13 @@ class LRUCache(Cache):
             self.__map[key] = node
         self.list.insert_head(node)
 
+    def delete(self, key):
+        node = self.__map.pop(key, None)
+        if node is None:
+            return None
+        self.list.remove(node)
+        return node.value
+
 
 class Frequency:
     __slots__ = ["__a", "__lock"]
@@ -312,6 +341,16 @@ class LFUCache(Cache):
                 self.frequency_map[node.frequency] = DoubleList()
             self.frequency_map[node.frequency].append(node)
 
+    def delete(self, key):
+        node = self.map.pop(key, None)
+        if node is None:
+            return None
+        lst = self.frequency_map[node.frequency]
+        lst.remove(node)
+        if lst.is_empty():
+            del self.frequency_map[node.frequency]
+        return node.value
+
     def __init__(self):
         super().__init__()
         self.map = {}
@@ -1,3 +1,5 @@
+import datetime
+import ipaddress
 import re
 from configparser import ConfigParser
 from typing import List, Any
@@ -5,7 +7,6 @@ from typing import List, Any
 from cryptography import x509
 from cryptography.hazmat._oid import ObjectIdentifier
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.backends.openssl.rsa import _RSAPrivateKey
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.x509 import NameOID
@@ -50,84 +51,83 @@ class X509Name:
         self.current_section = "X509Name"
 
     def collect(self) -> List[x509.NameAttribute]:
-        attrs = [x.lower() for x in NameOID.__dict__ if "__" not in x]
-        return [getattr(self, f"x509_{attr}")(self.config.get(self.current_section, attr).encode()) for attr in attrs if
-                self.config.get(self.current_section, attr)]
+        return [getattr(self, f"x509_{attr}")(value) for attr, value in self.config.items(self.current_section)
+                if value and hasattr(self, f"x509_{attr}")]
 
     @staticmethod
-    def x509name_attr(attr: ObjectIdentifier, data: bytes):
+    def x509name_attr(attr: ObjectIdentifier, data: str):
         return x509.NameAttribute(attr, data)
 
-    def x509_country_name(self, data: bytes):
+    def x509_country_name(self, data: str):
         return self.x509name_attr(NameOID.COUNTRY_NAME, data)
 
-    def x509_state_or_province_name(self, data: bytes):
-        return self.x509name_attr(NameOID.COUNTRY_NAME, data)
+    def x509_state_or_province_name(self, data: str):
+        return self.x509name_attr(NameOID.STATE_OR_PROVINCE_NAME, data)
 
-    def x509_common_name(self, data: bytes):
+    def x509_common_name(self, data: str):
         return self.x509name_attr(NameOID.COMMON_NAME, data)
 
-    def x509_locality_name(self, data: bytes):
+    def x509_locality_name(self, data: str):
         return self.x509name_attr(NameOID.LOCALITY_NAME, data)
 
-    def x509_street_address(self, data: bytes):
+    def x509_street_address(self, data: str):
         return self.x509name_attr(NameOID.STREET_ADDRESS, data)
 
-    def x509_organization_name(self, data: bytes):
+    def x509_organization_name(self, data: str):
         return self.x509name_attr(NameOID.ORGANIZATION_NAME, data)
 
-    def x509_organizational_unit_name(self, data: bytes):
+    def x509_organizational_unit_name(self, data: str):
         return self.x509name_attr(NameOID.ORGANIZATIONAL_UNIT_NAME, data)
 
-    def x509_serial_number(self, data: bytes):
+    def x509_serial_number(self, data: str):
         return self.x509name_attr(NameOID.SERIAL_NUMBER, data)
 
-    def x509_surname(self, data: bytes):
+    def x509_surname(self, data: str):
         return self.x509name_attr(NameOID.SURNAME, data)
 
-    def x509_given_name(self, data: bytes):
+    def x509_given_name(self, data: str):
         return self.x509name_attr(NameOID.GIVEN_NAME, data)
 
-    def x509_title(self, data: bytes):
+    def x509_title(self, data: str):
         return self.x509name_attr(NameOID.TITLE, data)
 
-    def x509_generation_qualifier(self, data: bytes):
+    def x509_generation_qualifier(self, data: str):
         return self.x509name_attr(NameOID.GENERATION_QUALIFIER, data)
 
-    def x509_x500_unique_identifier(self, data: bytes):
+    def x509_x500_unique_identifier(self, data: str):
         return self.x509name_attr(NameOID.X500_UNIQUE_IDENTIFIER, data)
 
-    def x509_dn_qualifier(self, data: bytes):
+    def x509_dn_qualifier(self, data: str):
         return self.x509name_attr(NameOID.DN_QUALIFIER, data)
 
-    def x509_pseudonym(self, data: bytes):
+    def x509_pseudonym(self, data: str):
         return self.x509name_attr(NameOID.PSEUDONYM, data)
 
-    def x509_user_id(self, data: bytes):
+    def x509_user_id(self, data: str):
         return self.x509name_attr(NameOID.USER_ID, data)
 
-    def x509_domain_component(self, data: bytes):
+    def x509_domain_component(self, data: str):
         return self.x509name_attr(NameOID.DOMAIN_COMPONENT, data)
 
-    def x509_email_address(self, data: bytes):
+    def x509_email_address(self, data: str):
         return self.x509name_attr(NameOID.EMAIL_ADDRESS, data)
 
-    def x509_jurisdiction_country_name(self, data: bytes):
+    def x509_jurisdiction_country_name(self, data: str):
         return self.x509name_attr(NameOID.JURISDICTION_COUNTRY_NAME, data)
 
-    def x509_jurisdiction_locality_name(self, data: bytes):
+    def x509_jurisdiction_locality_name(self, data: str):
         return self.x509name_attr(NameOID.JURISDICTION_LOCALITY_NAME, data)
 
-    def x509_jurisdiction_state_or_province_name(self, data: bytes):
+    def x509_jurisdiction_state_or_province_name(self, data: str):
         return self.x509name_attr(NameOID.JURISDICTION_STATE_OR_PROVINCE_NAME, data)
 
-    def x509_business_category(self, data: bytes):
+    def x509_business_category(self, data: str):
         return self.x509name_attr(NameOID.BUSINESS_CATEGORY, data)
 
-    def x509_postal_address(self, data: bytes):
+    def x509_postal_address(self, data: str):
         return self.x509name_attr(NameOID.POSTAL_ADDRESS, data)
 
-    def x509_postal_code(self, data: bytes):
+    def x509_postal_code(self, data: str):
         return self.x509name_attr(NameOID.POSTAL_CODE, data)
 
 
@@ -146,7 +146,7 @@ class X509SubjectAlternativeName:
 class X509Cert:
 
     @staticmethod
-    def generate_private_key(key_size, backend=None, public_exponent=65537) -> _RSAPrivateKey:
+    def generate_private_key(key_size, backend=None, public_exponent=65537) -> rsa.RSAPrivateKey:
         """
         生成RSA秘钥
         :param key_size:  bits 是一个字节大小的值，必须大于等于1024，通常建议写1024的倍数，FIPS定义了1024，2048， 3072。
@@ -158,18 +158,23 @@ class X509Cert:
                                         backend=default_backend() if backend is None else backend())
 
     @staticmethod
-    def save_private_key(filename, key: _RSAPrivateKey):
+    def save_private_key(filename, key: rsa.RSAPrivateKey, password: bytes = None):
         """
         保存生成的RSA秘钥
         :param filename: 文件路径
         :param key: 生成的秘钥
+        :param password: 加密秘钥的密码，为None时不加密
         :return:
         """
+        if password:
+            encryption = serialization.BestAvailableEncryption(password)
+        else:
+            encryption = serialization.NoEncryption()
         with open(filename, "wb") as f:
             f.write(key.private_bytes(
                 encoding=serialization.Encoding.PEM,
                 format=serialization.PrivateFormat.TraditionalOpenSSL,
-                encryption_algorithm=serialization.BestAvailableEncryption,
+                encryption_algorithm=encryption,
             ))
 
     @staticmethod
@@ -185,6 +190,51 @@ class X509Cert:
         with open(csr_file_name, 'wb') as f:
             f.write(csr.public_bytes(encoding))
 
+    @staticmethod
+    def generate_self_signed(private_key, name: X509Name, subject: X509SubjectAlternativeName, days=365,
+                             ip_addresses=()) -> x509.Certificate:
+        """
+        生成自签名证书，可以用于本地测试TLS服务器
+        :param private_key: 生成的秘钥
+        :param name: 证书的subject和issuer
+        :param subject: 证书的DNS备用名称，客户端使用其中的域名校验证书
+        :param days: 有效天数
+        :param ip_addresses: 额外的IP备用名称，例如127.0.0.1
+        :return:
+        """
+        x509_name = x509.Name(name.collect())
+        alt_names = subject.collect() + [x509.IPAddress(ipaddress.ip_address(ip)) for ip in ip_addresses]
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return x509.CertificateBuilder() \
+            .subject_name(x509_name) \
+            .issuer_name(x509_name) \
+            .public_key(private_key.public_key()) \
+            .serial_number(x509.random_serial_number()) \
+            .not_valid_before(now - datetime.timedelta(minutes=5)) \
+            .not_valid_after(now + datetime.timedelta(days=days)) \
+            .add_extension(x509.SubjectAlternativeName(alt_names), critical=False) \
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True) \
+            .sign(private_key, hashes.SHA256(), default_backend())
+
+    @staticmethod
+    def save_cert_file(cert_file_name, cert: x509.Certificate, encoding=serialization.Encoding.PEM):
+        with open(cert_file_name, 'wb') as f:
+            f.write(cert.public_bytes(encoding))
+
+
+def load_config(filename=None) -> ConfigParser:
+    """
+    读取证书配置，支持CONFIG_INI中的行尾注释
+    :param filename: .ini文件路径，为None时使用CONFIG_INI
+    :return:
+    """
+    config = ConfigParser(inline_comment_prefixes=("#",))
+    if filename is None:
+        config.read_string(CONFIG_INI)
+    else:
+        config.read(filename, encoding="utf-8")
+    return config
+
 
 if __name__ == '__main__':
     with open("example.ini", "w") as f: